@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmark hedged getInvoiceTopLevelItems calls (hedging.py) against a local stub server with a slow tail.
+
+The stub server answers each page after --latency seconds, or --slow times that for a --tail fraction of requests.
+--pages calls are made one after another (as invoiceAnalysis.py pages an invoice) through a client from
+softlayerClient.createClient, first without hedging and then with it.  Reported are the total and p99 page time,
+hedges sent, and how many a hedge won.
+
+    python benchmarks/hedgingBenchmark.py --pages 300
+    python benchmarks/hedgingBenchmark.py --pages 300 --tail 0.05 --budget 0.02
+"""
+
+import argparse, json, logging, os, random, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import hedging, softlayerClient
+from runMetrics import metrics, percentile
+
+page = json.dumps([{"id": i, "billingItemId": i, "categoryCode": "server", "totalRecurringAmount": "1.00"} for i in range(75)]).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        slow = random.random() < self.server.tail
+        time.sleep(self.server.latency * (self.server.slow if slow else 1))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(server, pages, hedge, budget):
+    """
+    Return (seconds, page times, hedges, hedges won) for pages calls made one after another
+    """
+    url = "http://127.0.0.1:{}/xmlrpc/v3.1".format(server.server_address[1])
+    client = metrics.instrumentSoftLayer(softlayerClient.createClient("stub", url, "rest"))
+    metrics.api.clear()
+    metrics.hedges.clear()
+    hedging.hedger = hedging.Hedger(budget=budget)
+    if hedge:
+        hedging.hedgeSoftLayer(client)
+    times = []
+    start = time.perf_counter()
+    for offset in range(pages):
+        called = time.perf_counter()
+        client['Billing_Invoice'].getInvoiceTopLevelItems(id=1, limit=75, offset=offset)
+        times.append(time.perf_counter() - called)
+    seconds = time.perf_counter() - start
+    hedges = sum(stats["hedged"] for stats in metrics.hedges.values())
+    won = sum(stats["hedge"] for stats in metrics.hedges.values())
+    return seconds, times, hedges, won
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hedged SoftLayer page calls against a local stub server.")
+    parser.add_argument("--pages", type=int, default=200, help="Pages called per run.")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds the stub server takes per page.")
+    parser.add_argument("--slow", type=float, default=50, help="Times --latency a slow page takes.")
+    parser.add_argument("--tail", type=float, default=0.03, help="Fraction of pages which are slow.")
+    parser.add_argument("--budget", type=float, default=hedging.BUDGET, help="Largest fraction of calls hedged.")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.ERROR)
+    # the stub pages are quick, so hedge after the percentile itself rather than the production floor
+    hedging.MIN_DEADLINE = 0
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.latency, server.slow, server.tail = args.latency, args.slow, args.tail
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("{:>8} {:>10} {:>10} {:>8} {:>8}".format("hedging", "seconds", "p99 s", "hedges", "won"))
+    for hedge in (False, True):
+        random.seed(1)
+        seconds, times, hedges, won = run(server, args.pages, hedge, args.budget)
+        print("{:>8} {:>10.2f} {:>10.3f} {:>8} {:>8}".format("on" if hedge else "off", seconds, percentile(times, 99), hedges, won))
+    server.shutdown()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmark the shared HTTP session (httpSessions.py) against the SDK clients' default sessions.
+
+A local stub server answers get_account_usage with a small usage document after --latency seconds, and returns 429
+(Retry-After: 0) for a --throttle fraction of requests.  --threads workers share one UsageReportsV4 client, first with
+its default session (a pool of 10 connections, no retries) and then configured with configureService.  Reported are
+requests per second, connections the server accepted, failed calls, and calls retried after a 429 by the rate
+limiter.
+
+    python benchmarks/httpSessionBenchmark.py --threads 8 32 64 --requests 2000
+    python benchmarks/httpSessionBenchmark.py --threads 32 --throttle 0.05
+"""
+
+import argparse, json, logging, os, random, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ibm_platform_services import UsageReportsV4
+from ibm_cloud_sdk_core import ApiException
+from ibm_cloud_sdk_core.authenticators import NoAuthAuthenticator
+import httpSessions
+from runMetrics import metrics
+from rateLimiter import limiter
+
+usage = json.dumps({"account_id": "stub", "billing_country": "USA", "currency_code": "USD", "month": "2023-10",
+                    "resources": [{"resource_id": "service-{}".format(i), "billable_cost": 1.0, "billable_rated_cost": 1.0,
+                                   "plans": []} for i in range(20)]}).encode()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, throttle):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.latency = latency
+        self.throttle = throttle
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if random.random() < self.server.throttle:
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            body = b'{"errors": [{"message": "Too many requests"}]}'
+        else:
+            self.send_response(200)
+            body = usage
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(server, threads, requests, shared):
+    """
+    Return (seconds, connections, failed calls, throttled calls) for requests calls made by threads workers
+    """
+    service = UsageReportsV4(authenticator=NoAuthAuthenticator())
+    service.set_service_url("http://127.0.0.1:{}".format(server.server_address[1]))
+    if shared:
+        httpSessions.sessions.clear()
+        httpSessions.configureService(service, poolSize=threads)
+    metrics.waits.clear()
+    limiter.buckets.clear()
+    server.connections = 0
+    failed = []
+
+    def call(i):
+        try:
+            service.get_account_usage(account_id="stub", billingmonth="2023-10").get_result()
+        except ApiException:
+            failed.append(i)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(call, range(requests)))
+    seconds = time.perf_counter() - start
+    service.get_http_client().close()
+    return seconds, server.connections, len(failed), sum(waits["throttled"] for waits in metrics.waits.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the shared HTTP session against a local stub server.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[8, 32], help="Concurrent callers, one run per value.")
+    parser.add_argument("--requests", type=int, default=1000, help="Calls per run.")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds the stub server takes per request.")
+    parser.add_argument("--throttle", type=float, default=0, help="Fraction of requests answered with 429.")
+    args = parser.parse_args()
+    # the default pool logs a warning for each connection it discards when full
+    logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+    logging.getLogger().setLevel(logging.ERROR)
+
+    server = StubServer(args.latency, args.throttle)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("{:>8} {:>8} {:>10} {:>12} {:>8} {:>8}".format("threads", "session", "req/s", "connections", "failed", "throttled"))
+    for threads in args.threads:
+        for shared in (False, True):
+            seconds, connections, failed, throttled = run(server, threads, args.requests, shared)
+            print("{:>8} {:>8} {:>10.1f} {:>12} {:>8} {:>8}".format(threads, "shared" if shared else "default",
+                                                                   args.requests / seconds, connections, failed, throttled))
+    server.shutdown()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmark ibmCloudUsage.getInstancesUsage over synthetic instance usage.
+
+A stand-in for the Usage Reports service returns generated pages of instance usage, so the time measured is the
+row processing and DataFrame construction in getInstancesUsage, not the API.  --latency adds a simulated API
+latency per page to measure concurrent month retrieval with --workers.
+
+    python benchmarks/instancesUsageBenchmark.py --months 12 24 --instances 2000
+    python benchmarks/instancesUsageBenchmark.py --months 12 --instances 500 --latency 0.2 --workers 12
+"""
+
+import argparse, logging, os, sys, time
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import ibmCloudUsage
+from runMetrics import peakMemoryMB
+
+
+class SyntheticResult(object):
+    def __init__(self, result):
+        self.result = result
+
+    def get_result(self):
+        return self.result
+
+
+class SyntheticUsageReports(object):
+    """
+    Returns pages of generated instance usage for any month
+    """
+
+    def __init__(self, instances, metrics, latency=0):
+        self.instances = instances
+        self.metrics = metrics
+        self.latency = latency
+
+    def instance(self, month, i):
+        usage = []
+        for m in range(self.metrics):
+            usage.append({"metric": "METRIC_{}".format(m), "metric_name": "Metric {}".format(m), "unit": "HOURS",
+                          "unit_name": "Hours", "quantity": 720.0 + m, "rateable_quantity": 720.0 + m,
+                          "cost": 10.0 * m, "rated_cost": 10.0 * m,
+                          "price": [{"quantity_from": 0, "quantity_to": 999999, "price": 0.01}], "discounts": []})
+        return {"account_id": "synthetic", "resource_instance_id": "crn:v1:bluemix:public:synthetic:us-south:a/1::instance:{}".format(i),
+                "resource_group_id": "rg{}".format(i % 5), "resource_group_name": "group {}".format(i % 5), "month": month,
+                "pricing_country": "USA", "billing_country": "USA", "currency_code": "USD", "plan_id": "plan{}".format(i % 20),
+                "plan_name": "Plan {}".format(i % 20), "billable": True, "pricing_plan_id": "pricing{}".format(i % 20),
+                "pricing_region": "us-south", "region": "us-south", "resource_id": "service{}".format(i % 30),
+                "resource_name": "Service {}".format(i % 30), "resource_instance_name": "instance-{}".format(i), "usage": usage}
+
+    def get_resource_usage_account(self, account_id, billingmonth, names=True, limit=100, start=None, **kwargs):
+        time.sleep(self.latency)
+        offset = int(start) if start else 0
+        resources = [self.instance(billingmonth, i) for i in range(offset, min(offset + limit, self.instances))]
+        result = {"count": self.instances, "limit": limit, "resources": resources}
+        if offset + limit < self.instances:
+            result["next"] = {"offset": str(offset + limit)}
+        return SyntheticResult(result)
+
+
+def run(months, instances, metrics, latency=0, workers=1):
+    ibmCloudUsage.usage_reports_service = SyntheticUsageReports(instances, metrics, latency)
+    ibmCloudUsage.accountId = "synthetic"
+    ibmCloudUsage.resource_cache = {}
+    ibmCloudUsage.tag_cache = {}
+    # every instance is already cached, so no resource controller calls are made
+    for i in range(instances):
+        ibmCloudUsage.resource_cache["crn:v1:bluemix:public:synthetic:us-south:a/1::instance:{}".format(i)] = {"type": "service_instance", "state": "active"}
+    start = datetime(2022, 1, 1)
+    end = start + relativedelta(months=months - 1)
+    started = time.perf_counter()
+    instancesUsage = ibmCloudUsage.getInstancesUsage(start, end, workers)
+    return time.perf_counter() - started, len(instancesUsage)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark getInstancesUsage over synthetic instance usage.")
+    parser.add_argument("--months", type=int, nargs="+", default=[12, 24], help="Month counts to benchmark.")
+    parser.add_argument("--instances", type=int, default=2000, help="Instances per month.")
+    parser.add_argument("--metrics", type=int, default=3, help="Usage metrics per instance.")
+    parser.add_argument("--latency", type=float, default=0, help="Simulated API latency in seconds per page.")
+    parser.add_argument("--workers", type=int, default=1, help="Months retrieved concurrently.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    for months in args.months:
+        seconds, rows = run(months, args.instances, args.metrics, args.latency, args.workers)
+        print("{:>3} months: {:>9,} rows in {:7.2f}s ({:,.0f} rows/sec, {:.3f}s per month, peak RSS {} MB)".format(
+            months, rows, seconds, rows / seconds, seconds / months, peakMemoryMB()))
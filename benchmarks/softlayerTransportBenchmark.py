@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compare the XML-RPC and REST SoftLayer transports on large Billing_Invoice::getInvoiceTopLevelItems pages.
+
+Pages of generated top level items, shaped like those returned for invoiceAnalysis.py's object mask, are encoded as
+each transport's response.  The time to decode them (xmlrpc.client.loads and json.loads, as the transports do) and the
+response size are reported.  --end-to-end also serves the pages from a local stub server and times the call through
+clients from softlayerClient.createClient.
+
+    python benchmarks/softlayerTransportBenchmark.py --items 1000 5000
+    python benchmarks/softlayerTransportBenchmark.py --items 2000 --end-to-end
+"""
+
+import argparse, json, os, sys, threading, time, xmlrpc.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import softlayerClient
+
+
+def invoiceItem(i):
+    """
+    Return a generated top level invoice item with two children
+    """
+    def product(description):
+        return {"description": description, "taxCategory": {"id": 3, "name": "Taxable"},
+                "attributes": [{"value": "1", "attributeType": {"keyName": "HOURLY_BILLING", "name": "Hourly"}}]}
+    return {"id": 1000000 + i, "billingItemId": 2000000 + i, "categoryCode": "server", "hourlyFlag": True,
+            "category": {"name": "Server", "categoryCode": "server", "group": {"name": "Compute"}},
+            "hostName": "host{}".format(i), "domainName": "example.com", "location": {"id": 138124, "name": "dal10", "longName": "Dallas 10"},
+            "notes": "", "product": product("Dual Intel Xeon Silver 4210 (20 Cores, 2.20 GHz)"), "createDate": "2023-10-01T00:00:00-06:00",
+            "totalRecurringAmount": "412.50", "totalOneTimeAmount": "0", "usageChargeFlag": False, "hourlyRecurringFee": ".573",
+            "children": [{"billingItemId": 3000000 + 2 * i + c, "description": "Child {}".format(c), "categoryCode": "ram",
+                          "category": {"group": {"name": "Memory"}}, "product": product("64 GB RAM"), "recurringFee": "45.00"}
+                         for c in range(2)]}
+
+
+def encodePages(items):
+    page = [invoiceItem(i) for i in range(items)]
+    return xmlrpc.client.dumps((page,), methodresponse=True, allow_none=True).encode(), json.dumps(page).encode()
+
+
+def timeDecode(decode, body, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decode(body)
+    return (time.perf_counter() - start) / repeat
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        body = self.server.bodies["rest" if self.path.split("?")[0].endswith(".json") else "xmlrpc"]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = respond
+    do_POST = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+def timeCall(server, transport, repeat):
+    url = "http://127.0.0.1:{}/xmlrpc/v3.1".format(server.server_address[1])
+    client = softlayerClient.createClient("stub", url, transport)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        client['Billing_Invoice'].getInvoiceTopLevelItems(id=1, limit=len(server.items))
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare XML-RPC and REST decode cost of getInvoiceTopLevelItems pages.")
+    parser.add_argument("--items", type=int, nargs="+", default=[1000, 5000], help="Items per page, one run per value.")
+    parser.add_argument("--repeat", type=int, default=5, help="Times each page is decoded.")
+    parser.add_argument("--end-to-end", default=False, action=argparse.BooleanOptionalAction, help="Also time calls through a local stub server.")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>10} {:>10} {:>10} {:>9}".format("items", "xmlrpc MB", "rest MB", "xmlrpc s", "rest s", "speedup"))
+    for items in args.items:
+        xmlBody, jsonBody = encodePages(items)
+        xmlSeconds = timeDecode(xmlrpc.client.loads, xmlBody, args.repeat)
+        jsonSeconds = timeDecode(json.loads, jsonBody, args.repeat)
+        print("{:>8} {:>10.2f} {:>10.2f} {:>10.3f} {:>10.3f} {:>8.1f}x".format(items, len(xmlBody) / 1048576, len(jsonBody) / 1048576,
+                                                                           xmlSeconds, jsonSeconds, xmlSeconds / jsonSeconds))
+        if args.end_to_end:
+            server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+            server.daemon_threads = True
+            server.bodies = {"xmlrpc": xmlBody, "rest": jsonBody}
+            server.items = range(items)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            xmlCall = timeCall(server, "xmlrpc", args.repeat)
+            restCall = timeCall(server, "rest", args.repeat)
+            print("{:>8} {:>21} {:>10.3f} {:>10.3f} {:>8.1f}x  (call through stub server)".format(items, "", xmlCall, restCall, xmlCall / restCall))
+            server.shutdown()
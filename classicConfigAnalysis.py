@@ -18,28 +18,13 @@ import pandas as pd
 import numpy as np
 from datetime import datetime
 from dotenv import load_dotenv
+from logSetup import setup_logging
+from softlayerClient import createClient, createEmployeeClient, TRANSPORTS, TIMEOUT
+from runMetrics import metrics
+from rateLimiter import limiter
+from hedging import hedgeSoftLayer, hedger, BUDGET
 
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
-def createEmployeeClient(end_point_employee, employee_user, passw, token):
-    """Creates a softlayer-python client that can make API requests for a given employee_user"""
-    client_noauth = SoftLayer.Client(endpoint_url=end_point_employee)
-    client_noauth.auth = None
-    employee = client_noauth['SoftLayer_User_Employee']
-    result = employee.performExternalAuthentication(employee_user, passw, token)
-    # Save result['hash'] somewhere to not have to login for every API request
-    client_employee = SoftLayer.employee_client(username=employee_user, access_token=result['hash'], endpoint_url=end_point_employee)
-    return client_employee
+@metrics.timed()
 def getinventory():
     """
     GET DETAILS OF ALL HARDWARE DEVICES IN ACCOUNT
@@ -430,9 +415,12 @@ def getinventory():
     ]
     hardware_df = pd.DataFrame(data,columns=hw_columns)
     trunkedvlan_df = pd.DataFrame(trunkedvlan_data)
+    metrics.addRows("hardware", len(hardware_df))
+    metrics.addRows("trunkedVlans", len(trunkedvlan_df))
 
     return hardware_df, trunkedvlan_df
 
+@metrics.timed()
 def createHWDetail(hardware_df):
     """
     Write detail tab to excel
@@ -446,6 +434,7 @@ def createHWDetail(hardware_df):
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
 
+@metrics.timed()
 def createProcessorPivot(hardware_df):
     """
     Create a Pivot of Servers by Processor type
@@ -463,6 +452,7 @@ def createProcessorPivot(hardware_df):
     worksheet.set_column("B:B", 60, leftformat)
     worksheet.set_column("C:C", 10, format1)
     return
+@metrics.timed()
 def createMotherboardPivot(hardware_df):
     """
     Create a Pivot of Servers by Processor type
@@ -480,6 +470,7 @@ def createMotherboardPivot(hardware_df):
     worksheet.set_column("B:B", 75, leftformat)
     worksheet.set_column("C:C", 10, format1)
     return
+@metrics.timed()
 def createHostsByDatePivot(hardware_df):
     """
     Create a Pivot of Servers by Processor type
@@ -501,6 +492,7 @@ def createHostsByDatePivot(hardware_df):
     worksheet.set_column("E:E", 10, format1)
     return
 
+@metrics.timed()
 def createVlanDetail(trunkedvlan_df):
     """
     Write detail tab to excel
@@ -519,6 +511,7 @@ def createVlanDetail(trunkedvlan_df):
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
 
+@metrics.timed()
 def createServersByTrunkedVlan(trunkedvlan_df):
     """
     Create a Pivot of list of Servers per tagged VLAN
@@ -542,6 +535,7 @@ def createServersByTrunkedVlan(trunkedvlan_df):
 
     return
 
+@metrics.timed()
 def createServersbyOsPivot(hardware_df):
     """
     Create a list of server for each OS
@@ -560,6 +554,7 @@ def createServersbyOsPivot(hardware_df):
     worksheet.set_column("C:C", 10, format1)
     return
 
+@metrics.timed()
 def createTaggedVlanbyServersPivot(hardware_df):
     """
     Create a list of server for each OS
@@ -608,8 +603,19 @@ if __name__ == "__main__":
     parser.add_argument("--output", default=os.environ.get('output', 'config-report.xlsx'), help="Excel filename for output file. (including extension of .xlsx)")
     parser.add_argument("--load", action=argparse.BooleanOptionalAction, help="load dataframes from pkl files.")
     parser.add_argument("--save", action=argparse.BooleanOptionalAction, help="Store dataframes to pkl files.")
+    parser.add_argument("--sl-transport", default=os.environ.get('sl_transport', 'xmlrpc'), choices=TRANSPORTS, help="SoftLayer API transport, rest is quicker to parse for large pages.")
+    parser.add_argument("--sl-timeout", type=int, default=os.environ.get('sl_timeout', TIMEOUT), help="Seconds to wait for a SoftLayer API response before retrying.")
+    parser.add_argument("--rate-limits", default=os.environ.get('rate_limits', None), help="API calls per second by family, ie SoftLayer=10,UsageReportsV4=20 (default unlimited, slowed automatically when throttled).")
+    parser.add_argument("--hedge", default=False, action=argparse.BooleanOptionalAction, help="Send a second copy of slow getHardware pages and use the first answer.")
+    parser.add_argument("--hedge-budget", type=float, default=os.environ.get('hedge_budget', BUDGET), help="Largest fraction of page calls which may be hedged.")
+    parser.add_argument("--metrics-out", default=os.environ.get('metrics_out', None), help="Write run metrics (phase timings, API latency, rows) to this JSON file.")
+    parser.add_argument("--profile", default=os.environ.get('profile', None), help="Write cProfile stats for the run to this file.")
 
     args = parser.parse_args()
+    metrics.enable(args.metrics_out, args.profile)
+    limiter.configure(args.rate_limits)
+    if args.hedge:
+        hedger.configure(budget=args.hedge_budget)
 
     if args.load:
         logging.info("Retrieving Usage and Instance data stored data")
@@ -628,7 +634,7 @@ if __name__ == "__main__":
                     ims_yubikey = input("Yubi Key:")
                     ims_account = args.account
                     SL_ENDPOINT = "http://internal.applb.dal10.softlayer.local/v3.1/internal/xmlrpc"
-                    client = createEmployeeClient(SL_ENDPOINT, ims_username, ims_password, ims_yubikey)
+                    client = createEmployeeClient(SL_ENDPOINT, ims_username, ims_password, ims_yubikey, args.sl_transport, timeout=args.sl_timeout)
                 else:
                     logging.error("Error!  Can't find internal credentials or ims account.")
                     quit()
@@ -644,7 +650,12 @@ if __name__ == "__main__":
                 SL_ENDPOINT = "https://api.softlayer.com/xmlrpc/v3.1"
 
             # Create Classic infra API client
-            client = SoftLayer.Client(username="apikey", api_key=IC_API_KEY, endpoint_url=SL_ENDPOINT)
+            client = createClient(IC_API_KEY, SL_ENDPOINT, args.sl_transport, timeout=args.sl_timeout)
+
+        # time every classic API call for the run metrics
+        metrics.instrumentSoftLayer(client)
+        if args.hedge:
+            hedgeSoftLayer(client)
 
         """
         Using Account API retrieve Baremetal Server Inventory for account.
@@ -670,7 +681,8 @@ if __name__ == "__main__":
     createMotherboardPivot(hardware_df)
     createHostsByDatePivot(hardware_df)
     createServersbyOsPivot(hardware_df)
-    writer.close()
+    with metrics.phase("xlsxWriterClose"):
+        writer.close()
 
 
 
@@ -6,28 +6,11 @@
 
 import SoftLayer, json, os, argparse, logging, logging.config
 from dotenv import load_dotenv
-
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
-def createEmployeeClient(end_point_employee, employee_user, passw, token):
-    """Creates a softlayer-python client that can make API requests for a given employee_user"""
-    client_noauth = SoftLayer.Client(endpoint_url=end_point_employee)
-    client_noauth.auth = None
-    employee = client_noauth['SoftLayer_User_Employee']
-    result = employee.performExternalAuthentication(employee_user, passw, token)
-    # Save result['hash'] somewhere to not have to login for every API request
-    client_employee = SoftLayer.employee_client(username=employee_user, access_token=result['hash'], endpoint_url=end_point_employee)
-    return client_employee
+from logSetup import setup_logging
+from softlayerClient import createClient, createEmployeeClient, TRANSPORTS, TIMEOUT
+from runMetrics import metrics
+from rateLimiter import limiter
+from hedging import hedgeSoftLayer, hedger, BUDGET
 
 def output(line):
     
@@ -71,7 +54,7 @@ class TablePrinter(object):
 
 
 if __name__ == "__main__":
-
+    setup_logging()
     load_dotenv()
     ## READ CommandLine Arguments and load configuration file
     parser = argparse.ArgumentParser(description="Configuration Report prints details of BareMetal Servers such as Network, VLAN, and hardware configuration")
@@ -86,8 +69,19 @@ if __name__ == "__main__":
     parser.add_argument("-c", "--config", help="config.ini file to load")
     parser.add_argument("--output", default=os.environ.get('output', 'config-report.txt'),
                        help="Text filename for output file. (including extension of .txt)")
+    parser.add_argument("--sl-transport", default=os.environ.get('sl_transport', 'xmlrpc'), choices=TRANSPORTS, help="SoftLayer API transport, rest is quicker to parse for large pages.")
+    parser.add_argument("--sl-timeout", type=int, default=os.environ.get('sl_timeout', TIMEOUT), help="Seconds to wait for a SoftLayer API response before retrying.")
+    parser.add_argument("--rate-limits", default=os.environ.get('rate_limits', None), help="API calls per second by family, ie SoftLayer=10,UsageReportsV4=20 (default unlimited, slowed automatically when throttled).")
+    parser.add_argument("--hedge", default=False, action=argparse.BooleanOptionalAction, help="Send a second copy of slow getHardware pages and use the first answer.")
+    parser.add_argument("--hedge-budget", type=float, default=os.environ.get('hedge_budget', BUDGET), help="Largest fraction of page calls which may be hedged.")
+    parser.add_argument("--metrics-out", default=os.environ.get('metrics_out', None), help="Write run metrics (phase timings, API latency, rows) to this JSON file.")
+    parser.add_argument("--profile", default=os.environ.get('profile', None), help="Write cProfile stats for the run to this file.")
 
     args = parser.parse_args()
+    metrics.enable(args.metrics_out, args.profile)
+    limiter.configure(args.rate_limits)
+    if args.hedge:
+        hedger.configure(budget=args.hedge_budget)
 
     if args.IC_API_KEY == None:
         if args.username == None or args.password == None or args.account == None:
@@ -101,7 +95,7 @@ if __name__ == "__main__":
                 ims_yubikey = input("Yubi Key:")
                 ims_account = args.account
                 SL_ENDPOINT = "http://internal.applb.dal10.softlayer.local/v3.1/internal/xmlrpc"
-                client = createEmployeeClient(SL_ENDPOINT, ims_username, ims_password, ims_yubikey)
+                client = createEmployeeClient(SL_ENDPOINT, ims_username, ims_password, ims_yubikey, args.sl_transport, timeout=args.sl_timeout)
             else:
                 logging.error("Error!  Can't find internal credentials or ims account.")
                 quit()
@@ -117,9 +111,13 @@ if __name__ == "__main__":
             SL_ENDPOINT = "https://api.softlayer.com/xmlrpc/v3.1"
 
         # Create Classic infra API client
-        client = SoftLayer.Client(username="apikey", api_key=IC_API_KEY, endpoint_url=SL_ENDPOINT)
+        client = createClient(IC_API_KEY, SL_ENDPOINT, args.sl_transport, timeout=args.sl_timeout)
+
+    # time every classic API call for the run metrics
+    metrics.instrumentSoftLayer(client)
+    if args.hedge:
+        hedgeSoftLayer(client)
 
-    setup_logging()
     # BUILD TABLES
     #
     networkFormat = [
@@ -170,7 +168,8 @@ if __name__ == "__main__":
         limit = 10
         offset = 0
         while True:
-            hardwarelist = client['Account'].getHardware(id=ims_account, limit=limit, offset=offset, mask='datacenter,datacenterName,networkVlans,backendRouters,frontendRouters,backendNetworkComponentCount,backendNetworkComponents,'\
+            with metrics.phase("getHardware"):
+                hardwarelist = client['Account'].getHardware(id=ims_account, limit=limit, offset=offset, mask='datacenter,datacenterName,networkVlans,backendRouters,frontendRouters,backendNetworkComponentCount,backendNetworkComponents,'\
                     'backendNetworkComponents.router,backendNetworkComponents.router.primaryIpAddress,backendNetworkComponents.duplexMode,backendNetworkComponents.uplinkComponent,frontendNetworkComponentCount,frontendNetworkComponents,frontendNetworkComponents.router,'
                     'frontendNetworkComponents.duplexMode,frontendNetworkComponents.router.primaryIpAddress,frontendNetworkComponents.uplinkComponent,uplinkNetworkComponents,activeComponents,processors,networkGatewayMemberFlag,softwareComponents')
 
@@ -179,6 +178,7 @@ if __name__ == "__main__":
                 break
             else:
                 offset = offset + len(hardwarelist)
+                metrics.addRows("hardware", len(hardwarelist))
             """
             Extract hardware data from json
             """
@@ -1,46 +1,115 @@
 
-import os, logging, logging.config, json, os.path, argparse, calendar, time
+import os, re, logging, logging.config, json, os.path, argparse, calendar, time
 import pandas as pd
 import numpy as np
 from datetime import datetime
 from dateutil.relativedelta import *
 from dateutil import tz
+from runMetrics import metrics
+from resourceCache import ResourceCache
+from usageSnapshots import iterSnapshots, rowKeys
+from logSetup import setup_logging
 
-def do_compare(prev_pickle_filename, curr_pickle_filename):
-    prev_df = pd.read_pickle(prev_pickle_filename)
-    curr_df = pd.read_pickle(curr_pickle_filename)
+# rows are compared by instance, metric and unit
+KEY = ["instance_id", "metric", "unit"]
+VALUES = ["cost", "quantity"]
+DESCRIBE = ["month", "service_name", "instance_name", "plan_name", "region", "resource_group_name"]
 
-    #prev_df = prev_df.rename(columns=lambda x: x+'_prev')
-    #prev_df = prev_df.rename(columns={'instance_id_prev':'instance_id'})
-    prev_df = prev_df.rename(columns={'quantity':'quantity_prev','cost':'cost_prev','rated_cost':'rated_cost_prev','rateable_quantity':'rateable_quantity_prev'})
-    #prev_df = prev_df.rename(columns={'cost':'cost_prev'})
-
-
-    print(prev_df)
-    print(curr_df)
-
-    print(prev_df.columns)
-
-
-    #combine_df = pd.merge(curr_df,prev_df[['instance_id','cost_prev']],on='instance_id', how='left')
-    combine_df = pd.merge(curr_df,prev_df[['instance_id','metric','unit','unit_name','quantity_prev','cost_prev']], how='left')
-
-    print(combine_df)
-    print(combine_df.columns)
-
-    print(combine_df[['instance_id','cost_prev','cost','quantity_prev','quantity']])
+def iterPickles(start, end):
+    """
+    Yield (day, instance usage) for each instanceUsage-YYYYMMDD.pkl in the current directory from start to end
+    (YYYYMMDD, default all)
+    """
+    for name in sorted(os.listdir(".")):
+        match = re.match(r"^instanceUsage-(\d{8})\.pkl$", name)
+        if match and (start == None or match.group(1) >= start) and (end == None or match.group(1) <= end):
+            yield match.group(1), pd.read_pickle(name)
 
-    combine_df['cost_diff'] = combine_df['cost'].sub(combine_df['cost_prev'])
-    combine_df['quantity_diff'] = combine_df['quantity'].sub(combine_df['quantity_prev'])
-    #print(combine_df[['instance_id','cost_diff','quantity_diff']])
+def shiftDays(values, days):
+    """
+    Return values shifted right by days columns, NaN where there is no earlier day
+    """
+    shifted = np.full(values.shape, np.nan)
+    if days < values.shape[1]:
+        shifted[:, days:] = values[:, :values.shape[1] - days]
+    return shifted
 
-    #instance_id_crn = 'crn:v1***'
-    #final_df = combine_df[combine_df['instance_id'] == instance_id_crn]
-    #print(final_df[['instance_id','cost_diff','quantity_diff']])
-    print(combine_df[['instance_id','cost','cost_prev','quantity','quantity_prev','cost_diff','quantity_diff']])
+def shiftCalendarDays(values, labels, days):
+    """
+    Return the values of the day days calendar days before each column's day (labels are YYYYMMDD), NaN where there
+    is no snapshot for that day
+    """
+    dates = [datetime.strptime(label, "%Y%m%d").toordinal() for label in labels]
+    column = {date: i for i, date in enumerate(dates)}
+    shifted = np.full(values.shape, np.nan)
+    for i, date in enumerate(dates):
+        if date - days in column:
+            shifted[:, i] = values[:, column[date - days]]
+    return shifted
+
+@metrics.timed()
+def compareDays(days, window=7, costThreshold=1.0, quantityThreshold=None):
+    """
+    Compare instance usage across any number of days in one pass.  days is an iterable of (day, instance usage) in
+    date order.  Cost and quantity are summed per instance, metric and unit for each day, and a row is returned for
+    each key and day where the change from the previous day loaded, or from window calendar days before, exceeds a
+    threshold.
+    """
+    labels = []
+    totals = []
+    describe = None
+    for day, df in days:
+        columns = [column for column in DESCRIBE if column in df.columns]
+        keys = rowKeys(df, KEY)
+        labels.append(day)
+        totals.append(df[VALUES].groupby(keys, sort=False).sum())
+        # the latest description of each key is kept
+        first = ~pd.Index(keys).duplicated()
+        described = df.loc[first, KEY + columns].set_index(keys[first])
+        describe = described if describe is None else pd.concat([described, describe[~describe.index.isin(described.index)]])
+        logging.info("Loaded instance usage for {}, {} rows.".format(day, len(df)))
+    if len(labels) < 2:
+        logging.error("At least two days of instance usage are needed to compare, found {}.".format(labels))
+        quit()
+
+    # one row per key (by hash) and a column per day, keys missing on a day have no usage that day
+    matrix = pd.concat(totals, axis=1, keys=labels).fillna(0)
+    changed = np.zeros((len(matrix), len(labels)), dtype=bool)
+    results = {}
+    for value in VALUES:
+        current = matrix.xs(value, axis=1, level=1).to_numpy(dtype=float)
+        previous = shiftDays(current, 1)
+        results[value] = current
+        results[value + "_prev"] = previous
+        results[value + "_diff"] = current - previous
+        # the window is in calendar days, so a gap in the snapshots leaves it empty rather than comparing further back
+        results["{}_diff_{}d".format(value, window)] = current - shiftCalendarDays(current, labels, window)
+        threshold = costThreshold if value == "cost" else quantityThreshold
+        if threshold != None:
+            with np.errstate(invalid="ignore"):
+                changed |= (np.abs(results[value + "_diff"]) > threshold) | (np.abs(results["{}_diff_{}d".format(value, window)]) > threshold)
+
+    rows, columns = np.nonzero(changed)
+    describe = describe.loc[matrix.index[rows]].reset_index(drop=True)
+    combine_df = describe[KEY].copy()
+    combine_df.insert(0, "day", np.array(labels)[columns])
+    for name, values in results.items():
+        combine_df[name] = values[rows, columns]
+    combine_df = pd.concat([combine_df, describe.drop(columns=KEY)], axis=1)
+    combine_df = combine_df.iloc[np.lexsort((-np.abs(combine_df["cost_diff"].to_numpy()), combine_df["day"].to_numpy()))].reset_index(drop=True)
+    logging.info("{} instance metrics changed beyond the threshold over {} days.".format(len(combine_df), len(labels)))
+    return combine_df
 
+@metrics.timed()
+def addCurrentState(combine_df, resource_cache):
+    """
+    Add the current state and deletion date of each instance from the resource cache
+    """
+    combine_df['current_state'] = combine_df['instance_id'].map(lambda crn: resource_cache.get(crn, {}).get('state', ''))
+    combine_df['current_deleted_at'] = combine_df['instance_id'].map(lambda crn: resource_cache.get(crn, {}).get('deleted_at', ''))
     return combine_df
 
+@metrics.timed()
 def createInstancesDetailTab(combine_df):
     """
     Write detail tab to excel
@@ -62,22 +131,39 @@ def createInstancesDetailTab(combine_df):
 
 
 if __name__ == "__main__":
-    #setup_logging()
+    setup_logging()
     #load_dotenv()
     parser = argparse.ArgumentParser(description="Compare IBM Cloud Daily Usage.")
     parser.add_argument("--output", default=os.environ.get('output', 'compared.xlsx'), help="Filename Excel output file. (including extension of .xlsx)")
-    parser.add_argument("--start", help="Start Month YYYYMMDD.")
-    parser.add_argument("--end", help="End Month YYYYMMDD.")
+    parser.add_argument("--start", help="First day to compare YYYYMMDD.")
+    parser.add_argument("--end", help="Last day to compare YYYYMMDD.")
+    parser.add_argument("--snapshot-dir", default=os.environ.get('snapshot_dir', None), help="Compare the snapshots ibmCloudUsage.py stored in this directory, instead of instanceUsage-YYYYMMDD.pkl files.")
+    parser.add_argument("--window", type=int, default=os.environ.get('window', 7), help="Days for the N day change, alongside the day over day change.")
+    parser.add_argument("--cost-threshold", type=float, default=os.environ.get('cost_threshold', 1.0), help="Report instance metrics whose cost changed by more than this.")
+    parser.add_argument("--quantity-threshold", type=float, default=os.environ.get('quantity_threshold', None), help="Also report instance metrics whose quantity changed by more than this.")
+    parser.add_argument("--resource-cache", default=os.environ.get('resource_cache', None), help="Resource cache file kept by ibmCloudUsage.py, adds the current state of each instance.")
+    parser.add_argument("--metrics-out", default=os.environ.get('metrics_out', None), help="Write run metrics (phase timings, rows) to this JSON file.")
+    parser.add_argument("--profile", default=os.environ.get('profile', None), help="Write cProfile stats for the run to this file.")
     args = parser.parse_args()
-    prev_date = args.start
-    curr_date = args.end
-
-    prev_pickle_filename = "instanceUsage-" + prev_date + ".pkl"
-    curr_pickle_filename = "instanceUsage-" + curr_date + ".pkl"
-
-    combine_df = do_compare(prev_pickle_filename, curr_pickle_filename)
+    metrics.enable(args.metrics_out, args.profile)
+
+    if args.snapshot_dir != None:
+        # only the columns compared are read from the memory mapped snapshots
+        days = iterSnapshots(args.snapshot_dir, args.start, args.end, columns=KEY + VALUES + DESCRIBE)
+    else:
+        days = iterPickles(args.start, args.end)
+    combine_df = compareDays(days, args.window, args.cost_threshold, args.quantity_threshold)
+    if args.resource_cache != None:
+        if os.path.exists(args.resource_cache):
+            cache = ResourceCache(args.resource_cache)
+            combine_df = addCurrentState(combine_df, cache.loadResources())
+            cache.close()
+        else:
+            logging.warning("Resource cache {} not found, current instance state not added.".format(args.resource_cache))
+    metrics.addRows("compared", len(combine_df))
 
     writer = pd.ExcelWriter(args.output, engine='xlsxwriter')
     workbook = writer.book
     createInstancesDetailTab(combine_df)
-    writer.close()
+    with metrics.phase("xlsxWriterClose"):
+        writer.close()
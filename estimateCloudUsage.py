@@ -15,49 +15,68 @@
 
 
 __author__ = 'jonhall'
-import os, logging, logging.config, json, os.path, argparse
+import os, logging, logging.config, json, os.path, argparse, time
+import requests
 import pandas as pd
 import numpy as np
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil import tz
 import ibm_boto3
 from ibm_botocore.client import Config, ClientError
-from ibm_platform_services import IamIdentityV1, UsageReportsV4
+from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalCatalogV1
 from ibm_cloud_sdk_core import ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+from logSetup import setup_logging
+from runMetrics import metrics
+from rateLimiter import limiter
+from iamTokenCache import getAuthenticator
+from httpSessions import configureService, POOL_SIZE
+from usageNames import UsageNames
+import pyarrow.feather as feather
 
+historyColumns = ["pulled", "resource_id", "plan_id", "resource_name", "plan_name", "quantity", "cost", "rated_cost"]
 
+# hours after which --watch pulls the usage even if the account summary is unchanged, as quantities can change at no cost
+FULL_PULL_HOURS = 24
 
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
 
-def getAccountId(IC_API_KEY):
-    ##########################################################
-    ## Get Account from the passed API Key
-    ##########################################################
 
-    logging.info("Retrieving IBM Cloud Account ID for this ApiKey.")
+def createSDK(IC_API_KEY, tokenCache=None, poolSize=POOL_SIZE):
+    """
+    Create SDK clients, sharing one authenticator so its IAM token is reused across calls and --watch polls
+    """
+    global iam_identity_service, usage_reports_service, global_catalog_service
+
     try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
+        authenticator = getAuthenticator(IC_API_KEY, tokenCache)
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
+
+    try:
+        iam_identity_service = metrics.instrumentService(configureService(IamIdentityV1(authenticator=authenticator), poolSize), "IamIdentityV1")
+    except ApiException as e:
+        logging.error("API exception {}.".format(str(e)))
+        quit()
+
     try:
-        iam_identity_service = IamIdentityV1(authenticator=authenticator)
+        usage_reports_service = metrics.instrumentService(configureService(UsageReportsV4(authenticator=authenticator), poolSize), "UsageReportsV4")
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
 
+    try:
+        global_catalog_service = metrics.instrumentService(configureService(GlobalCatalogV1(authenticator=authenticator), poolSize), "GlobalCatalogV1")
+    except ApiException as e:
+        logging.error("API exception {}.".format(str(e)))
+        quit()
+
+@metrics.timed()
+def getAccountId(IC_API_KEY):
+    ##########################################################
+    ## Get Account from the passed API Key
+    ##########################################################
+
+    logging.info("Retrieving IBM Cloud Account ID for this ApiKey.")
     try:
         api_key = iam_identity_service.get_api_keys_details(
           iam_api_key=IC_API_KEY
@@ -68,38 +87,25 @@ def getAccountId(IC_API_KEY):
 
     return api_key["account_id"]
 
-def accountUsage(IC_API_KEY, IC_ACCOUNT_ID):
+@metrics.timed()
+def accountUsage(IC_ACCOUNT_ID, names=True, usageNames=None):
     """
     Get paas Usage from account for current month to date
     Note: This usage will bill two months later.  For example April Usage, will invoice on the end of June invoice.
+    If names is False usage is requested without names, and service and plan names are resolved from the global catalog
+    with usageNames, which keeps the names already resolved between --watch polls.
     """
     now = datetime.now()
     usageMonth = now.strftime("%Y-%m")
     usageTime = now.strftime("%Y-%m %H:%M")
 
-    try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        error = ("API exception {}.".format(str(e)))
-        return accountUsage, error
-    try:
-        usage_reports_service = UsageReportsV4(authenticator=authenticator)
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        error = ("API exception {}.".format(str(e)))
-        return accountUsage, error
-
     logging.info("Retrieving PaaS Usage from {}.".format(usageMonth))
-    try:
-        usage = usage_reports_service.get_account_usage(
-            account_id=IC_ACCOUNT_ID,
-            billingmonth=usageMonth,
-            names=True
-        ).get_result()
-    except ApiException as e:
-        logging.error("API exception {}.".format(str(e)))
-        quit()
+    # API errors are raised to the caller, which quits or with --watch skips the poll
+    usage = usage_reports_service.get_account_usage(
+        account_id=IC_ACCOUNT_ID,
+        billingmonth=usageMonth,
+        names=names
+    ).get_result()
 
     data = []
     for resource in usage['resources']:
@@ -111,11 +117,11 @@ def accountUsage(IC_API_KEY, IC_ACCOUNT_ID):
                     'currency_code': usage['currency_code'],
                     'billing_country': usage['billing_country'],
                     'resource_id': resource['resource_id'],
-                    'resource_name': resource['resource_name'],
+                    'resource_name': resource.get('resource_name', ""),
                     'billable_charges': resource["billable_cost"],
                     'billable_rated_charges': resource["billable_rated_cost"],
                     'plan_id': plan['plan_id'],
-                    'plan_name': plan['plan_name'],
+                    'plan_name': plan.get('plan_name', ""),
                     'metric': metric['metric'],
                     'unit_name': metric['unit_name'],
                     'quantity': metric['quantity'],
@@ -147,9 +153,110 @@ def accountUsage(IC_API_KEY, IC_ACCOUNT_ID):
                     'cost',
                     'rated_cost',
                     'discount'])
+    metrics.addRows("accountUsage", len(accountUsage))
+
+    if not names:
+        if usageNames is None:
+            usageNames = UsageNames(global_catalog_service)
+        usageNames.fillCatalogNames(accountUsage, {"resource_name": "resource_id", "plan_name": "plan_id"})
 
     return accountUsage
 
+@metrics.timed()
+def accountSummary(IC_ACCOUNT_ID, usageMonth):
+    """
+    Return the month to date billable and non billable cost of the account, in total and per resource, from the
+    account summary.  A much smaller response than the usage, used by --watch to tell whether the usage changed.
+    """
+    summary = usage_reports_service.get_account_summary(account_id=IC_ACCOUNT_ID, billingmonth=usageMonth).get_result()
+    resources = sorted((resource["resource_id"], resource.get("billable_cost"), resource.get("non_billable_cost"))
+                       for resource in summary.get("account_resources") or [])
+    return usageMonth, summary["resources"]["billable_cost"], summary["resources"]["non_billable_cost"], tuple(resources)
+
+def historyPath(historyDir, usageMonth):
+    return os.path.join(historyDir, "paasUsage-{}.feather".format(usageMonth))
+
+def loadHistory(historyDir, usageMonth):
+    """
+    Return the pulls of a month saved in historyDir, or an empty frame if there are none
+    """
+    path = historyPath(historyDir, usageMonth)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=historyColumns)
+    return feather.read_feather(path)
+
+def summarizePull(paasUsage, pulled):
+    """
+    Return a pull of month to date usage as one row per resource and plan
+    """
+    pull = paasUsage.groupby(["resource_id", "plan_id"], sort=False).agg(
+        resource_name=("resource_name", "first"), plan_name=("plan_name", "first"),
+        quantity=("quantity", "sum"), cost=("cost", "sum"), rated_cost=("rated_cost", "sum")).reset_index()
+    pull.insert(0, "pulled", pd.Timestamp(pulled))
+    return pull[historyColumns]
+
+def addPull(history, paasUsage, pulled):
+    """
+    Return the month's time series with a pull of month to date usage added, unless its cost and quantity are the
+    same as the previous pull's.  A series of an earlier month is started again.
+    """
+    if history is None or len(history) > 0 and pd.Timestamp(history["pulled"].max()).strftime("%Y-%m") != pulled.strftime("%Y-%m"):
+        history = pd.DataFrame(columns=historyColumns)
+    pull = summarizePull(paasUsage, pulled)
+    if len(history) > 0:
+        previous = history[history["pulled"] == history["pulled"].max()]
+        keys = ["resource_id", "plan_id", "quantity", "cost"]
+        if len(previous) == len(pull) and previous[keys].merge(pull[keys], how="inner").shape[0] == len(pull):
+            logging.info("PaaS usage unchanged since {}, pull not added to history.".format(previous["pulled"].iloc[0]))
+            return history
+    return pd.concat([history, pull], ignore_index=True)
+
+def saveHistory(historyDir, paasUsage, pulled):
+    """
+    Add a pull of month to date usage to the month's time series in historyDir, returning the series
+    """
+    usageMonth = pulled.strftime("%Y-%m")
+    history = loadHistory(historyDir, usageMonth)
+    updated = addPull(history, paasUsage, pulled)
+    if updated is history:
+        return history
+    history = updated
+    os.makedirs(historyDir, exist_ok=True)
+    feather.write_feather(history, historyPath(historyDir, usageMonth))
+    logging.info("Saved PaaS usage pull {} of {} to {}.".format(history["pulled"].nunique(), usageMonth, historyPath(historyDir, usageMonth)))
+    return history
+
+@metrics.timed()
+def projectMonthEnd(history):
+    """
+    Project the month end cost of each resource and plan from the month's pulls.  With two or more pulls the cost is
+    extended along a least squares fit of cost against time, otherwise at its run rate since the start of the month.
+    The projection is never lower than the cost to date.
+    """
+    pulled = pd.to_datetime(history["pulled"])
+    monthStart = pulled.min().to_period("M").start_time
+    monthEnd = pulled.min().to_period("M").end_time
+    hours = (monthEnd - monthStart).total_seconds() / 3600
+    series = history.assign(t=((pulled - monthStart).dt.total_seconds() / 3600).to_numpy())
+    series["tc"] = series["t"] * series["cost"]
+    series["tt"] = series["t"] * series["t"]
+    groups = series.groupby(["resource_id", "plan_id"], sort=False)
+    fit = groups.agg(resource_name=("resource_name", "last"), plan_name=("plan_name", "last"), pulls=("t", "size"),
+                     t=("t", "mean"), c=("cost", "mean"), tc=("tc", "mean"), tt=("tt", "mean"), latest=("t", "max"))
+    last = series.loc[groups["t"].idxmax()].set_index(["resource_id", "plan_id"])
+    fit["cost"] = last["cost"]
+    fit["rated_cost"] = last["rated_cost"]
+    variance = fit["tt"] - fit["t"] * fit["t"]
+    slope = ((fit["tc"] - fit["t"] * fit["c"]) / variance.where(variance > 1e-9)).clip(lower=0)
+    runRate = fit["cost"] / fit["latest"].clip(lower=1)
+    fit["method"] = np.where(slope.notna(), "trend", "run rate")
+    fit["hourly_rate"] = slope.fillna(runRate)
+    fit["projected_cost"] = fit["cost"] + fit["hourly_rate"] * (hours - fit["latest"]).clip(lower=0)
+    projection = fit.reset_index()[["resource_name", "plan_name", "resource_id", "plan_id", "pulls", "method", "cost", "hourly_rate", "projected_cost"]]
+    metrics.addRows("projection", len(projection))
+    return projection.sort_values("projected_cost", ascending=False, ignore_index=True)
+
+@metrics.timed()
 def createDetailTab(paasUsage):
     """
     Write detail tab to excel
@@ -169,6 +276,7 @@ def createDetailTab(paasUsage):
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
 
+@metrics.timed()
 def createSummaryPivot(paasUsage):
     paasSummary = pd.pivot_table(paasUsage, index=["resource_name"],
                                     values=["cost"],
@@ -181,6 +289,7 @@ def createSummaryPivot(paasUsage):
     worksheet.set_column("A:A", 35, format2)
     worksheet.set_column("B:ZZ", 18, format1)
 
+@metrics.timed()
 def createPlanPivot(paasUsage):
     paasSummaryPlan = pd.pivot_table(paasUsage, index=["resource_name", "plan_name", "metric", "unit_name"],
                                  values=["quantity", "cost"],
@@ -202,30 +311,110 @@ def createPlanPivot(paasUsage):
 
     return
 
+@metrics.timed()
+def createProjectionTab(projection):
+    """
+    Write month end projection tab to excel
+    """
+    logging.info("Creating projection tab.")
+    projection = projection.copy()
+    projection.loc[len(projection)] = {"resource_name": "Total", "cost": projection["cost"].sum(), "hourly_rate": projection["hourly_rate"].sum(),
+                                       "projected_cost": projection["projected_cost"].sum()}
+    projection.to_excel(writer, "Projection", index=False)
+    worksheet = writer.sheets['Projection']
+    format1 = workbook.add_format({'num_format': '$#,##0.00'})
+    format2 = workbook.add_format({'align': 'left'})
+    format3 = workbook.add_format({'num_format': '$#,##0.0000'})
+    worksheet.set_column("A:D", 30, format2)
+    worksheet.set_column("E:F", 12, format2)
+    worksheet.set_column("G:G", 18, format1)
+    worksheet.set_column("H:H", 18, format3)
+    worksheet.set_column("I:I", 18, format1)
+    return
+
 if __name__ == "__main__":
     setup_logging()
     parser = argparse.ArgumentParser(description="Estimate PaaS Usage.")
     parser.add_argument("-k", "--IC_API_KEY", default=os.environ.get('IC_API_KEY', None), metavar="apikey", help="IBM Cloud API Key")
     parser.add_argument("--output", default=os.environ.get('output','paasEstimate.xlsx'), help="Filename Excel output file. (including extension of .xlsx)")
+    parser.add_argument("--token-cache", default=os.environ.get('token_cache', None), help="File to keep the IAM token in between runs (created readable by the owner only).")
+    parser.add_argument("--names", default=True, action=argparse.BooleanOptionalAction, help="Request names with usage, --no-names resolves service and plan names from the global catalog.")
+    parser.add_argument("--history-dir", default=os.environ.get('history_dir', None), help="Directory to keep each pull of the month's usage in, for the month end projection.")
+    parser.add_argument("--budget", type=float, default=os.environ.get('budget', None), help="Warn when the projected month end cost exceeds this amount.")
+    parser.add_argument("--watch", default=False, action=argparse.BooleanOptionalAction, help="Keep polling usage every --interval seconds, rewriting the output when usage changes.")
+    parser.add_argument("--interval", type=int, default=os.environ.get('interval', 3600), help="Seconds between polls with --watch.")
+    parser.add_argument("--rate-limits", default=os.environ.get('rate_limits', None), help="API calls per second by family, ie SoftLayer=10,UsageReportsV4=20 (default unlimited, slowed automatically when throttled).")
+    parser.add_argument("--metrics-out", default=os.environ.get('metrics_out', None), help="Write run metrics (phase timings, API latency, rows) to this JSON file.")
+    parser.add_argument("--profile", default=os.environ.get('profile', None), help="Write cProfile stats for the run to this file.")
     args = parser.parse_args()
+    metrics.enable(args.metrics_out, args.profile)
+    limiter.configure(args.rate_limits)
 
     if args.IC_API_KEY == None:
-        if args.username == None or args.password == None or args.account == None:
-            logging.error("You must provide IBM Cloud ApiKey with view access to usage reporting.")
-            quit()
+        logging.error("You must provide IBM Cloud ApiKey with view access to usage reporting.")
+        quit()
     else:
         logging.info("Using IBM Cloud Account API Key.")
         IC_API_KEY = args.IC_API_KEY
-        ims_account = None
 
-    paasUsage = accountUsage(IC_API_KEY, getAccountId(IC_API_KEY))
+    # one authenticated client for the run, its token is refreshed as needed between --watch polls
+    createSDK(IC_API_KEY, args.token_cache)
+    accountId = getAccountId(IC_API_KEY)
+    usageNames = UsageNames(global_catalog_service) if not args.names else None
+    previous = None
+    previousSummary = None
+    lastPull = None
+    # the month's pulls, kept between --watch polls when there is no --history-dir
+    history = None
+    while True:
+        pulled = datetime.now()
+        paasUsage = None
+        try:
+            # with --watch the usage is only pulled again when the account summary shows it changed
+            summary = accountSummary(accountId, pulled.strftime("%Y-%m")) if args.watch else None
+            if summary != None and summary == previousSummary and pulled - lastPull < timedelta(hours=FULL_PULL_HOURS):
+                logging.info("PaaS account summary unchanged since the last poll.")
+            else:
+                paasUsage = accountUsage(accountId, args.names, usageNames)
+                previousSummary = summary
+                lastPull = pulled
+        except (ApiException, requests.exceptions.RequestException) as e:
+            logging.error("API exception {}.".format(str(e)))
+            if not args.watch:
+                quit()
+            logging.warning("Poll skipped, polling again in {} seconds.".format(args.interval))
+
+        # a skipped or unchanged poll leaves the output as it is
+        current = paasUsage.drop(columns="usageTime") if paasUsage is not None else None
+        if current is not None and previous is not None and current.equals(previous):
+            logging.info("PaaS usage unchanged since the last poll.")
+        elif current is not None:
+            previous = current
+            if args.history_dir != None:
+                history = saveHistory(args.history_dir, paasUsage, pulled)
+            else:
+                history = addPull(history, paasUsage, pulled)
+            projection = projectMonthEnd(history)
+            projected = projection["projected_cost"].sum()
+            logging.info("PaaS cost to date {:,.2f}, projected month end {:,.2f}.".format(projection["cost"].sum(), projected))
+            if args.budget != None and projected > args.budget:
+                logging.warning("Projected month end cost {:,.2f} exceeds the budget of {:,.2f}.".format(projected, args.budget))
 
-    # Write dataframe to excel
-    writer = pd.ExcelWriter(args.output, engine='xlsxwriter')
-    workbook = writer.book
-    createDetailTab(paasUsage)
-    createSummaryPivot(paasUsage)
-    createPlanPivot(paasUsage)
-    writer.save()
+            # Write dataframe to excel
+            writer = pd.ExcelWriter(args.output, engine='xlsxwriter')
+            workbook = writer.book
+            createDetailTab(paasUsage)
+            createSummaryPivot(paasUsage)
+            createPlanPivot(paasUsage)
+            createProjectionTab(projection)
+            with metrics.phase("xlsxWriterClose"):
+                writer.close()
+            logging.info("PaaS Estimate is complete.")
 
-    logging.info("PaaS Estimate is complete.")
\ No newline at end of file
+        if not args.watch:
+            break
+        try:
+            time.sleep(args.interval)
+        except KeyboardInterrupt:
+            logging.info("Watch stopped.")
+            break
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Hedged SoftLayer calls for the slow, paged reads which set the runtime of a report.
+
+A few getInvoiceTopLevelItems and Account::getHardware pages with large object masks take many times the median
+latency.  With --hedge, a call to one of HEDGED_METHODS which has not returned within the PERCENTILE latency seen so
+far for its method is sent again, and whichever copy answers first is used.  Only these read only methods are
+hedged, as both copies reach the API.  Hedges are limited to --hedge-budget of the calls made, are not sent until
+MIN_SAMPLES calls give a latency to go on, and are not sent while the SoftLayer rate limiter is slowed down after
+being throttled.  How often the hedge won, and the seconds it saved, are in the hedging section of the run metrics.
+"""
+
+import copy, logging, threading, time
+from concurrent.futures import Future, wait, FIRST_COMPLETED
+from runMetrics import metrics
+from rateLimiter import limiter
+
+# idempotent reads which may be sent twice
+HEDGED_METHODS = ["SoftLayer_Billing_Invoice::getInvoiceTopLevelItems", "SoftLayer_Account::getHardware"]
+
+# latency percentile of the method after which a hedge is sent, below the share of pages in the slow tail
+PERCENTILE = 90
+
+# calls of a method timed before it is hedged
+MIN_SAMPLES = 5
+
+# seconds waited at least before a hedge is sent
+MIN_DEADLINE = 1.0
+
+# hedges sent as a fraction of hedged method calls
+BUDGET = 0.1
+
+
+def runAttempt(fn, *args):
+    """
+    Start fn(*args) on a daemon thread (a losing attempt left running does not hold up the end of the run), returning
+    a Future of its result
+    """
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+class Hedger(object):
+    """
+    Deadlines and the hedge budget for hedged methods
+    """
+
+    def __init__(self, percentile=PERCENTILE, budget=BUDGET):
+        self.lock = threading.Lock()
+        self.percentile = percentile
+        self.budget = budget
+        self.calls = 0
+        self.hedges = 0
+
+    def configure(self, percentile=PERCENTILE, budget=BUDGET):
+        self.percentile = percentile
+        self.budget = budget
+        logging.info("Hedging {} after p{} latency, for up to {:.0%} of calls.".format(", ".join(HEDGED_METHODS), percentile, budget))
+
+    def deadline(self, method):
+        """
+        Return the seconds to wait for a call to method before hedging it, None if it is not to be hedged
+        """
+        if metrics.callCount("SoftLayer", method) < MIN_SAMPLES:
+            return None
+        return max(MIN_DEADLINE, metrics.latencyPercentile("SoftLayer", method, self.percentile))
+
+    def allowHedge(self):
+        """
+        Take a hedge from the budget, False if the budget is spent or the SoftLayer API is throttling calls
+        """
+        bucket = limiter.bucket("SoftLayer")
+        if bucket.rate != None and bucket.ceiling != None and bucket.rate < bucket.ceiling:
+            return False
+        with self.lock:
+            if self.hedges + 1 > self.calls * self.budget:
+                return False
+            self.hedges += 1
+            return True
+
+    def call(self, method, fn, request):
+        """
+        Call fn(request), sending a copy of the request if it runs past the method's deadline, and return the first
+        answer
+        """
+        with self.lock:
+            self.calls += 1
+        deadline = self.deadline(method)
+        primary = runAttempt(fn, request)
+        if deadline is None:
+            return primary.result()
+        done, _ = wait([primary], timeout=deadline)
+        if done or not self.allowHedge():
+            return primary.result()
+
+        logging.debug("{} has not returned after {:.1f}s, hedging.".format(method, deadline))
+        hedge = runAttempt(fn, duplicateRequest(request))
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((future for future in done if future.exception() is None), None)
+            if winner is not None:
+                break
+        if winner is None:
+            # both copies failed, the original call's error is raised
+            metrics.recordHedge(method, "failed")
+            return primary.result()
+        if winner is primary:
+            metrics.recordHedge(method, "primary")
+            return primary.result()
+
+        won = time.perf_counter()
+
+        def primaryDone(future):
+            # the seconds saved are known once the original call returns
+            metrics.recordHedge(method, "hedge", time.perf_counter() - won)
+        primary.add_done_callback(primaryDone)
+        return hedge.result()
+
+
+def duplicateRequest(request):
+    """
+    Return a copy of a SoftLayer transport Request, with its own headers as the transports add to them
+    """
+    duplicate = copy.copy(request)
+    duplicate.headers = dict(request.headers)
+    duplicate.transport_headers = dict(request.transport_headers)
+    return duplicate
+
+
+class HedgedTransport(object):
+    """
+    SoftLayer transport wrapper which hedges calls to HEDGED_METHODS
+    """
+
+    def __init__(self, transport, hedger):
+        self.transport = transport
+        self.hedger = hedger
+
+    def __call__(self, call):
+        method = "{}::{}".format(call.service, call.method)
+        if method not in HEDGED_METHODS:
+            return self.transport(call)
+        return self.hedger.call(method, self.transport, call)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+def hedgeSoftLayer(client):
+    """
+    Replace the transport of a SoftLayer client with one that hedges slow reads.  Call after
+    metrics.instrumentSoftLayer so each copy's latency is timed.
+    """
+    if not isinstance(client.transport, HedgedTransport):
+        client.transport = HedgedTransport(client.transport, hedger)
+    return client
+
+
+# process wide hedge budget shared by all clients of a run
+hedger = Hedger()
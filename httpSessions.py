@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Shared HTTP session for the IBM Cloud SDK clients.
+
+Each SDK client otherwise creates its own requests Session, with a pool of 10 keep-alive connections and no retries.
+configureService() points a client at one process wide session whose pool is sized to the run's concurrency, sets
+connect and read timeouts, and retries connection errors and 5xx responses with exponential backoff.  Each retry is
+counted in the run metrics as httpRetries.  Calls are made within the rate limit of the client's API family, and 429
+responses are retried by the rate limiter (rateLimiter.py), which slows the whole family down.
+"""
+
+import logging, threading
+import requests
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+from ibm_cloud_sdk_core.http_adapter import SSLHTTPAdapter
+from runMetrics import metrics
+from rateLimiter import limiter
+
+# keep-alive connections kept per host, requests beyond this wait for a free connection
+POOL_SIZE = 32
+
+# seconds to connect and to wait for a response
+TIMEOUT = (10, 120)
+
+RETRIES = 4
+
+# seconds, doubled for each retry up to BACKOFF_MAX
+BACKOFF = 0.5
+BACKOFF_MAX = 30
+
+# 429 is left to the rate limiter
+RETRY_STATUS = [500, 502, 503, 504]
+
+# request header naming the API family of an SDK client, removed by the adapter before the request is sent.  Clients
+# can share a host (ResourceControllerV2 and ResourceManagerV2), so the family is not taken from the host.
+FAMILY_HEADER = "X-Rate-Limit-Family"
+
+sessions = {}
+sessionsLock = threading.Lock()
+
+
+class CountedRetry(Retry):
+    """
+    Retry policy which counts each retry in the run metrics, leaving 429 to the rate limiter
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # throttled calls are retried by the rate limiter, so the whole API family slows down
+        if status_code == 429:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_backoff_time(self):
+        # capped here rather than by backoff_max, which urllib3 before 2.0 does not take
+        return min(BACKOFF_MAX, super().get_backoff_time())
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        metrics.addRows("httpRetries", 1)
+        logging.debug("Retrying {} {} ({}).".format(method, url, response.status if response is not None else error))
+        return retry
+
+
+def retryAfter(response):
+    """
+    Return the seconds of a response's Retry-After header, or None
+    """
+    value = response.headers.get("Retry-After") if hasattr(response, "headers") else None
+    try:
+        return float(value) if value != None else None
+    except ValueError:
+        return None
+
+def isThrottled(response):
+    if getattr(response, "status_code", None) != 429:
+        return False
+    # read the body so the connection goes back to the pool when the response is closed
+    response.content
+    return True
+
+
+class LimitedHTTPAdapter(SSLHTTPAdapter):
+    """
+    HTTP adapter which makes each request within the rate limit of its API family (the client's name, or the host of
+    requests from elsewhere)
+    """
+
+    def send(self, request, **kwargs):
+        family = request.headers.pop(FAMILY_HEADER, None) or urlparse(request.url).netloc
+        return limiter.call(family, lambda: super(LimitedHTTPAdapter, self).send(request, **kwargs), isThrottled, retryAfter)
+
+
+def createSession(poolSize=POOL_SIZE, retries=RETRIES, backoff=BACKOFF):
+    """
+    Return a requests Session with a keep-alive pool of poolSize connections per host, retrying 5xx and connection
+    errors (429 is retried by the rate limiter)
+    """
+    # the usage API reads are safe to repeat, including the global search POST, so all methods are retried
+    retry = CountedRetry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUS,
+                         allowed_methods=None, respect_retry_after_header=True, raise_on_status=False)
+    adapter = LimitedHTTPAdapter(pool_connections=16, pool_maxsize=poolSize, max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def getSession(poolSize=POOL_SIZE):
+    """
+    Return the process wide session for a pool size
+    """
+    with sessionsLock:
+        if poolSize not in sessions:
+            sessions[poolSize] = createSession(poolSize)
+        return sessions[poolSize]
+
+def configureService(service, poolSize=POOL_SIZE, timeout=TIMEOUT):
+    """
+    Point an IBM Cloud SDK client at the shared session, with timeouts.  Call before metrics.instrumentService so
+    its hooks are added to the shared session.
+    """
+    service.set_default_headers(dict(service.default_headers or {}, **{FAMILY_HEADER: type(service).__name__}))
+    service.set_http_client(getSession(poolSize))
+    service.set_http_config({"timeout": timeout})
+    return service
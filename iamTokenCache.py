@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+IAM bearer token cache shared by the IBM Cloud SDK clients of a run, and optionally between runs.
+
+getAuthenticator() returns one authenticator per API key for the process, so every client (UsageReportsV4,
+ResourceControllerV2, GlobalSearchV2, GlobalTaggingV1, IamIdentityV1, ...) uses the same token.  With --token-cache
+(or the token_cache environment variable) the token and its expiry are also kept in a file readable only by the
+owner, keyed by a hash of the API key, so scheduled runs reuse a token until it is near expiry instead of requesting
+one at every start.  Tokens are refreshed REFRESH_AHEAD seconds before they expire, or earlier if the SDK would.
+"""
+
+import hashlib, json, logging, os, stat, threading, time
+from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+from ibm_cloud_sdk_core.token_managers.iam_token_manager import IAMTokenManager
+
+# seconds before expiry a token is refreshed, and the least time left for a cached token to be used
+REFRESH_AHEAD = 600
+
+authenticators = {}
+authenticatorsLock = threading.Lock()
+
+
+class CachedIAMTokenManager(IAMTokenManager):
+    """
+    IAM token manager which loads its token from, and saves new tokens to, a cache file
+    """
+
+    def __init__(self, apikey, cachePath=None, **kwargs):
+        super().__init__(apikey, **kwargs)
+        self.cachePath = cachePath
+        self.cacheKey = hashlib.sha256("{} {}".format(self.url, apikey).encode()).hexdigest()
+        self.cacheLock = threading.Lock()
+        self.loadToken()
+
+    def readCache(self):
+        """
+        Return the cache file's tokens, or {} if there is none.  A file others can read or write is not trusted.
+        """
+        if self.cachePath == None or not os.path.exists(self.cachePath):
+            return {}
+        if os.name == "posix" and os.stat(self.cachePath).st_mode & (stat.S_IRWXG | stat.S_IRWXO):
+            logging.warning("IAM token cache {} is accessible to other users and is ignored.".format(self.cachePath))
+            return {}
+        try:
+            with open(self.cachePath) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("IAM token cache {} could not be read: {}.".format(self.cachePath, e))
+            return {}
+
+    def loadToken(self):
+        """
+        Use the cached token for this API key if it has more than REFRESH_AHEAD seconds left
+        """
+        with self.cacheLock:
+            cached = self.readCache().get(self.cacheKey)
+            if cached == None or cached["expire_time"] <= max(self.expire_time, time.time() + REFRESH_AHEAD):
+                return False
+            self.access_token = cached["access_token"]
+            self.expire_time = cached["expire_time"]
+            self.refresh_time = cached["refresh_time"]
+            logging.debug("Using cached IAM token, expires {}.".format(time.ctime(self.expire_time)))
+            return True
+
+    def _save_token_info(self, token_response):
+        super()._save_token_info(token_response)
+        self.refresh_time = min(self.refresh_time, self.expire_time - REFRESH_AHEAD)
+        if self.cachePath == None:
+            return
+        with self.cacheLock:
+            tokens = self.readCache()
+            now = time.time()
+            tokens = {key: token for key, token in tokens.items() if token["expire_time"] > now}
+            tokens[self.cacheKey] = {"access_token": self.access_token, "expire_time": self.expire_time, "refresh_time": self.refresh_time}
+            # written to a file created owner only, then renamed over the cache so readers never see part of it
+            temporary = "{}.{}".format(self.cachePath, os.getpid())
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump(tokens, f)
+            os.replace(temporary, self.cachePath)
+
+    def get_token(self):
+        # another process may already have refreshed the token
+        if self.cachePath != None and self.refresh_time < time.time():
+            self.loadToken()
+        return super().get_token()
+
+
+def getAuthenticator(apikey, cachePath=None):
+    """
+    Return the process wide IAM authenticator for an API key, caching its token in cachePath if given
+    """
+    with authenticatorsLock:
+        if apikey not in authenticators:
+            authenticator = IAMAuthenticator(apikey)
+            authenticator.token_manager = CachedIAMTokenManager(apikey, cachePath)
+            authenticators[apikey] = authenticator
+        return authenticators[apikey]
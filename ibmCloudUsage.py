@@ -16,7 +16,8 @@
 
 
 __author__ = 'jonhall'
-import os, logging, logging.config, json, os.path, argparse, calendar, time
+import os, re, logging, logging.config, json, os.path, argparse, calendar, time, threading, queue
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 from datetime import datetime
@@ -24,24 +25,18 @@ from dateutil.relativedelta import *
 from dateutil import tz
 import ibm_boto3
 from ibm_botocore.client import Config, ClientError
-from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalTaggingV1, GlobalSearchV2
+from ibm_platform_services import IamIdentityV1, UsageReportsV4, GlobalTaggingV1, GlobalSearchV2, GlobalCatalogV1, ResourceManagerV2
 from ibm_platform_services.resource_controller_v2 import *
 from ibm_cloud_sdk_core import ApiException
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
 from dotenv import load_dotenv
-
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
+from logSetup import setup_logging
+from runMetrics import metrics, ProgressReporter
+from rateLimiter import limiter
+from resourceCache import ResourceCache
+from usageNames import UsageNames
+from usageSnapshots import saveSnapshot
+from iamTokenCache import getAuthenticator
+from httpSessions import configureService, POOL_SIZE
 
 def getAccountId(IC_API_KEY):
     ##########################################################
@@ -58,83 +53,113 @@ def getAccountId(IC_API_KEY):
 
     return api_key["account_id"]
 
-def createSDK(IC_API_KEY):
+def createSDK(IC_API_KEY, tokenCache=None, poolSize=POOL_SIZE):
     """
        Create SDK clients
        """
-    global usage_reports_service, resource_controller_service, global_tagging_service, iam_identity_service, global_search_service
+    global usage_reports_service, resource_controller_service, global_tagging_service, iam_identity_service, global_search_service, \
+        global_catalog_service, resource_manager_service
 
     try:
-        authenticator = IAMAuthenticator(IC_API_KEY)
+        authenticator = getAuthenticator(IC_API_KEY, tokenCache)
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
 
     try:
-        iam_identity_service = IamIdentityV1(authenticator=authenticator)
+        iam_identity_service = metrics.instrumentService(configureService(IamIdentityV1(authenticator=authenticator), poolSize), "IamIdentityV1")
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
 
     try:
-        usage_reports_service = UsageReportsV4(authenticator=authenticator)
+        usage_reports_service = metrics.instrumentService(configureService(UsageReportsV4(authenticator=authenticator), poolSize), "UsageReportsV4")
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
 
     try:
-        resource_controller_service = ResourceControllerV2(authenticator=authenticator)
+        resource_controller_service = metrics.instrumentService(configureService(ResourceControllerV2(authenticator=authenticator), poolSize), "ResourceControllerV2")
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
 
     try:
-        global_tagging_service = GlobalTaggingV1(authenticator=authenticator)
+        global_tagging_service = metrics.instrumentService(configureService(GlobalTaggingV1(authenticator=authenticator), poolSize), "GlobalTaggingV1")
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
 
     try:
-        global_search_service = GlobalSearchV2(authenticator=authenticator)
+        global_search_service = metrics.instrumentService(configureService(GlobalSearchV2(authenticator=authenticator), poolSize), "GlobalSearchV2")
     except ApiException as e:
         logging.error("API exception {}.".format(str(e)))
         quit()
-def prePopulateTagCache():
+
+    try:
+        global_catalog_service = metrics.instrumentService(configureService(GlobalCatalogV1(authenticator=authenticator), poolSize), "GlobalCatalogV1")
+    except ApiException as e:
+        logging.error("API exception {}.".format(str(e)))
+        quit()
+
+    try:
+        resource_manager_service = metrics.instrumentService(configureService(ResourceManagerV2(authenticator=authenticator), poolSize), "ResourceManagerV2")
+    except ApiException as e:
+        logging.error("API exception {}.".format(str(e)))
+        quit()
+def searchResources(query, fields):
     """
-    Pre Populate Tagging data into cache
+    Yield the resources matching a global search query, reading one page of up to 1000 at a time
     """
-    logging.info("Tag Cache being pre-populated with tags.")
     search_cursor = None
-    items = []
     while True:
-        response = global_search_service.search(query='tags:*',
+        response = global_search_service.search(query=query,
                                                 search_cursor=search_cursor,
-                                                fields=["tags"],
+                                                fields=fields,
                                                 limit=1000)
         scan_result = response.get_result()
 
-        items = items + scan_result["items"]
-        if "search_cursor" not in scan_result:
+        yield from scan_result["items"]
+        if "search_cursor" not in scan_result or len(scan_result["items"]) == 0:
             break
         else:
             search_cursor = scan_result["search_cursor"]
 
+@metrics.timed()
+def prePopulateTagCache():
+    """
+    Pre Populate Tagging data into cache
+    """
+    logging.info("Tag Cache being pre-populated with tags.")
     tag_cache = {}
-    for resource in items:
-        resourceId = resource["crn"]
-
-        tag_cache[resourceId] = resource["tags"]
+    for resource in searchResources('tags:*', ["tags"]):
+        tag_cache[resource["crn"]] = resource["tags"]
 
     return tag_cache
-def prePopulateResourceCache():
+
+def getResourceTags(resourceIds):
+    """
+    Return the tags of a batch of resources from a single search query, resources without tags map to []
+    """
+    tags = {resourceId: [] for resourceId in resourceIds}
+    query = " OR ".join('crn:"{}"'.format(resourceId) for resourceId in resourceIds)
+    for resource in searchResources(query, ["crn", "tags"]):
+        tags[resource["crn"]] = resource.get("tags", [])
+    metrics.addRows("tagSearchBatches", 1)
+    return tags
+@metrics.timed()
+def prePopulateResourceCache(updated_from=None, state=None):
     """
     Retrieve all Resources for account from resource controller and pre-populate cache
+    updated_from and state restrict the list to instances updated since a date, or in a state other than active.
     """
     logging.info("Resource_cache being pre-populated with active resources in account.")
     all_results = []
     pager = ResourceInstancesPager(
         client=resource_controller_service,
-        limit=50
+        limit=100,
+        updated_from=updated_from,
+        state=state
     )
 
     try:
@@ -142,11 +167,10 @@ def prePopulateResourceCache():
             next_page = pager.get_next()
             assert next_page is not None
             all_results.extend(next_page)
-        logging.debug("resource_instance={}".format(all_results))
+        logging.debug("resource_instance=%s", all_results)
     except ApiException as e:
         logging.error(
-            "API Error.  Can not retrieve instances of type {} {}: {}".format(resource_type, str(e.code),
-                                                                              e.message))
+            "API Error.  Can not retrieve resource instances {}: {}".format(str(e.code), e.message))
         quit()
 
     resource_cache = {}
@@ -155,77 +179,357 @@ def prePopulateResourceCache():
         resource_cache[resourceId] = resource
 
     return resource_cache
-def getAccountUsage(start, end):
+def loadResourceCache(cache=None):
+    """
+    Populate the resource cache, refreshing the persistent cache file if one is used
+    """
+    global resource_cache
+    if cache != None:
+        resource_cache = cache.refreshResources(prePopulateResourceCache)
+    else:
+        resource_cache = prePopulateResourceCache()
+
+def loadTagCache(cache=None):
+    """
+    Populate the tag cache, refreshing the persistent cache file if one is used
+    """
+    global tag_cache
+    if cache != None:
+        tag_cache = cache.refreshTags(prePopulateTagCache)
+    else:
+        tag_cache = prePopulateTagCache()
+
+def getUsageMonths(start, end):
+    """
+    Return the list of usage months (YYYY-MM) from start to end inclusive
+    """
+    months = []
+    while start <= end:
+        months.append(start.strftime("%Y-%m"))
+        start += relativedelta(months=+1)
+    return months
+
+accountColumns = ['account_id', 'month', 'currency_code', 'billing_country', 'resource_id', 'resource_name',
+                  'billable_charges', 'billable_rated_charges', 'plan_id', 'plan_name', 'metric', 'unit_name', 'quantity',
+                  'rateable_quantity','cost', 'rated_cost', 'discount', 'price']
+
+@metrics.timed()
+def getAccountUsage(start, end, workers=1, names=True):
     """
     Get IBM Cloud Service from account for range of months.
     Note: This usage will bill two months later for SLIC.  For example April Usage, will invoice on the end of June CFTS invoice.
+    Up to workers months are retrieved concurrently.  If names is False service and plan names are left empty.
     """
     data = []
-    while start <= end:
-        usageMonth = start.strftime("%Y-%m")
-        logging.info("Retrieving Account Usage from {}.".format(usageMonth))
-        start += relativedelta(months=+1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # merge in month order, months not yet available (424) return no rows
+        for rows in executor.map(lambda usageMonth: getAccountUsageMonth(usageMonth, names), getUsageMonths(start, end)):
+            data.extend(rows)
 
-        try:
-            usage = usage_reports_service.get_account_usage(
-                account_id=accountId,
-                billingmonth=usageMonth,
-                names=True
-            ).get_result()
-        except ApiException as e:
-            if e.code == 424:
-                logging.warning("API exception {}.".format(str(e)))
-                continue
+    accountUsage = pd.DataFrame(data, columns=accountColumns)
+    metrics.addRows("accountUsage", len(accountUsage))
+
+    return accountUsage
+
+def getAccountUsageMonth(usageMonth, names=True):
+    """
+    Get account usage rows for one month
+    """
+    data = []
+    logging.info("Retrieving Account Usage from {}.".format(usageMonth))
+
+    try:
+        usage = usage_reports_service.get_account_usage(
+            account_id=accountId,
+            billingmonth=usageMonth,
+            names=names
+        ).get_result()
+    except ApiException as e:
+        if e.code == 424:
+            logging.warning("API exception {}.".format(str(e)))
+            return data
+        else:
+            logging.error("API exception {}.".format(str(e)))
+            quit()
+
+    logging.debug("usage %s=%s", usageMonth, usage)
+    for resource in usage['resources']:
+        for plan in resource['plans']:
+            for metric in plan['usage']:
+                row = {
+                    'account_id': usage["account_id"],
+                    'month': usageMonth,
+                    'currency_code': usage['currency_code'],
+                    'billing_country': usage['billing_country'],
+                    'resource_id': resource['resource_id'],
+                    'resource_name': resource.get('resource_name', ""),
+                    'billable_charges': resource["billable_cost"],
+                    'billable_rated_charges': resource["billable_rated_cost"],
+                    'plan_id': plan['plan_id'],
+                    'plan_name': plan.get('plan_name', ""),
+                    'metric': metric['metric'],
+                    'unit_name': metric['unit_name'],
+                    'quantity': float(metric['quantity']),
+                    'rateable_quantity': metric['rateable_quantity'],
+                    'cost': metric['cost'],
+                    'rated_cost': metric['rated_cost'],
+                    }
+
+                if len(metric['discounts']) > 0:
+                    row['discount'] = metric['discounts'][0]['discount']
+                else:
+                    discount = 0
+
+                if len(metric['price']) > 0:
+                    row['price'] = metric['price']
+                else:
+                    row['price'] = "[]"
+                # add row to data
+                data.append(row.copy())
+
+    return data
+
+def categorize(df, maxRatio=0.5):
+    """
+    Convert text columns with few distinct values (service, plan, region, month...) to categorical dtypes
+    """
+    for column in df.columns:
+        if df[column].dtype == object and len(df) > 0:
+            try:
+                if df[column].nunique(dropna=False) <= maxRatio * len(df):
+                    df[column] = df[column].astype("category")
+            except TypeError:
+                # unhashable values such as lists are left as objects
+                pass
+    return df
+
+class UsageTables(object):
+    """
+    Normalized instance usage.  instances has one row per instance and month, usage one row per metric keyed by
+    instance_key, and tiers one table per list column (price tiers, discounts) with a row per entry keyed by usage_key.
+    Each entry is kept as its JSON text, so the lists are rebuilt exactly as returned (a list of None is one row with
+    no entry).  The wide view with a row per metric is only built by wide() when a tab needs it.
+    """
+
+    def __init__(self, instances, usage, tiers, columns):
+        self.instances = instances
+        self.usage = usage
+        self.tiers = tiers
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.usage)
+
+    def tierLists(self, column, usageKeys=None):
+        """
+        Rebuild the list of entries of a tier column for each usage row, or for the usage rows in usageKeys
+        """
+        tiers = self.tiers[column]
+        if usageKeys is None:
+            position = range(len(self.usage))
+        else:
+            position = {usageKey: i for i, usageKey in enumerate(usageKeys)}
+            tiers = tiers[tiers["usage_key"].isin(list(position))]
+        lists = [[] for _ in range(len(position))]
+        for usageKey, entry in zip(tiers["usage_key"].tolist(), tiers["entry"].astype(object).tolist()):
+            if entry is None or (isinstance(entry, float) and np.isnan(entry)):
+                lists[position[usageKey]] = None
             else:
-                logging.error("API exception {}.".format(str(e)))
-                quit()
+                lists[position[usageKey]].append(json.loads(entry))
+        return lists
 
-        logging.debug("usage {}={}".format(usageMonth, usage))
-        for resource in usage['resources']:
-            for plan in resource['plans']:
-                for metric in plan['usage']:
-                    row = {
-                        'account_id': usage["account_id"],
-                        'month': usageMonth,
-                        'currency_code': usage['currency_code'],
-                        'billing_country': usage['billing_country'],
-                        'resource_id': resource['resource_id'],
-                        'resource_name': resource['resource_name'],
-                        'billable_charges': resource["billable_cost"],
-                        'billable_rated_charges': resource["billable_rated_cost"],
-                        'plan_id': plan['plan_id'],
-                        'plan_name': plan['plan_name'],
-                        'metric': metric['metric'],
-                        'unit_name': metric['unit_name'],
-                        'quantity': float(metric['quantity']),
-                        'rateable_quantity': metric['rateable_quantity'],
-                        'cost': metric['cost'],
-                        'rated_cost': metric['rated_cost'],
-                        }
-
-                    if len(metric['discounts']) > 0:
-                        row['discount'] = metric['discounts'][0]['discount']
-                    else:
-                        discount = 0
+    def tierText(self, column):
+        """
+        Return the JSON text of the list of entries of a tier column for each usage row, as a category
+        """
+        lists = [[] for _ in range(len(self.usage))]
+        tiers = self.tiers[column]
+        for usageKey, entry in zip(tiers["usage_key"].tolist(), tiers["entry"].astype(object).tolist()):
+            if entry is None or (isinstance(entry, float) and np.isnan(entry)):
+                lists[usageKey] = None
+            else:
+                lists[usageKey].append(entry)
+        return pd.Series(["[" + ", ".join(entries) + "]" if entries is not None else None for entries in lists], dtype="category")
 
-                    if len(metric['price']) > 0:
-                        row['price'] = metric['price']
-                    else:
-                        row['price'] = "[]"
-                    # add row to data
-                    data.append(row.copy())
+    def frame(self, columns=None, tierText=False):
+        """
+        Return columns (default all) with a row per metric, only repeating the instance attributes and building the
+        tier lists asked for.  With tierText tier columns are the JSON text of each list rather than the list.
+        """
+        columns = self.columns if columns is None else columns
+        frame = self.instances[[column for column in columns if column in self.instances.columns]].take(
+            self.usage["instance_key"].to_numpy()).reset_index(drop=True)
+        for column in columns:
+            if column in self.usage.columns:
+                frame[column] = self.usage[column].to_numpy()
+            elif column in self.tiers:
+                frame[column] = self.tierText(column).to_numpy() if tierText else self.tierLists(column)
+        return frame[columns]
+
+    def wide(self):
+        """
+        Return the denormalized DataFrame, instance attributes repeated for each of its metrics
+        """
+        return self.frame()
 
+def usageColumns(instancesUsage, columns=None, tierText=False):
+    """
+    Return columns of instance usage with a row per metric, from UsageTables or the wide DataFrame (--load)
+    """
+    if isinstance(instancesUsage, UsageTables):
+        return instancesUsage.frame(columns, tierText)
+    return instancesUsage if columns is None else instancesUsage[columns]
 
-    accountUsage = pd.DataFrame(data, columns=['account_id', 'month', 'currency_code', 'billing_country', 'resource_id', 'resource_name',
-                    'billable_charges', 'billable_rated_charges', 'plan_id', 'plan_name', 'metric', 'unit_name', 'quantity',
-                    'rateable_quantity','cost', 'rated_cost', 'discount', 'price'])
+class UsageAccumulator(object):
+    """
+    Columnar accumulator for instance usage.  Instance attributes are appended once per instance, metric values
+    once per metric and tier column entries (price tiers, discounts) once per entry, as JSON text.  The tables are
+    built once at the end by toTables().
+    """
 
-    return accountUsage
-def getInstancesUsage(start,end):
+    def __init__(self, instanceColumns, metricColumns, tierColumns=("price", "discount")):
+        self.instanceColumns = instanceColumns
+        self.metricColumns = [column for column in metricColumns if column not in tierColumns]
+        self.tierColumns = list(tierColumns)
+        self.columns = instanceColumns + metricColumns
+        self.instanceValues = {column: [] for column in instanceColumns}
+        self.metricValues = {column: [] for column in self.metricColumns}
+        self.tierValues = {column: [] for column in self.tierColumns}
+        self.tierCounts = {column: [] for column in self.tierColumns}
+        self.metricCounts = []
+
+    def addInstance(self, values):
+        for column in self.instanceColumns:
+            self.instanceValues[column].append(values[column])
+        self.metricCounts.append(0)
+
+    def addMetric(self, values):
+        for column in self.metricColumns:
+            self.metricValues[column].append(values[column])
+        for column in self.tierColumns:
+            entries = [None] if values[column] is None else [json.dumps(entry) for entry in values[column]]
+            self.tierValues[column].extend(entries)
+            self.tierCounts[column].append(len(entries))
+        self.metricCounts[-1] += 1
+
+    def extend(self, other):
+        """
+        Append the rows of another accumulator, ie one month's usage retrieved on another thread
+        """
+        for column in self.instanceColumns:
+            self.instanceValues[column].extend(other.instanceValues[column])
+        for column in self.metricColumns:
+            self.metricValues[column].extend(other.metricValues[column])
+        for column in self.tierColumns:
+            self.tierValues[column].extend(other.tierValues[column])
+            self.tierCounts[column].extend(other.tierCounts[column])
+        self.metricCounts.extend(other.metricCounts)
+
+    def toTables(self):
+        instances = categorize(pd.DataFrame(self.instanceValues, columns=self.instanceColumns))
+        usage = pd.DataFrame(self.metricValues, columns=self.metricColumns)
+        usage.insert(0, "instance_key", np.repeat(np.arange(len(self.metricCounts)), self.metricCounts))
+        usage = categorize(usage)
+        tiers = {}
+        for column in self.tierColumns:
+            entries = pd.DataFrame({"usage_key": np.repeat(np.arange(len(usage)), self.tierCounts[column]),
+                                    "entry": pd.Series(self.tierValues[column], dtype=object)})
+            tiers[column] = categorize(entries)
+        return UsageTables(instances, usage, tiers, self.columns)
+
+instanceColumns = ['account_id', "month", "service_name", "service_id", "instance_name","instance_id", "plan_name", "plan_id", "region", "pricing_region",
+                   "resource_group_name","resource_group_id", "billable", "pricing_country", "billing_country", "currency_code", "pricing_plan_id",
+                   "instance_created_at", "instance_updated_at", "instance_deleted_at", "instance_state", "type", "roks_cluster_id", "roks_cluster_name", "instance_profile", "cpu_family",
+                   "numberOfVirtualCPUs", "MemorySizeMiB", "NodeName", "NumberOfGPUs", "NumberOfInstStorageDisks", "availability_zone",
+                   "instance_role"]
+metricColumns = ["metric", "metric_name", "unit", "unit_name", "quantity", "cost", "rated_cost", "rateable_quantity", "price", "discount"]
+
+# computed over the instance table once all usage is retrieved, rather than for each row
+clusterColumns = ["roks_cluster_id", "roks_cluster_name"]
+rowColumns = [column for column in instanceColumns if column not in clusterColumns]
+
+CLUSTER_PLAN = "containers.kubernetes.cluster.roks"
+WORKER_PLAN = "containers.kubernetes.vpc.gen2.roks"
+
+def addClusterAttribution(instances):
+    """
+    Add the ROKS cluster of each cluster and worker instance to the instance table.  A cluster instance is its own
+    cluster, a worker belongs to the cluster named by its instance name up to the first '_'.
+    """
+    names = instances["instance_name"].astype(object).fillna("")
+    container = (instances["type"] == "container_instance").to_numpy()
+    cluster = container & (instances["plan_id"] == CLUSTER_PLAN).to_numpy()
+    worker = container & (instances["plan_id"] == WORKER_PLAN).to_numpy()
+    clusterId = pd.Series("", index=instances.index, dtype=object)
+    clusterId[cluster] = names[cluster]
+    clusterId[worker] = names[worker].str.extract(r"^([^_]*)", expand=False)
+    instances["roks_cluster_id"] = clusterId.astype("category")
+    instances["roks_cluster_name"] = instances["roks_cluster_id"]
+    return instances
+
+@metrics.timed()
+def clusterRollup(instancesUsage):
+    """
+    Roll up ROKS cluster and worker usage per month, region and cluster: the number of workers, and quantity and
+    cost for each unit
+    """
+    instancesUsage = usageColumns(instancesUsage, ["month", "region", "roks_cluster_id", "instance_id", "plan_id", "unit_name", "quantity", "cost", "rated_cost"])
+    clusters = instancesUsage[(instancesUsage["roks_cluster_id"].astype(object).fillna("") != "").to_numpy()]
+    workerIds = clusters["instance_id"].astype(object).where((clusters["plan_id"] == WORKER_PLAN).to_numpy())
+    rollup = clusters.assign(worker_id=workerIds).groupby(["month", "region", "roks_cluster_id", "unit_name"], observed=True).agg(
+        workers=("worker_id", "nunique"), quantity=("quantity", "sum"), cost=("cost", "sum"), rated_cost=("rated_cost", "sum"))
+    return rollup.reset_index()
+
+@metrics.timed()
+def getInstancesUsage(start, end, workers=1, resolveWorkers=8, scopedTags=False, cachesReady=(), names=True,
+                      resourceGroups=None, service=None, region=None):
     """
     Get instances resource usage for month of specific resource_id
+    Up to workers months are retrieved concurrently, and up to resolveWorkers resource instances missing from
+    the resource cache are looked up concurrently.  Usage can be restricted to a list of resourceGroups ids, each
+    retrieved as its own shard, and filtered by service (catalog resource id) and region on the server.  If scopedTags the tags of each page's instances are searched
+    for in batches, rather than relying on the account wide tag cache.
+    Usage pages are fetched while the caches are still loading, cachesReady are the futures populating them and
+    are waited on before the first page is enriched.
+    If names is False usage is retrieved without names, instance names are taken from the resource cache and the
+    other names are left empty for UsageNames to fill.
+    Returns UsageTables, the wide DataFrame is built from it with wide().
     """
 
+    def fetchUsagePages(usageMonth, resourceGroupId, pages):
+        """
+        Read the usage pages of a month (or a resource group's month) in order onto a queue, so the next page is
+        fetched while the current one is enriched.  Errors are queued for the consumer to handle, None marks the end.
+        """
+        try:
+            nextoffset = None
+            while True:
+                if resourceGroupId != None:
+                    instances_usage = usage_reports_service.get_resource_usage_resource_group(
+                        account_id=accountId, resource_group_id=resourceGroupId,
+                        billingmonth=usageMonth, names=names, limit=limit, start=nextoffset,
+                        resource_id=service, region=region).get_result()
+                else:
+                    instances_usage = usage_reports_service.get_resource_usage_account(
+                        account_id=accountId,
+                        billingmonth=usageMonth, names=names, limit=limit, start=nextoffset,
+                        resource_id=service, region=region).get_result()
+                logging.debug("instance_usage %s=%s", usageMonth, instances_usage)
+                pages.put(instances_usage)
+                if "next" not in instances_usage:
+                    break
+                nextoffset = instances_usage["next"]["offset"]
+        except Exception as e:
+            pages.put(e)
+        pages.put(None)
+
+    def waitForCaches():
+        """
+        Wait for the tag and resource caches to be populated
+        """
+        for ready in cachesReady:
+            ready.result()
+
     def getResourceInstancefromCloud(resourceId):
         """
         Retrieve Resource Details from resource controller
@@ -233,7 +537,8 @@ def getInstancesUsage(start,end):
         try:
             resource_instance = resource_controller_service.get_resource_instance(
                 id=resourceId).get_result()
-            logging.debug("resource_instance={}".format(resource_instance))
+            logging.debug("resource_instance=%s", resource_instance)
+            resource_cache[resourceId] = resource_instance
         except ApiException as e:
             resource_instance = {}
             if e.code == 403:
@@ -242,53 +547,118 @@ def getInstancesUsage(start,end):
             else:
                 logging.warning(
                     "Error: Instance {} {}: {}".format(resourceId, str(e.code),e.message))
+            if e.code == 403 or e.code == 404:
+                # negatively cache instances which won't resolve later in the run, other errors are retried on a later page
+                resource_cache[resourceId] = resource_instance
+        finally:
+            with resolveLock:
+                pending.pop(resourceId, None)
         return resource_instance
 
+    def getTagsfromSearch(resourceIds):
+        """
+        Search for the tags of a batch of resources and add them to the tag cache
+        """
+        try:
+            tag_cache.update(getResourceTags(resourceIds))
+        finally:
+            with resolveLock:
+                for resourceId in resourceIds:
+                    pendingTags.pop(resourceId, None)
+
+    def resolveResourceInstances(resourceIds):
+        """
+        Look up the resource instances of a usage page missing from the cache concurrently, before its rows are processed.
+        Instances already being looked up for another month are waited on rather than requested again.
+        """
+        lookups = []
+        with resolveLock:
+            if scopedTags:
+                missingTags = []
+                for resourceId in set(resourceIds):
+                    if resourceId in tag_cache:
+                        continue
+                    if resourceId in pendingTags:
+                        lookups.append(pendingTags[resourceId])
+                    else:
+                        missingTags.append(resourceId)
+                for i in range(0, len(missingTags), tagBatch):
+                    batch = missingTags[i:i + tagBatch]
+                    lookup = resolver.submit(getTagsfromSearch, batch)
+                    for resourceId in batch:
+                        pendingTags[resourceId] = lookup
+                    lookups.append(lookup)
+            for resourceId in set(resourceIds):
+                if resourceId in resource_cache:
+                    continue
+                lookup = pending.get(resourceId)
+                if lookup is None:
+                    logging.debug("Cache miss for Resource %s", resourceId)
+                    lookup = resolver.submit(getResourceInstancefromCloud, resourceId)
+                    pending[resourceId] = lookup
+                    metrics.addRows("resourceCacheMisses", 1)
+                lookups.append(lookup)
+        for lookup in lookups:
+            lookup.result()
+
     def getResourceInstance(resourceId):
         """
-        Check Cache for Resource Details which may have been retrieved previously
+        Return Resource Details from the cache, populated for the page by resolveResourceInstances
         """
-        if resourceId not in resource_cache:
-            logging.debug("Cache miss for Resource {}".format(resourceId))
-            resource_cache[resourceId] = getResourceInstancefromCloud(resourceId)
-        return resource_cache[resourceId]
+        return resource_cache.get(resourceId, {})
 
     def getTags(resourceId):
         """
         Check Tag Cache for Resource
         """
         if resourceId not in tag_cache:
-            logging.debug("Cache miss for Tag {}".format(resourceId))
+            logging.debug("Cache miss for Tag %s", resourceId)
             tags = []
         else:
             tags = tag_cache[resourceId]
         return tags
 
-    data = []
-    limit = 100  ## set limit of record returned
-
-    """ Loop through months """
-    while start <= end:
-        usageMonth = start.strftime("%Y-%m")
-        logging.info("Retrieving Instances Usage from {}.".format(usageMonth))
-        start += relativedelta(months=+1)
-        record = 0
-        instances_usage = usage_reports_service.get_resource_usage_account(
-            account_id=accountId,
-            billingmonth=usageMonth, names=True, limit=limit).get_result()
-
-        if "next" in instances_usage:
-            nextoffset = instances_usage["next"]["offset"]
+    def getInstancesUsageMonth(shard):
+        """
+        Page through instance usage for one month, or one resource group's month.  Pages are read in order, each page
+        returns the offset of the next, by a prefetch thread while this thread enriches them.
+        """
+        usageMonth, resourceGroupId = shard
+        if resourceGroupId != None:
+            logging.info("Retrieving Instances Usage from {} for resource group {}.".format(usageMonth, resourceGroupId))
         else:
-            nextoffset = ""
-
-        rows_count = instances_usage["count"]
+            logging.info("Retrieving Instances Usage from {}.".format(usageMonth))
+        usageRows = UsageAccumulator(rowColumns, metricColumns)
+        record = 0
+        rows_count = None
+        pages = queue.Queue(maxsize=prefetchPages)
+        threading.Thread(target=fetchUsagePages, args=(usageMonth, resourceGroupId, pages), daemon=True).start()
+        waitForCaches()
 
         while True:
+            instances_usage = pages.get()
+            if instances_usage is None:
+                """ No more records break out of loop """
+                break
+            elif isinstance(instances_usage, ApiException):
+                if instances_usage.code == 424:
+                    logging.warning("API exception {}.".format(str(instances_usage)))
+                    return usageRows
+                else:
+                    logging.error("API exception {}.".format(str(instances_usage)))
+                    quit()
+            elif isinstance(instances_usage, Exception):
+                raise instances_usage
+            if rows_count is None:
+                rows_count = instances_usage["count"]
+                progress.addTotal(rows_count)
+
+            resolveResourceInstances([instance["resource_instance_id"] for instance in instances_usage["resources"]])
             for instance in instances_usage["resources"]:
                 record = record + 1
-                logging.info("{} Retrieving Instance {} of {} {}".format(usageMonth, record, rows_count, instance["resource_instance_id"]))
-                logging.debug("instance={}".format(instance))
+                logging.debug("%s Retrieving Instance %s of %s %s", usageMonth, record, rows_count, instance["resource_instance_id"])
+                logging.debug("instance=%s", instance)
+                progress.update(current=usageMonth)
                 if "pricing_country" in instance:
                     pricing_country = instance["pricing_country"]
                 else:
@@ -318,15 +688,15 @@ def getInstancesUsage(start,end):
                     "billing_country": billing_country,
                     "currency_code": currency_code,
                     "plan_id": instance["plan_id"],
-                    "plan_name": instance["plan_name"],
+                    "plan_name": instance.get("plan_name", ""),
                     "billable": instance["billable"],
                     "pricing_plan_id": instance["pricing_plan_id"],
                     "pricing_region": pricing_region,
                     "region": instance["region"],
                     "service_id": instance["resource_id"],
-                    "service_name": instance["resource_name"],
-                    "resource_group_name": instance["resource_group_name"],
-                    "instance_name": instance["resource_instance_name"]
+                    "service_name": instance.get("resource_name", ""),
+                    "resource_group_name": instance.get("resource_group_name", ""),
+                    "instance_name": instance.get("resource_instance_name", "")
                 }
 
                 """
@@ -335,6 +705,9 @@ def getInstancesUsage(start,end):
 
                 # get instance detail from cache or resource controller
                 resource_instance = getResourceInstance(instance["resource_instance_id"])
+                if row["instance_name"] == "":
+                    # usage retrieved with names=False, the name comes from the resource instance
+                    row["instance_name"] = resource_instance.get("name", "")
 
                 if "created_at" in resource_instance:
                     created_at = resource_instance["created_at"]
@@ -361,18 +734,6 @@ def getInstancesUsage(start,end):
                 else:
                     type = ""
 
-                roks_cluster_id = ""
-                roks_cluster_name = ""
-                if type == "container_instance":
-                    if instance["plan_id"] == "containers.kubernetes.cluster.roks":
-                        """ This is the instance of the ROKS Cluster"""
-                        roks_cluster_id = instance["resource_instance_name"]
-                        roks_cluster_name =  instance["resource_instance_name"]
-                    elif instance["plan_id"] == "containers.kubernetes.vpc.gen2.roks":
-                        """ This is a worker instance """
-                        roks_cluster_id = instance["resource_instance_name"][0:instance["resource_instance_name"].find('_')]
-                        roks_cluster_name = instance["resource_instance_name"][0:instance["resource_instance_name"].find('_')]
-
                 """
                 For VPC Virtual Servers obtain intended profile and virtual server details
                 """
@@ -418,8 +779,6 @@ def getInstancesUsage(start,end):
                     "instance_deleted_at": deleted_at,
                     "instance_state": state,
                     "type": type,
-                    "roks_cluster_id": roks_cluster_id,
-                    "roks_cluster_name": roks_cluster_name,
                     "instance_profile": profile,
                     "cpu_family": cpuFamily,
                     "numberOfVirtualCPUs": numberOfVirtualCPUs,
@@ -432,7 +791,8 @@ def getInstancesUsage(start,end):
                 }
 
                 # combine original row with additions
-                row = row | row_addition
+                row.update(row_addition)
+                usageRows.addInstance(row)
 
                 for usage in instance["usage"]:
                     metric = usage["metric"]
@@ -446,7 +806,7 @@ def getInstancesUsage(start,end):
                     metric_name = usage["metric_name"]
                     unit_name = usage["unit_name"]
 
-                    row_addition = {
+                    usageRows.addMetric({
                         "metric": metric,
                         "unit": unit,
                         "quantity": quantity,
@@ -457,37 +817,100 @@ def getInstancesUsage(start,end):
                         "discount": discount,
                         "metric_name": metric_name,
                         'unit_name': unit_name,
-                    }
+                    })
 
-                    row = row | row_addition
+        return usageRows
 
-                    data.append(row.copy())
-
-            if nextoffset == "":
-                """ No more records break out of loop """
-                break
-            else:
-                """ get more """
-                instances_usage = usage_reports_service.get_resource_usage_account(
-                    account_id=accountId,
-                    billingmonth=usageMonth, names=True,limit=limit, start=nextoffset).get_result()
-                if "next" in instances_usage:
-                    nextoffset = instances_usage["next"]["offset"]
-                else:
-                    nextoffset = ""
-
-            logging.debug("instance_usage {}={}".format(usageMonth, instances_usage))
-            #logging.info("Requesting Instance Usage: Start {}, Limit={}, Count={}".format(record, instances_usage["limit"], instances_usage["count"]))
-
-
-        instancesUsage = pd.DataFrame(data, columns=['account_id', "month", "service_name", "service_id", "instance_name","instance_id", "plan_name", "plan_id", "region", "pricing_region",
-                                                 "resource_group_name","resource_group_id", "billable", "pricing_country", "billing_country", "currency_code", "pricing_plan_id",
-                                                 "instance_created_at", "instance_updated_at", "instance_deleted_at", "instance_state", "type", "roks_cluster_id", "roks_cluster_name", "instance_profile", "cpu_family",
-                                                 "numberOfVirtualCPUs", "MemorySizeMiB", "NodeName", "NumberOfGPUs", "NumberOfInstStorageDisks", "availability_zone",
-                                                 "instance_role", "metric", "metric_name", "unit", "unit_name", "quantity", "cost", "rated_cost", "rateable_quantity", "price", "discount"])
+    limit = 100  ## set limit of record returned
+    prefetchPages = 2  ## usage pages read ahead of enrichment per month
+    tagBatch = 50  ## resources per scoped tag search query
+
+    # log progress periodically rather than a line per instance
+    progress = ProgressReporter("Instances usage")
+
+    # resource instance lookups from all months share one bounded pool
+    resolveLock = threading.Lock()
+    pending = {}
+    pendingTags = {}
+
+    # months, and resource groups within each month, are retrieved concurrently and merged in order
+    shards = [(usageMonth, resourceGroupId) for usageMonth in getUsageMonths(start, end) for resourceGroupId in (resourceGroups or [None])]
+    usageRows = UsageAccumulator(rowColumns, metricColumns)
+    with ThreadPoolExecutor(max_workers=resolveWorkers) as resolver, ThreadPoolExecutor(max_workers=workers) as executor:
+        for monthRows in executor.map(getInstancesUsageMonth, shards):
+            usageRows.extend(monthRows)
+
+    # build the normalized tables once from all months
+    instancesUsage = usageRows.toTables()
+    addClusterAttribution(instancesUsage.instances)
+    instancesUsage.columns = instanceColumns + metricColumns
+    progress.finish()
+    metrics.addRows("instancesUsage", len(instancesUsage))
 
     return instancesUsage
 
+@metrics.timed()
+def deriveAccountUsage(instancesUsage):
+    """
+    Compute account usage from instance usage rather than calling get_account_usage for every month.  Quantity and cost
+    of each service plan metric are summed over its instances for the month, price and discount are taken from its
+    first instance.
+    """
+    keys = ["account_id", "month", "currency_code", "billing_country", "service_id", "service_name", "plan_id", "plan_name"]
+    usage = instancesUsage.usage
+    detail = instancesUsage.instances[keys + ["billable"]].take(usage["instance_key"].to_numpy()).reset_index(drop=True)
+    for column in ["metric", "unit_name", "quantity", "rateable_quantity", "cost", "rated_cost"]:
+        detail[column] = usage[column].to_numpy()
+    detail["usage_key"] = np.arange(len(detail))
+    billable = (detail["billable"] == True).to_numpy()
+    detail["billable_charges"] = detail["cost"].where(billable, 0)
+    detail["billable_rated_charges"] = detail["rated_cost"].where(billable, 0)
+
+    accountUsage = detail.groupby(keys + ["metric", "unit_name"], observed=True, dropna=False).agg(
+        quantity=("quantity", "sum"), rateable_quantity=("rateable_quantity", "sum"),
+        cost=("cost", "sum"), rated_cost=("rated_cost", "sum"), usage_key=("usage_key", "first")).reset_index()
+    # billable charges are totals of the service for the month
+    resources = detail.groupby(["month", "service_id"], observed=True).agg(
+        billable_charges=("billable_charges", "sum"), billable_rated_charges=("billable_rated_charges", "sum"))
+    accountUsage = accountUsage.join(resources, on=["month", "service_id"])
+
+    # the first discount entry of the metric, as account usage reports it
+    discounts = instancesUsage.tierLists("discount", accountUsage["usage_key"].tolist())
+    accountUsage["discount"] = [discount[0].get("discount", np.nan) if discount else np.nan for discount in discounts]
+    prices = instancesUsage.tierLists("price", accountUsage["usage_key"].tolist())
+    accountUsage["price"] = [price if price else "[]" for price in prices]
+
+    accountUsage = accountUsage.rename(columns={"service_id": "resource_id", "service_name": "resource_name"})[accountColumns]
+    # plain object columns, so pivot tables only include observed values
+    for column in accountUsage.columns:
+        if accountUsage[column].dtype.name == "category":
+            accountUsage[column] = accountUsage[column].astype(object)
+    metrics.addRows("accountUsage", len(accountUsage))
+    return accountUsage
+
+def reconcileAccountUsage(accountUsage, sample, usageMonth, tolerance=0.01):
+    """
+    Compare the cost of each service in derived account usage for one month with the rows returned by get_account_usage
+    for the month, logging services whose cost differs by more than tolerance (relative).  Returns True if all agree.
+    """
+    sample = pd.DataFrame(sample, columns=accountColumns)
+    if len(sample) == 0:
+        logging.warning("Account usage for {} not available to reconcile derived account usage.".format(usageMonth))
+        return True
+    derived = accountUsage[accountUsage["month"] == usageMonth].groupby("resource_id")[["cost", "rated_cost"]].sum()
+    reported = sample.groupby("resource_id")[["cost", "rated_cost"]].sum()
+    compare = derived.join(reported, how="outer", lsuffix="_derived", rsuffix="_reported").fillna(0)
+    difference = (compare["cost_derived"] - compare["cost_reported"]).abs()
+    mismatched = compare[difference > tolerance * compare["cost_reported"].abs().clip(lower=0.01)]
+    logging.info("Derived account usage for {} costs {:,.2f}, get_account_usage {:,.2f}.".format(
+        usageMonth, compare["cost_derived"].sum(), compare["cost_reported"].sum()))
+    for resourceId, row in mismatched.iterrows():
+        logging.warning("Derived account usage for {} {} cost {:,.2f} differs from get_account_usage {:,.2f}.".format(
+            usageMonth, resourceId, row["cost_derived"], row["cost_reported"]))
+    metrics.addRows("reconcileMismatches", len(mismatched))
+    return len(mismatched) == 0
+
+@metrics.timed()
 def createServiceDetail(paasUsage):
     """
     Write Service Usage detail tab to excel
@@ -507,6 +930,7 @@ def createServiceDetail(paasUsage):
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
 
+@metrics.timed()
 def createInstancesDetailTab(instancesUsage):
     """
     Write detail tab to excel
@@ -526,6 +950,7 @@ def createInstancesDetailTab(instancesUsage):
     worksheet.autofilter(0,0,totalrows,totalcols)
     return
 
+@metrics.timed()
 def createUsageSummaryTab(paasUsage):
     logging.info("Creating Usage Summary tab.")
     usageSummary = pd.pivot_table(paasUsage, index=["resource_name"],
@@ -542,6 +967,64 @@ def createUsageSummaryTab(paasUsage):
     worksheet.set_column("A:A", 35, format2)
     worksheet.set_column("B:ZZ", 18, format1)
 
+def buildTagIndex(tag_cache):
+    """
+    Return the tag cache as a long table of instance_id, tag_key and tag_value, one row per tag.  Tags are split at
+    the first ':', tags without one have an empty value.
+    """
+    tags = pd.Series(tag_cache, dtype=object).explode().dropna()
+    if len(tags) == 0:
+        return pd.DataFrame({"instance_id": pd.Series(dtype=object), "tag_key": pd.Series(dtype=object), "tag_value": pd.Series(dtype=object)})
+    parts = tags.astype(str).str.split(":", n=1, expand=True).reindex(columns=[0, 1])
+    tagIndex = pd.DataFrame({"instance_id": tags.index, "tag_key": parts[0].to_numpy(), "tag_value": parts[1].fillna("").to_numpy()})
+    tagIndex["tag_key"] = tagIndex["tag_key"].astype("category")
+    tagIndex["tag_value"] = tagIndex["tag_value"].astype("category")
+    metrics.addRows("tagIndex", len(tagIndex))
+    return tagIndex
+
+def chargeback(instancesUsage, tagIndex, tagKey):
+    """
+    Return cost and rated cost by value of a tag key and month.  Instances with more than one value for the key are
+    charged to the first, spend of instances without the key is returned separately.
+    """
+    instancesUsage = usageColumns(instancesUsage, ["month", "instance_id", "rated_cost", "cost"])
+    costs = instancesUsage.groupby(["month", "instance_id"], observed=True)[["rated_cost", "cost"]].sum().reset_index()
+    costs["instance_id"] = costs["instance_id"].astype(object)
+    costs["month"] = costs["month"].astype(object)
+    values = tagIndex[(tagIndex["tag_key"] == tagKey).to_numpy()].drop_duplicates("instance_id")
+    values = pd.Series(values["tag_value"].astype(object).to_numpy(), index=values["instance_id"].astype(object).to_numpy())
+    costs["tag_value"] = costs["instance_id"].map(values)
+    tagged = costs["tag_value"].notna().to_numpy()
+    return costs[tagged], costs[~tagged]
+
+@metrics.timed()
+def createChargebackTab(instancesUsage, tagIndex, tagKey):
+    """
+    Write a tab of spend by the values of a tag key, with untagged spend on its own row
+    """
+    tagged, untagged = chargeback(instancesUsage, tagIndex, tagKey)
+    logging.info("Creating Chargeback tab for tag {}.".format(tagKey))
+    rows = []
+    if len(tagged) > 0:
+        rows.append(pd.pivot_table(tagged, index=["tag_value"], columns=["month"], values=["rated_cost", "cost"], aggfunc=np.sum, fill_value=0))
+    if len(untagged) > 0:
+        rows.append(pd.pivot_table(untagged.assign(tag_value="(untagged)"), index=["tag_value"], columns=["month"],
+                                   values=["rated_cost", "cost"], aggfunc=np.sum, fill_value=0))
+    if len(rows) == 0:
+        return
+    spend = pd.concat(rows).fillna(0)
+    spend.loc["Total"] = spend.sum()
+    spend = spend.reindex(["rated_cost", "cost"], axis=1, level=0)
+    spend.index.name = tagKey
+    sheet = re.sub(r"[\[\]:*?/\\]", "_", "Chargeback_" + tagKey)[:31]
+    spend.to_excel(writer, sheet)
+    worksheet = writer.sheets[sheet]
+    format1 = workbook.add_format({'num_format': '$#,##0.00'})
+    format2 = workbook.add_format({'align': 'left'})
+    worksheet.set_column("A:A", 35, format2)
+    worksheet.set_column("B:ZZ", 18, format1)
+
+@metrics.timed()
 def createMetricSummary(paasUsage):
     logging.info("Creating Metric Plan Summary tab.")
     metricSummaryPlan = pd.pivot_table(paasUsage, index=["resource_name", "plan_name", "metric"],
@@ -564,19 +1047,23 @@ def createMetricSummary(paasUsage):
     worksheet.set_column(4 + months, 4 + (months * 2), 18, format1)
     return
 
+@metrics.timed()
 def createClusterTab(instancesUsage):
     """
     Create Pivot table for ROKS Clusters
     """
 
-    workers = instancesUsage.query('(service_id == "containers-kubernetes" and plan_id == "containers.kubernetes.vpc.gen2.roks")')
+    instancesUsage = usageColumns(instancesUsage, ["month", "region", "roks_cluster_id", "service_id", "instance_name", "plan_id", "plan_name",
+                                                   "metric_name", "unit_name", "quantity", "cost"])
+    workers = instancesUsage[((instancesUsage["service_id"] == "containers-kubernetes") & (instancesUsage["plan_id"] == WORKER_PLAN)).to_numpy()]
     if len(workers) > 0:
         logging.info("Creating Cluster Pivot Tab.")
+        # observed only, so categorical columns don't expand to every combination of their values
         clusters = pd.pivot_table(workers, index=["region",  "roks_cluster_id", "instance_name", "plan_name", "metric_name", "unit_name"],
                                         columns=["month"],
                                         values=["quantity", "cost"],
                                         aggfunc={"quantity": np.sum, "cost": np.sum},
-                                        fill_value=0)
+                                        fill_value=0, observed=True)
 
         new_order = ["quantity", "cost"]
         clusters = clusters.reindex(new_order, axis=1, level=0)
@@ -595,57 +1082,165 @@ def createClusterTab(instancesUsage):
         worksheet.set_column(6 + months, 6 + (months * 2), 12, format1)
     return
 
+@metrics.timed()
+def createClusterSummaryTab(instancesUsage):
+    """
+    Create Pivot table of workers, quantity and cost for each ROKS cluster by month
+    """
+    rollup = clusterRollup(instancesUsage)
+    if len(rollup) > 0:
+        logging.info("Creating Cluster Summary Tab.")
+        clusters = pd.pivot_table(rollup, index=["region", "roks_cluster_id", "unit_name"],
+                                        columns=["month"],
+                                        values=["workers", "quantity", "cost"],
+                                        aggfunc=np.sum, fill_value=0, observed=True)
+        new_order = ["workers", "quantity", "cost"]
+        clusters = clusters.reindex(new_order, axis=1, level=0)
+        clusters.to_excel(writer, 'ClusterSummary')
+        worksheet = writer.sheets['ClusterSummary']
+        format2 = workbook.add_format({'align': 'left'})
+        format1 = workbook.add_format({'num_format': '$#,##0.00'})
+        format3 = workbook.add_format({'num_format': '#,##0'})
+        worksheet.set_column("A:A", 18, format2)
+        worksheet.set_column("B:B", 30, format2)
+        worksheet.set_column("C:C", 25, format2)
+        months = len(rollup.month.unique())
+        worksheet.set_column(3, 2 + (months * 2), 12, format3)
+        worksheet.set_column(3 + (months * 2), 2 + (months * 3), 12, format1)
+    return
+
 if __name__ == "__main__":
     setup_logging()
     load_dotenv()
     parser = argparse.ArgumentParser(description="Calculate IBM Cloud Usage.")
     parser.add_argument("--apikey", default=os.environ.get('IC_API_KEY', None), metavar="apikey", help="IBM Cloud API Key")
     parser.add_argument("--output", default=os.environ.get('output', 'ibmCloudUsage.xlsx'), help="Filename Excel output file. (including extension of .xlsx)")
+    parser.add_argument("--token-cache", default=os.environ.get('token_cache', None), help="File to keep the IAM token in between runs (created readable by the owner only).")
     parser.add_argument("--load", action=argparse.BooleanOptionalAction, help="load dataframes from pkl files.")
     parser.add_argument("--save", action=argparse.BooleanOptionalAction, help="Store dataframes to pkl files.")
     parser.add_argument("--start", help="Start Month YYYY-MM.")
     parser.add_argument("--end", help="End Month YYYY-MM.")
+    parser.add_argument("--workers", type=int, default=os.environ.get('workers', 6), help="Number of months to retrieve usage for concurrently.")
+    parser.add_argument("--resolve-workers", type=int, default=os.environ.get('resolve_workers', 8), help="Number of resource instances not in the resource cache to look up concurrently.")
+    parser.add_argument("--pool-size", type=int, default=os.environ.get('pool_size', POOL_SIZE), help="HTTP connections kept open per API host, shared by all workers.")
+    parser.add_argument("--resource-cache", default=os.environ.get('resource_cache', None), help="SQLite file to keep resource instances and tags between runs, shared with compareDayInstance.py.")
+    parser.add_argument("--scoped-tags", default=False, action=argparse.BooleanOptionalAction, help="Search tags only for the instances in the usage, in batches, instead of every tagged resource in the account.")
+    parser.add_argument("--resource-group", default=os.environ.get('resource_group', None), help="Only report usage of these resource groups (comma separated names or ids), retrieved concurrently.")
+    parser.add_argument("--service", default=os.environ.get('service', None), help="Only report usage of this service (catalog resource id, ie containers-kubernetes).")
+    parser.add_argument("--region", default=os.environ.get('region', None), help="Only report usage in this region.")
+    parser.add_argument("--snapshot-dir", default=os.environ.get('snapshot_dir', None), help="Store a dated snapshot of instance usage in this directory, as the changes since the previous snapshot.")
+    parser.add_argument("--cluster-tabs", default=True, action=argparse.BooleanOptionalAction, help="Include the ROKS ClusterDetail and ClusterSummary tabs.")
+    parser.add_argument("--chargeback-tags", default=os.environ.get('chargeback_tags', None), help="Comma separated tag keys (ie cost-center,team,env) to add a tab of spend by tag value for each.")
+    parser.add_argument("--names", default=True, action=argparse.BooleanOptionalAction, help="Request names with usage, --no-names resolves service, plan, resource group and instance names locally.")
+    parser.add_argument("--derive-account-usage", default=False, action=argparse.BooleanOptionalAction, help="Compute account usage from instance usage, requesting account usage only for the end month to reconcile it.")
+    parser.add_argument("--rate-limits", default=os.environ.get('rate_limits', None), help="API calls per second by family, ie SoftLayer=10,UsageReportsV4=20 (default unlimited, slowed automatically when throttled).")
+    parser.add_argument("--metrics-out", default=os.environ.get('metrics_out', None), help="Write run metrics (phase timings, API latency, rows) to this JSON file.")
+    parser.add_argument("--profile", default=os.environ.get('profile', None), help="Write cProfile stats for the run to this file.")
     args = parser.parse_args()
+    metrics.enable(args.metrics_out, args.profile)
+    limiter.configure(args.rate_limits)
     start = datetime.strptime(args.start, "%Y-%m")
     end = datetime.strptime(args.end, "%Y-%m")
     if args.load:
         logging.info("Retrieving Usage and Instance data stored data")
         accountUsage = pd.read_pickle("accountUsage.pkl")
         instancesUsage = pd.read_pickle("instanceUsage.pkl")
+        tagIndex = pd.read_pickle("tagIndex.pkl") if os.path.exists("tagIndex.pkl") else buildTagIndex({})
     else:
         if args.apikey == None:
                 logging.error("You must provide IBM Cloud ApiKey with view access to usage reporting.")
                 quit()
         else:
             apikey = args.apikey
-            instancesUsage = pd.DataFrame()
             accountUsage = pd.DataFrame()
-            createSDK(apikey)
+            createSDK(apikey, args.token_cache, args.pool_size)
             accountId = getAccountId(apikey)
             logging.info("Retrieving Usage and Instance data from AccountId: {}.".format(accountId))
             """
             Pre-populate Account Data to accelerate report generation
             """
-            tag_cache = prePopulateTagCache()
-            resource_cache = prePopulateResourceCache()
+            if args.resource_cache != None:
+                # reuse tags and resource instances from previous runs, refreshing only what changed
+                cache = ResourceCache(args.resource_cache)
+            else:
+                cache = None
+            usageNames = UsageNames(global_catalog_service, resource_manager_service, accountId, cache, args.resolve_workers)
+
+            # scope usage to resource groups (by name or id), a service or a region
+            resourceGroups = None
+            if args.resource_group != None:
+                groupIds = {name: groupId for groupId, name in usageNames.resourceGroups().items()}
+                resourceGroups = [groupIds.get(group.strip(), group.strip()) for group in args.resource_group.split(",")]
+            scoped = resourceGroups != None or args.service != None or args.region != None
+            if scoped:
+                # account usage can't be filtered, so it is derived from the scoped instance usage
+                logging.info("Usage scoped to resource groups {}, service {}, region {}.".format(resourceGroups, args.service, args.region))
 
-            logging.info("Retrieving Usage and Instance data from AccountId: {}.".format(accountId))
+            """
+            Tag and resource caches are populated while usage is retrieved, instance usage pages are
+            prefetched and wait for the caches only before they are enriched
+            """
+            resource_cache = {}
+            tag_cache = {}
+            with ThreadPoolExecutor(max_workers=3) as startup:
+                cachesReady = [startup.submit(loadResourceCache, cache)]
+                if not args.scoped_tags:
+                    cachesReady.append(startup.submit(loadTagCache, cache))
+                # tags are otherwise searched for the instances in the usage as each page is read
+                if args.derive_account_usage and not scoped:
+                    # only the last month is requested, to reconcile the account usage derived from instance usage
+                    sampleFuture = startup.submit(getAccountUsageMonth, end.strftime("%Y-%m"), args.names)
+                elif not scoped:
+                    accountUsageFuture = startup.submit(getAccountUsage, start, end, args.workers, args.names)
+
+                # Get Usage Data via API
+                instancesUsage = getInstancesUsage(start, end, args.workers, args.resolve_workers, args.scoped_tags, cachesReady, args.names,
+                                                   resourceGroups, args.service, args.region)
+                if not args.names:
+                    # usage was retrieved by id, fill service, plan and resource group names locally
+                    usageNames.fillCatalogNames(instancesUsage.instances, {"service_name": "service_id", "plan_name": "plan_id"})
+                    usageNames.fillResourceGroupNames(instancesUsage.instances)
+                if args.derive_account_usage or scoped:
+                    accountUsage = pd.concat([accountUsage, deriveAccountUsage(instancesUsage)])
+                    if not scoped:
+                        reconcileAccountUsage(accountUsage, sampleFuture.result(), end.strftime("%Y-%m"))
+                else:
+                    accountUsage = pd.concat([accountUsage, accountUsageFuture.result()])
+                    if not args.names:
+                        usageNames.fillCatalogNames(accountUsage, {"resource_name": "resource_id", "plan_name": "plan_id"})
+                for ready in cachesReady:
+                    ready.result()
 
-            # Get Usage Data via API
-            accountUsage = pd.concat([accountUsage, getAccountUsage(start, end)])
-            instancesUsage = pd.concat([instancesUsage, getInstancesUsage(start, end)])
+            if cache != None:
+                cache.saveLookups(resource_cache)
+                cache.close()
+            tagIndex = buildTagIndex(tag_cache)
 
             if args.save:
                 accountUsage.to_pickle("accountUsage.pkl")
+                # pickled as the wide DataFrame, UsageTables only resolves when this file runs as a script
+                instancesUsage = instancesUsage.wide()
                 instancesUsage.to_pickle("instanceUsage.pkl")
+                tagIndex.to_pickle("tagIndex.pkl")
 
     # Write dataframe to excel
     writer = pd.ExcelWriter(args.output, engine='xlsxwriter')
     workbook = writer.book
     createServiceDetail(accountUsage)
-    createInstancesDetailTab(instancesUsage)
+    if args.snapshot_dir != None and not args.load:
+        # today's snapshot, stored as the rows changed since the previous one
+        with metrics.phase("saveSnapshot"):
+            saveSnapshot(args.snapshot_dir, usageColumns(instancesUsage, tierText=True))
+    # the wide view is only built for this tab (unless it already was for --save), the other tabs take their columns
+    createInstancesDetailTab(usageColumns(instancesUsage))
     createUsageSummaryTab(accountUsage)
     createMetricSummary(accountUsage)
-    #createClusterTab(instancesUsage)
-    writer.close()
+    if args.cluster_tabs:
+        createClusterTab(instancesUsage)
+        createClusterSummaryTab(instancesUsage)
+    if args.chargeback_tags != None:
+        for tagKey in args.chargeback_tags.split(","):
+            createChargebackTab(instancesUsage, tagIndex, tagKey.strip())
+    with metrics.phase("xlsxWriterClose"):
+        writer.close()
     logging.info("Usage Report is complete.")
\ No newline at end of file
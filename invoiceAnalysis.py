@@ -15,7 +15,7 @@
 
 
 __author__ = 'jonhall'
-import SoftLayer, os, logging, logging.config, json, calendar, os.path, argparse, base64, re, urllib
+import SoftLayer, os, logging, logging.config, json, calendar, os.path, argparse, base64, re, urllib, tempfile
 import pandas as pd
 import numpy as np
 from sendgrid import SendGridAPIClient
@@ -29,19 +29,11 @@ from dateutil.relativedelta import relativedelta
 import ibm_boto3
 from ibm_botocore.client import Config, ClientError
 from dotenv import load_dotenv
-def setup_logging(default_path='logging.json', default_level=logging.info, env_key='LOG_CFG'):
-    # read logging.json for log parameters to be ued by script
-    path = default_path
-    value = os.getenv(env_key, None)
-    if value:
-        path = value
-    if os.path.exists(path):
-        with open(path, 'rt') as f:
-            config = json.load(f)
-        logging.config.dictConfig(config)
-    else:
-        logging.basicConfig(level=default_level)
-
+from logSetup import setup_logging
+from softlayerClient import createClient, createEmployeeClient, TRANSPORTS, TIMEOUT
+from runMetrics import metrics, ProgressReporter
+from rateLimiter import limiter
+from hedging import hedgeSoftLayer, hedger, BUDGET
 def getDescription(categoryCode, detail):
     # retrieve additional description detail for child records
     for item in detail:
@@ -71,23 +63,14 @@ def getInvoiceDates(startdate,enddate):
     enddate = datetime(int(enddate[0:4]),int(enddate[5:7]),20,0,0,0,tzinfo=dallas)
     return startdate, enddate
 
-def createEmployeeClient(end_point_employee, employee_user, passw, token):
-    """Creates a softlayer-python client that can make API requests for a given employee_user"""
-    client_noauth = SoftLayer.Client(endpoint_url=end_point_employee)
-    client_noauth.auth = None
-    employee = client_noauth['SoftLayer_User_Employee']
-    result = employee.performExternalAuthentication(employee_user, passw, token)
-    # Save result['hash'] somewhere to not have to login for every API request
-    client_employee = SoftLayer.employee_client(username=employee_user, access_token=result['hash'], endpoint_url=end_point_employee)
-    return client_employee
-
+@metrics.timed()
 def getInvoiceList(startdate, enddate):
     # GET LIST OF PORTAL INVOICES BETWEEN DATES USING CENTRAL (DALLAS) TIME
     dallas=tz.gettz('US/Central')
     logging.info("Looking up invoices from {} to {}.".format(startdate.strftime("%m/%d/%Y %H:%M:%S%z"), enddate.strftime("%m/%d/%Y %H:%M:%S%z")))
     # filter invoices based on local dallas time that correspond to CFTS UTC cutoff
-    logging.debug("invoiceList startDate: {}".format(startdate.astimezone(dallas).strftime("%m/%d/%Y %H:%M:%S")))
-    logging.debug("invoiceList endDate: {}".format(enddate.astimezone(dallas).strftime("%m/%d/%Y %H:%M:%S")))
+    logging.debug("invoiceList startDate: %s", startdate.astimezone(dallas))
+    logging.debug("invoiceList endDate: %s", enddate.astimezone(dallas))
     try:
         invoiceList = client['Account'].getInvoices(id=ims_account, mask='id,accountId,createDate,typeCode,invoiceTotalAmount,invoiceTotalRecurringAmount,invoiceTopLevelItemCount', filter={
                 'invoices': {
@@ -103,10 +86,12 @@ def getInvoiceList(startdate, enddate):
     except SoftLayer.SoftLayerAPIError as e:
         logging.error("Account::getInvoices: %s, %s" % (e.faultCode, e.faultString))
         quit()
-    logging.debug("getInvoiceList account {}: {}".format(ims_account,invoiceList))
-    logging.info("IBM Cloud account {}".format(invoiceList[0]["accountId"]))
+    logging.debug("getInvoiceList account %s: %s", ims_account, invoiceList)
+    if len(invoiceList) > 0:
+        logging.info("IBM Cloud account {}".format(invoiceList[0]["accountId"]))
     return invoiceList
 
+@metrics.timed()
 def parseChildren(row, parentDescription, children):
     """
     Parse Children Record if requested
@@ -114,7 +99,7 @@ def parseChildren(row, parentDescription, children):
     global data
 
     for child in children:
-        logging.debug(child)
+        logging.debug("child=%s", child)
         if float(child["recurringFee"]) > 0:
             row['RecordType'] = "Child"
             row["childBillingItemId"] = child["billingItemId"]
@@ -171,11 +156,11 @@ def parseChildren(row, parentDescription, children):
 
             # write child record
             data.append(row.copy())
-            logging.debug("child {} {} {} RecurringFee: {}".format(row["childBillingItemId"], row["INV_PRODID"], row["Description"],
-                                                               row["childTotalRecurringCharge"]))
-            logging.debug(row)
+            logging.debug("child %s %s %s RecurringFee: %s", row["childBillingItemId"], row["INV_PRODID"], row["Description"],
+                          row["childTotalRecurringCharge"])
     return
 
+@metrics.timed()
 def getAccountNetworkStorage():
     """
     Build Dataframe with accounts current network storage
@@ -258,9 +243,11 @@ def getAccountNetworkStorage():
 
     return storage_df
 
-def getInvoiceDetail(startdate, enddate):
+@metrics.timed()
+def getInvoiceDetail(startdate, enddate, invoiceMonth=None):
     """
     Read invoice top level detail from range of invoices
+    If invoiceMonth is specified only invoices for that IBM invoice month (YYYY-MM) are read.
     """
     global client, data, networkStorageDF
     # Create dataframe to work with for classic infrastructure invoices
@@ -274,6 +261,15 @@ def getInvoiceDetail(startdate, enddate):
     if invoiceList == None:
         return invoiceList
 
+    if invoiceMonth is not None:
+        # adjacent month ranges share the cutoff instant, keep only the invoices which belong to this month
+        invoiceList = [invoice for invoice in invoiceList
+                       if getCFTSInvoiceDate(datetime.strptime(invoice['createDate'], "%Y-%m-%dT%H:%M:%S%z").astimezone(dallas)) == invoiceMonth]
+
+    # log progress periodically rather than a line per line item
+    progress = ProgressReporter("Invoice line items", total=sum(invoice['invoiceTopLevelItemCount'] for invoice in invoiceList
+                                                                if float(invoice['invoiceTotalAmount']) != 0 or float(invoice['invoiceTotalRecurringAmount']) != 0))
+
     for invoice in invoiceList:
         if (float(invoice['invoiceTotalAmount']) == 0) and (float(invoice['invoiceTotalRecurringAmount']) == 0):
             continue
@@ -297,6 +293,7 @@ def getInvoiceDetail(startdate, enddate):
             serviceDateEnd = invoiceDate
 
         totalItems = invoice['invoiceTopLevelItemCount']
+        currentInvoice = "Invoice {} {} {}".format(invoiceID, invoiceType, datetime.strftime(invoiceDate, "%Y-%m-%d"))
 
         # PRINT INVOICE SUMMARY LINE
         logging.info('Invoice: {} Date: {} Type:{} Items: {} Amount: ${:,.2f}'.format(invoiceID, datetime.strftime(invoiceDate, "%Y-%m-%d"), invoiceType, totalItems, invoiceTotalRecurringAmount))
@@ -305,7 +302,7 @@ def getInvoiceDetail(startdate, enddate):
         for offset in range(0, totalItems, limit):
             if ( totalItems - offset - limit ) < 0:
                 remaining = totalItems - offset
-            logging.info("Retrieving %s invoice line items for Invoice %s at Offset %s of %s" % (limit, invoiceID, offset, totalItems))
+            logging.debug("Retrieving %s invoice line items for Invoice %s at Offset %s of %s", limit, invoiceID, offset, totalItems)
 
             try:
                 """
@@ -315,7 +312,8 @@ def getInvoiceDetail(startdate, enddate):
                        note: user must have classic Infrastructure access for storage components
                 """
 
-                Billing_Invoice = client['Billing_Invoice'].getInvoiceTopLevelItems(id=invoiceID, limit=limit, offset=offset,
+                with metrics.phase("getInvoiceTopLevelItems"):
+                    Billing_Invoice = client['Billing_Invoice'].getInvoiceTopLevelItems(id=invoiceID, limit=limit, offset=offset,
                                     mask="id, billingItemId,categoryCode,category,category.group, hourlyFlag,hostName,domainName,location,notes,product.description,product.taxCategory,product.attributes.attributeType," \
                                          "createDate,totalRecurringAmount,totalOneTimeAmount,usageChargeFlag,hourlyRecurringFee,children.billingItemId,children.description,children.category.group," \
                                          "children.categoryCode,children.product,children.product.taxCategory,children.product.attributes,children.product.attributes.attributeType,children.recurringFee")
@@ -327,7 +325,7 @@ def getInvoiceDetail(startdate, enddate):
 
             # ITERATE THROUGH DETAIL
             for item in Billing_Invoice:
-                logging.debug(item)
+                logging.debug("item=%s", item)
                 totalOneTimeAmount = float(item['totalOneTimeAmount'])
                 billingItemId = item['billingItemId']
                 if "group" in item["category"]:
@@ -513,8 +511,8 @@ def getInvoiceDetail(startdate, enddate):
 
                 # write parent record
                 data.append(row.copy())
-                logging.info("parent {} {} RecurringFee: {}".format(row["BillingItemId"], row["Description"],row["totalRecurringCharge"]))
-                logging.debug(row)
+                logging.debug("parent %s %s RecurringFee: %s", row["BillingItemId"], row["Description"], row["totalRecurringCharge"])
+                progress.update(current=currentInvoice)
 
                 if len(item["children"]) > 0:
                     parseChildren(row, description, item["children"])
@@ -557,26 +555,229 @@ def getInvoiceDetail(startdate, enddate):
     if storageFlag:
         columns.append("storage_notes")
 
+    progress.finish()
     df = pd.DataFrame(data, columns=columns)
+    metrics.addRows("invoiceDetail", len(df))
 
     return df
 
-def createType1Report(filename, classicUsage):
+def addTotalAmount(classicUsage):
+    # combine one time amounts and total recurring charge in datafrane
+    classicUsage["totalAmount"] = classicUsage["totalOneTimeAmount"] + classicUsage["totalRecurringCharge"] + classicUsage["childTotalRecurringCharge"]
+    return classicUsage
+
+"""
+Columns the summary, server and storage tabs group by, and the amounts they sum.  Line items are folded to one
+rollup row per distinct combination of keys, with Count holding the number of line items folded into the row.
+"""
+rollupKeys = ['IBM_Invoice_Month', 'Type', 'RecordType', 'TaxCategory', 'Category_Group', 'Category', 'Description',
+              'OS', 'location', 'Hourly', 'childParentProduct', 'INV_PRODID', 'billing_notes', 'storage_notes']
+rollupValues = ['totalAmount', 'totalRecurringCharge', 'childTotalRecurringCharge', 'Hours']
+
+@metrics.timed()
+def buildRollup(classicUsage):
+    """
+    Fold invoice line items into per month aggregates for the summary tabs
+    """
+    keys = [key for key in rollupKeys if key in classicUsage.columns]
+    grouped = classicUsage.groupby(keys, dropna=False, sort=False)
+    rollup = grouped[rollupValues].sum()
+    rollup["Count"] = grouped.size()
+    return rollup.reset_index()
+
+class InvoiceMonthSpool(object):
+    """
+    Invoice line items spilled to disk, one pickle per IBM invoice month.  Iterating the spool loads one month
+    at a time in month order, so tabs can be written without holding the whole date range in memory.
+    """
+
+    def __init__(self):
+        self.directory = tempfile.TemporaryDirectory(prefix="invoiceAnalysis-")
+        self.files = []
+        self.rollups = []
+        self.rows = 0
+
+    def add(self, month, classicUsage):
+        """
+        Fold a month of line items into the rollup and write them to the spool, returns the month's rollup
+        """
+        if len(classicUsage) == 0:
+            return buildRollup(addTotalAmount(classicUsage))
+        addTotalAmount(classicUsage)
+        # continue the row index across months so the Detail tab numbers rows as a single DataFrame would
+        classicUsage.index = pd.RangeIndex(self.rows, self.rows + len(classicUsage))
+        self.rows += len(classicUsage)
+        rollup = buildRollup(classicUsage)
+        self.rollups.append(rollup)
+        path = os.path.join(self.directory.name, "{}.pkl".format(month))
+        classicUsage.to_pickle(path)
+        self.files.append(path)
+        return rollup
+
+    def rollup(self):
+        """
+        Return the rollup of all months in the spool
+        """
+        if len(self.rollups) == 0:
+            return pd.DataFrame(columns=rollupKeys + rollupValues + ["Count"])
+        return pd.concat(self.rollups, ignore_index=True)
+
+    def __iter__(self):
+        for path in self.files:
+            yield pd.read_pickle(path)
+
+    def close(self):
+        self.directory.cleanup()
+
+def rollupPath(rollupDir, month):
+    return os.path.join(rollupDir, "rollup_{}.pkl".format(month))
+
+def saveRollups(rollupDir, rollup, fetched):
+    """
+    Write the rollup of each IBM invoice month to the rollup store, replacing the month if already stored.  fetched
+    is when its invoices started to be read, kept with the rollup to tell whether the month had closed.
+    """
+    os.makedirs(rollupDir, exist_ok=True)
+    for month, monthRollup in rollup.groupby("IBM_Invoice_Month", sort=False):
+        monthRollup = monthRollup.reset_index(drop=True)
+        monthRollup.attrs["fetched"] = fetched
+        monthRollup.to_pickle(rollupPath(rollupDir, month))
+        logging.debug("Saved rollup for %s to %s.", month, rollupDir)
+
+def loadRollup(rollupDir, month, monthEnd):
+    """
+    Return the stored rollup for a closed IBM invoice month, or None if the month must be read from the API.
+    A month closes at the CFTS cutoff (monthEnd), a rollup fetched before then was for an open month and is not reused.
+    The fetch time is stored in the rollup, as the file's modification time changes when the store is copied.
+    """
+    path = rollupPath(rollupDir, month)
+    if not os.path.exists(path):
+        return None
+    rollup = pd.read_pickle(path)
+    fetched = rollup.attrs.get("fetched")
+    if fetched is None or fetched < monthEnd:
+        logging.info("Rollup for {} was fetched before the month closed, refreshing.".format(month))
+        return None
+    if storageFlag and "storage_notes" not in rollup.columns:
+        logging.info("Rollup for {} was saved without --storage, refreshing.".format(month))
+        return None
+    return rollup
+
+@metrics.timed()
+def getInvoiceDetailByMonth(startdate, enddate, rollupDir=None):
+    """
+    Streaming alternative to getInvoiceDetail for long date ranges.  Invoices are read one IBM invoice month
+    (20th to 19th) at a time and each month is rolled up and spilled to disk before the next is read, so peak
+    memory is bounded by the largest month rather than the whole range.  Month rollups are saved to rollupDir if specified.
+    """
+    global data
+    spool = InvoiceMonthSpool()
+    monthStart = startdate
+    while monthStart < enddate:
+        monthEnd = monthStart + relativedelta(months=1)
+        month = getCFTSInvoiceDate(monthStart)
+        logging.info("Retrieving invoices for IBM invoice month {}.".format(month))
+        fetched = datetime.now(tz.tzutc())
+        with metrics.phase("spoolInvoiceMonth"):
+            rollup = spool.add(month, getInvoiceDetail(monthStart, monthEnd, month))
+        if rollupDir is not None:
+            saveRollups(rollupDir, rollup, fetched)
+        # release the month's rows before the next month is read
+        data = []
+        monthStart = monthEnd
+    return spool
+
+@metrics.timed()
+def getMonthlyRollups(startdate, enddate, rollupDir=None):
+    """
+    Return the rollup of each IBM invoice month in the range for the summary tabs.  Closed months are read from
+    the rollup store, only new and open months are retrieved from the API and their rollups saved.
+    """
+    global data
+    rollups = []
+    monthStart = startdate
+    while monthStart < enddate:
+        monthEnd = monthStart + relativedelta(months=1)
+        month = getCFTSInvoiceDate(monthStart)
+        rollup = None
+        if rollupDir is not None:
+            rollup = loadRollup(rollupDir, month, monthEnd)
+        if rollup is None:
+            logging.info("Retrieving invoices for IBM invoice month {}.".format(month))
+            fetched = datetime.now(tz.tzutc())
+            rollup = buildRollup(addTotalAmount(getInvoiceDetail(monthStart, monthEnd, month)))
+            data = []
+            if rollupDir is not None:
+                saveRollups(rollupDir, rollup, fetched)
+        else:
+            logging.info("Using stored rollup for IBM invoice month {}.".format(month))
+        rollups.append(rollup)
+        monthStart = monthEnd
+    metrics.addRows("rollup", sum(len(rollup) for rollup in rollups))
+    return pd.concat(rollups, ignore_index=True)
+
+def createWriter(filename, usageChunks):
+    """
+    Return the ExcelWriter for a report.  When streaming, the workbook is opened in constant_memory mode so the Detail
+    tab's rows are flushed to disk as they are written rather than all held until the workbook is closed.
+    """
+    streaming = isinstance(usageChunks, InvoiceMonthSpool)
+    return pd.ExcelWriter(filename, engine='xlsxwriter', engine_kwargs={"options": {"constant_memory": streaming}})
+
+def writeDetailRows(workbook, usageChunks):
+    """
+    Write line items to a constant_memory Detail worksheet in row order, laid out as DataFrame.to_excel would (which
+    writes a column at a time, so can't be used in constant_memory mode).  Returns the rows and columns written.
+    """
+    worksheet = workbook.add_worksheet("Detail")
+    header = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    totalrows = 0
+    columns = None
+    for classicUsage in usageChunks:
+        if len(classicUsage) == 0:
+            continue
+        if columns is None:
+            columns = list(classicUsage.columns)
+            worksheet.write_row(0, 1, columns, header)
+        for index, values in zip(classicUsage.index, classicUsage.itertuples(index=False, name=None)):
+            totalrows += 1
+            worksheet.write(totalrows, 0, index, header)
+            # missing values are left blank, as to_excel does
+            worksheet.write_row(totalrows, 1, [None if value is pd.NaT or (isinstance(value, float) and value != value) else value for value in values])
+    return totalrows, len(columns) if columns is not None else 0
+
+@metrics.timed()
+def createType1Report(filename, usageChunks, rollup):
     """
     Type 1 Output meets the majority of SLIC account setup.
     Break out of invoice data is based on a traditional IaaS vs PaaS view.
     IaaS Top Sheet Detail is split by all classic Infrastructure broken out by IMS Invoice, with splits for VMware Licensing, Classic Object Storage, and all other IaaS
     PaaS Top Sheet Detail is atches the definition of IMS as any usage billed through IMS from DSW.  Additional detail is provided to assist in reconcilation
 
+    usageChunks is an iterable of line item DataFrames (the whole range, or one per month with --streaming) used for
+    the detail and reconciliation tabs.  Summary tabs are built from the rollup of the same line items.
+
     Command-line Flags can be set to control which tabs are created
     """
 
-    def createDetailTab(classicUsage):
+    @metrics.timed()
+    def createDetailTab(usageChunks):
         """
-        Write detail tab to excel
+        Write detail tab to excel, appending one chunk of rows at a time
         """
         logging.info("Creating detail tab.")
-        classicUsage.to_excel(writer, 'Detail')
+        totalrows = 0
+        if workbook.constant_memory:
+            totalrows, totalcols = writeDetailRows(workbook, usageChunks)
+        else:
+            for classicUsage in usageChunks:
+                if len(classicUsage) == 0:
+                    continue
+                classicUsage.to_excel(writer, 'Detail', startrow=totalrows + 1 if totalrows > 0 else 0, header=totalrows == 0)
+                totalrows += len(classicUsage)
+                totalcols = len(classicUsage.columns)
+        if totalrows == 0:
+            return
         usdollar = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
         worksheet = writer.sheets['Detail']
@@ -584,10 +785,10 @@ def createType1Report(filename, classicUsage):
         worksheet.set_column('AB:AB', 18, format2)
         worksheet.set_column('AC:AC', 18, usdollar)
         worksheet.set_column('W:W', 18, format2)
-        totalrows, totalcols = classicUsage.shape
         worksheet.autofilter(0, 0, totalrows, totalcols)
         return
 
+    @metrics.timed()
     def createIaasTopSheet(classicUsage):
         """
         Break out for CFTS type 1 detail for IaaS.  This covers accounts with single billing work number
@@ -635,11 +836,11 @@ def createType1Report(filename, classicUsage):
                     billingItemId = row["BillingItemId"]
                     invoiceId = row["Portal_Invoice_Number"]
                     os = vmwareOS.query('BillingItemId == @billingItemId and Portal_Invoice_Number == @invoiceId')
-                    logging.debug("os: {}".format(os))
+                    logging.debug("os: %s", os)
                     if len(os) > 0:
                         serverCost = row["totalRecurringCharge"]
                         osCost = os["childTotalRecurringCharge"]
-                        logging.debug("row:{}".format(row))
+                        logging.debug("row: %s", row)
                         iaasRemaining.at[index, 'totalRecurringCharge'] = float(serverCost) - float(osCost)
 
             iaasRemaining["invoiceAmount"] = (iaasRemaining["totalRecurringCharge"] + iaasRemaining["totalOneTimeAmount"])
@@ -706,6 +907,7 @@ def createType1Report(filename, classicUsage):
             worksheet.set_column("H:ZZ", 18, format1)
         return
 
+    @metrics.timed()
     def createPaasTopSheet(classicUsage):
         """
         Build a pivot table of items that typically show on CFTS invoice at child level
@@ -739,6 +941,7 @@ def createType1Report(filename, classicUsage):
                 worksheet.set_column("G:ZZ", 18, format1)
         return
     
+    @metrics.timed()
     def createCreditTopSheet(classicUsage):
         """
         Build a pivot table Credit Invoices
@@ -761,6 +964,7 @@ def createType1Report(filename, classicUsage):
                 worksheet.set_column("D:ZZ", 18, format1)
         return
 
+    @metrics.timed()
     def createCategoryGroup(classicUsage):
         """
         Create General SUmmary Tab by Category_Group of NEW, RECURRING, and ONE_TIME CHARGES appearing
@@ -783,6 +987,7 @@ def createType1Report(filename, classicUsage):
         worksheet.set_column("C:ZZ", 18, format1)
         return
 
+    @metrics.timed()
     def createCategoryDetail(classicUsage):
         """
         Build a pivot table by Category with totalRecurringCharges
@@ -805,6 +1010,7 @@ def createType1Report(filename, classicUsage):
         worksheet.set_column("E:ZZ", 18, format1)
         return
 
+    @metrics.timed()
     def createClassicCOS(classicUsage):
         """
         Build a pivot table of Classic Object Storage
@@ -830,6 +1036,7 @@ def createType1Report(filename, classicUsage):
             worksheet.set_column("F:ZZ", 18, format1)
         return
 
+    @metrics.timed()
     def createPaaSInvoiceDetail(classicUsage):
         """
         Build a pivot table of PaaS object storage
@@ -858,6 +1065,7 @@ def createType1Report(filename, classicUsage):
             worksheet.set_column("D:ZZ", 18, format1)
         return
 
+    @metrics.timed()
     def createHourlyVirtualServers(classicUsage):
         """
         Build a pivot table for Hourly VSI's with totalRecurringCharges
@@ -866,11 +1074,11 @@ def createType1Report(filename, classicUsage):
         if len(virtualServers) > 0:
             logging.info("Creating Hourly VSI Tab.")
             virtualServerPivot = pd.pivot_table(virtualServers, index=["Description", "OS"],
-                                                values=["Hours", "totalRecurringCharge"],
+                                                values=["Count", "Hours", "totalRecurringCharge"],
                                                 columns=['IBM_Invoice_Month'],
-                                                aggfunc={'Description': len, 'Hours': np.sum,
+                                                aggfunc={'Count': np.sum, 'Hours': np.sum,
                                                          'totalRecurringCharge': np.sum}, fill_value=0). \
-                rename(columns={"Description": 'qty', 'Hours': 'Total Hours', 'totalRecurringCharge': 'TotalRecurring'})
+                rename(columns={"Count": 'qty', 'Hours': 'Total Hours', 'totalRecurringCharge': 'TotalRecurring'})
 
             virtualServerPivot.to_excel(writer, 'HrlyVirtualServers')
             format_leftjustify = workbook.add_format()
@@ -880,6 +1088,7 @@ def createType1Report(filename, classicUsage):
 
         return
 
+    @metrics.timed()
     def createMonthlyVirtualServers(classicUsage):
         """
         Build a pivot table for Monthly VSI's with totalRecurringCharges
@@ -888,11 +1097,11 @@ def createType1Report(filename, classicUsage):
         if len(monthlyVirtualServers) > 0:
             logging.info("Creating Monthly VSI Tab.")
             virtualServerPivot = pd.pivot_table(monthlyVirtualServers, index=["Description", "OS"],
-                                                values=["totalRecurringCharge"],
+                                                values=["Count", "totalRecurringCharge"],
                                                 columns=['IBM_Invoice_Month'],
-                                                aggfunc={'Description': len, 'totalRecurringCharge': np.sum},
+                                                aggfunc={'Count': np.sum, 'totalRecurringCharge': np.sum},
                                                 fill_value=0). \
-                rename(columns={"Description": 'qty', 'totalRecurringCharge': 'TotalRecurring'})
+                rename(columns={"Count": 'qty', 'totalRecurringCharge': 'TotalRecurring'})
             virtualServerPivot.to_excel(writer, 'MnthlyVirtualServers')
             format_leftjustify = workbook.add_format()
             format_leftjustify.set_align('left')
@@ -900,6 +1109,7 @@ def createType1Report(filename, classicUsage):
             worksheet.set_column('A:B', 40, format_leftjustify)
         return
 
+    @metrics.timed()
     def createHourlyBareMetalServers(classicUsage):
         """
         Build a pivot table for Hourly Bare Metal with totalRecurringCharges
@@ -908,10 +1118,10 @@ def createType1Report(filename, classicUsage):
         if len(bareMetalServers) > 0:
             logging.info("Creating Hourly Bare Metal Tab.")
             pivot = pd.pivot_table(bareMetalServers, index=["Description", "OS"],
-                                   values=["Hours", "totalRecurringCharge"],
+                                   values=["Count", "totalRecurringCharge"],
                                    columns=['IBM_Invoice_Month'],
-                                   aggfunc={'Description': len, 'totalRecurringCharge': np.sum}, fill_value=0). \
-                rename(columns={"Description": 'qty', 'Hours': np.sum, 'totalRecurringCharge': 'TotalRecurring'})
+                                   aggfunc={'Count': np.sum, 'totalRecurringCharge': np.sum}, fill_value=0). \
+                rename(columns={"Count": 'qty', 'totalRecurringCharge': 'TotalRecurring'})
             pivot.to_excel(writer, 'HrlyBaremetalServers')
             format_leftjustify = workbook.add_format()
             format_leftjustify.set_align('left')
@@ -919,6 +1129,7 @@ def createType1Report(filename, classicUsage):
             worksheet.set_column('A:B', 40, format_leftjustify)
         return
 
+    @metrics.timed()
     def createMonthlyBareMetalServers(classicUsage):
         """
         Build a pivot table for Monthly Bare Metal with totalRecurringCharges
@@ -927,10 +1138,10 @@ def createType1Report(filename, classicUsage):
         if len(monthlyBareMetalServers) > 0:
             logging.info("Creating Monthly Bare Metal Tab.")
             pivot = pd.pivot_table(monthlyBareMetalServers, index=["location", "Description", "OS"],
-                                   values=["totalRecurringCharge"],
+                                   values=["Count", "totalRecurringCharge"],
                                    columns=['IBM_Invoice_Month'],
-                                   aggfunc={'Description': len, 'totalRecurringCharge': np.sum}, fill_value=0). \
-                rename(columns={"Description": 'qty', 'totalRecurringCharge': 'TotalRecurring'})
+                                   aggfunc={'Count': np.sum, 'totalRecurringCharge': np.sum}, fill_value=0). \
+                rename(columns={"Count": 'qty', 'totalRecurringCharge': 'TotalRecurring'})
             pivot.to_excel(writer, 'MthlyBaremetalServers')
             format_leftjustify = workbook.add_format()
             format_leftjustify.set_align('left')
@@ -938,6 +1149,7 @@ def createType1Report(filename, classicUsage):
             worksheet.set_column('A:C', 40, format_leftjustify)
         return
 
+    @metrics.timed()
     def createStorageTab(classicUsage):
         """
         Build a pivot table for Storage as a Service by Volume Name
@@ -973,43 +1185,45 @@ def createType1Report(filename, classicUsage):
     """
     Create Pivots and write to Excel using xlswriter.
     """
-    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+    writer = createWriter(filename, usageChunks)
     workbook = writer.book
     logging.info("Creating {}.".format(filename))
 
-    # combine one time amounts and total recurring charge in datafrane
-    classicUsage["totalAmount"] = classicUsage["totalOneTimeAmount"] + classicUsage["totalRecurringCharge"] + classicUsage["childTotalRecurringCharge"]
-
     """
     Create each tab in Excel Worksheet
     """
-    if len(classicUsage) > 0:
+    if len(rollup) > 0:
         if detailFlag:
-            createDetailTab(classicUsage)
+            createDetailTab(usageChunks)
+        # only Detail is written a row at a time, pandas writes the other tabs a column at a time
+        workbook.constant_memory = False
         """
         Create IaaS, PaaS, and Credit Top Sheets to match
         each month's CFTS invoices generated
         """
         if reconciliationFlag:
-            createIaasTopSheet(classicUsage)
-            createPaasTopSheet(classicUsage)
-            createCreditTopSheet(classicUsage)
+            for classicUsage in usageChunks:
+                createIaasTopSheet(classicUsage)
+            for classicUsage in usageChunks:
+                createPaasTopSheet(classicUsage)
+            for classicUsage in usageChunks:
+                createCreditTopSheet(classicUsage)
 
         """
         Create additional Summary Usage and Category Detail
         """
         if summaryFlag:
-            createCategoryGroup(classicUsage)
-            createCategoryDetail(classicUsage)
+            createCategoryGroup(rollup)
+            createCategoryDetail(rollup)
 
         if cosdetailFlag:
-            createClassicCOS(classicUsage)
+            createClassicCOS(rollup)
 
         if serverDetailFlag:
-            createHourlyVirtualServers(classicUsage)
-            createMonthlyVirtualServers(classicUsage)
-            createHourlyBareMetalServers(classicUsage)
-            createMonthlyBareMetalServers(classicUsage)
+            createHourlyVirtualServers(rollup)
+            createMonthlyVirtualServers(rollup)
+            createHourlyBareMetalServers(rollup)
+            createMonthlyBareMetalServers(rollup)
 
         """
         if --storage specified on command line provide
@@ -1017,24 +1231,39 @@ def createType1Report(filename, classicUsage):
         records
         """
         if storageFlag:
-            createStorageTab(classicUsage)
-    writer.close()
+            createStorageTab(rollup)
+    with metrics.phase("xlsxWriterClose"):
+        writer.close()
     return
 
-def createType2Report(filename, classicUsage):
+@metrics.timed()
+def createType2Report(filename, usageChunks, rollup):
 
     """
     Type 2 Output meets the setup of SLIC accounts who have manual billing and/or multiple worknumbers associated.
     Break out of invoice data is based on "D Code" offering detail.
     The IaaS_YYYY-MM.  Items with the same INV_PRODID will appear as a single item on the CFTS invoice & Classic Infra by Category.
     The PaaS_YYYY-MM.  Items that have a PaaS CoS DCode appear a child level.
+    usageChunks and rollup are as for createType1Report.
     """
-    def createDetailTab(classicUsage):
+    @metrics.timed()
+    def createDetailTab(usageChunks):
         """
-        Write detail tab to excel
+        Write detail tab to excel, appending one chunk of rows at a time
         """
         logging.info("Creating detail tab.")
-        classicUsage.to_excel(writer, 'Detail')
+        totalrows = 0
+        if workbook.constant_memory:
+            totalrows, totalcols = writeDetailRows(workbook, usageChunks)
+        else:
+            for classicUsage in usageChunks:
+                if len(classicUsage) == 0:
+                    continue
+                classicUsage.to_excel(writer, 'Detail', startrow=totalrows + 1 if totalrows > 0 else 0, header=totalrows == 0)
+                totalrows += len(classicUsage)
+                totalcols = len(classicUsage.columns)
+        if totalrows == 0:
+            return
         usdollar = workbook.add_format({'num_format': '$#,##0.00'})
         format2 = workbook.add_format({'align': 'left'})
         worksheet = writer.sheets['Detail']
@@ -1042,9 +1271,9 @@ def createType2Report(filename, classicUsage):
         worksheet.set_column('AB:AB', 18, format2)
         worksheet.set_column('AC:AC', 18, usdollar)
         worksheet.set_column('W:W', 18, format2 )
-        totalrows,totalcols=classicUsage.shape
         worksheet.autofilter(0,0,totalrows,totalcols)
         return
+    @metrics.timed()
     def createCategoryGroupSummary(classicUsage):
         """
         Map Portal Invoices to SLIC Invoices / Create Top Sheet per SLIC month
@@ -1067,6 +1296,7 @@ def createType2Report(filename, classicUsage):
             worksheet.set_column("C:C", 60, format2)
             worksheet.set_column("D:ZZ", 18, format1)
         return
+    @metrics.timed()
     def createCategooryDetail(classicUsage):
         """
         Build a pivot table by Category with totalRecurringCharges
@@ -1089,6 +1319,7 @@ def createType2Report(filename, classicUsage):
             worksheet.set_column("D:D", 60, format2)
             worksheet.set_column("E:ZZ", 18, format1)
         return
+    @metrics.timed()
     def createClassicCOS(classicUsage):
         """
         Build a pivot table of Classic Object Storage that displays charges appearing on CFTS invoice
@@ -1109,6 +1340,7 @@ def createType2Report(filename, classicUsage):
                 worksheet.set_column("B:E", 40, format2)
                 worksheet.set_column("F:ZZ", 18, format1)
         return
+    @metrics.timed()
     def createPaaSInvoice(classicUsage):
         """
         Build a pivot table of PaaS object storage
@@ -1138,6 +1370,7 @@ def createType2Report(filename, classicUsage):
                 worksheet.set_column("F:F", 60, format2)
                 worksheet.set_column("G:ZZ", 18, format1)
         return
+    @metrics.timed()
     def createIaasInvoice(classicUsage):
         """
         Build a pivot table of items that typically show on CFTS invoice at child level
@@ -1208,6 +1441,7 @@ def createType2Report(filename, classicUsage):
                 worksheet.set_column("E:E", 70, format2)
                 worksheet.set_column("F:ZZ", 18, format1)
         return
+    @metrics.timed()
     def createCreditInvoice(classicUsage):
         """
         Build a pivot table Credit Invoices
@@ -1229,6 +1463,7 @@ def createType2Report(filename, classicUsage):
                 worksheet.set_column("A:C", 20, format2)
                 worksheet.set_column("D:ZZ", 18, format1)
         return
+    @metrics.timed()
     def createStorageTab(classicUsage):
         """
         Build a pivot table for Storage as a Service by Volume Name
@@ -1264,33 +1499,37 @@ def createType2Report(filename, classicUsage):
     global writer, workbook
 
     # Write dataframe to excel
-    writer = pd.ExcelWriter(filename, engine='xlsxwriter')
+    writer = createWriter(filename, usageChunks)
     workbook = writer.book
     logging.info("Creating {}.".format(filename))
 
-    # combine one time amounts and total recurring charge in datafrane
-    classicUsage["totalAmount"] = classicUsage["totalOneTimeAmount"] + classicUsage["totalRecurringCharge"] + classicUsage["childTotalRecurringCharge"]
-
     # create pivots for various tabs for Type2 SLIC based on flags
     if detailFlag:
-        createDetailTab(classicUsage)
+        createDetailTab(usageChunks)
+    # only Detail is written a row at a time, pandas writes the other tabs a column at a time
+    workbook.constant_memory = False
 
     if reconciliationFlag:
-        createIaasInvoice(classicUsage)
-        createPaaSInvoice(classicUsage)
-        createCreditInvoice(classicUsage)
+        for classicUsage in usageChunks:
+            createIaasInvoice(classicUsage)
+        for classicUsage in usageChunks:
+            createPaaSInvoice(classicUsage)
+        for classicUsage in usageChunks:
+            createCreditInvoice(classicUsage)
 
     if summaryFlag:
-        createCategoryGroupSummary(classicUsage)
-        createCategooryDetail(classicUsage)
+        createCategoryGroupSummary(rollup)
+        createCategooryDetail(rollup)
 
     if cosdetailFlag:
-        createClassicCOS(classicUsage)
+        createClassicCOS(rollup)
 
     if storageFlag:
-        createStorageTab(classicUsage)
-    writer.close()
+        createStorageTab(rollup)
+    with metrics.phase("xlsxWriterClose"):
+        writer.close()
     
+@metrics.timed()
 def multi_part_upload(bucket_name, item_name, file_path):
     try:
         logging.info("Starting file transfer for {0} to bucket: {1}".format(item_name, bucket_name))
@@ -1320,6 +1559,7 @@ def multi_part_upload(bucket_name, item_name, file_path):
         logging.error("Unable to complete multi-part upload: {0}".format(e))
     return
 
+@metrics.timed()
 def sendEmail(startdate, enddate, sendGridTo, sendGridFrom, sendGridSubject, sendGridApi, outputname):
     # Send output to email distributionlist via SendGrid
 
@@ -1389,8 +1629,22 @@ if __name__ == "__main__":
     parser.add_argument('--reconciliation', default=True, action=argparse.BooleanOptionalAction, help="Whether to write invoice reconciliation tabs to worksheet.")
     parser.add_argument('--serverdetail', default=True, action=argparse.BooleanOptionalAction, help="Whether to write server detail tabs to worksheet.")
     parser.add_argument('--cosdetail', default=False, action=argparse.BooleanOptionalAction, help="Whether to write Classic Object Storage tab to worksheet.")
+    parser.add_argument("--rollups", default=os.environ.get('rollups', None), help="Directory of monthly rollups used by the summary tabs. Rollups of months read are saved here, closed months are reused with --trend.")
+    parser.add_argument('--trend', default=False, action=argparse.BooleanOptionalAction, help="Build only the summary tabs from monthly rollups, retrieving only months not already in --rollups.")
+    parser.add_argument('--streaming', default=False, action=argparse.BooleanOptionalAction, help="Retrieve and process one IBM invoice month at a time, spilling detail to disk, to bound memory for long date ranges.")
+    parser.add_argument("--sl-transport", default=os.environ.get('sl_transport', 'xmlrpc'), choices=TRANSPORTS, help="SoftLayer API transport, rest is quicker to parse for large pages.")
+    parser.add_argument("--sl-timeout", type=int, default=os.environ.get('sl_timeout', TIMEOUT), help="Seconds to wait for a SoftLayer API response before retrying.")
+    parser.add_argument("--rate-limits", default=os.environ.get('rate_limits', None), help="API calls per second by family, ie SoftLayer=10,UsageReportsV4=20 (default unlimited, slowed automatically when throttled).")
+    parser.add_argument("--hedge", default=False, action=argparse.BooleanOptionalAction, help="Send a second copy of slow getInvoiceTopLevelItems pages and use the first answer.")
+    parser.add_argument("--hedge-budget", type=float, default=os.environ.get('hedge_budget', BUDGET), help="Largest fraction of page calls which may be hedged.")
+    parser.add_argument("--metrics-out", default=os.environ.get('metrics_out', None), help="Write run metrics (phase timings, API latency, rows) to this JSON file.")
+    parser.add_argument("--profile", default=os.environ.get('profile', None), help="Write cProfile stats for the run to this file.")
 
     args = parser.parse_args()
+    metrics.enable(args.metrics_out, args.profile)
+    limiter.configure(args.rate_limits)
+    if args.hedge:
+        hedger.configure(budget=args.hedge_budget)
 
     """Set Flags to determine which Tabs are created in output"""
     storageFlag = args.storage
@@ -1447,7 +1701,7 @@ if __name__ == "__main__":
                         ims_account = args.account
                     ims_yubikey = input("Yubi Key:")
                     SL_ENDPOINT = "http://internal.applb.dal10.softlayer.local/v3.1/internal/xmlrpc"
-                    client = createEmployeeClient(SL_ENDPOINT, ims_username, ims_password, ims_yubikey)
+                    client = createEmployeeClient(SL_ENDPOINT, ims_username, ims_password, ims_yubikey, args.sl_transport, timeout=args.sl_timeout)
                 else:
                     logging.error("Error!  Can't find internal credentials or ims account.")
                     quit()
@@ -1463,8 +1717,12 @@ if __name__ == "__main__":
                 SL_ENDPOINT = "https://api.softlayer.com/xmlrpc/v3.1"
 
             # Create Classic infra API client
-            client = SoftLayer.Client(username="apikey", api_key=IC_API_KEY, endpoint_url=SL_ENDPOINT)
+            client = createClient(IC_API_KEY, SL_ENDPOINT, args.sl_transport, timeout=args.sl_timeout)
 
+        # time every classic API call for the run metrics
+        metrics.instrumentSoftLayer(client)
+        if args.hedge:
+            hedgeSoftLayer(client)
 
         """
         Retrieve Existing Account Network Storage if requested by flag
@@ -1477,19 +1735,51 @@ if __name__ == "__main__":
 
 
         #  Retrieve Invoices from classic
-        classicUsage = getInvoiceDetail(startdate, enddate)
+        if args.trend:
+            # trend workbook is built from rollups alone, detail and reconciliation tabs need line items
+            classicUsage = None
+            spool = []
+            rollup = getMonthlyRollups(startdate, enddate, args.rollups)
+            detailFlag = False
+            reconciliationFlag = False
+        elif args.streaming:
+            classicUsage = None
+            spool = getInvoiceDetailByMonth(startdate, enddate, args.rollups)
+            rollup = spool.rollup()
+            if args.save:
+                logging.warning("--save is not supported with --streaming, classicUsage.pkl not written.")
+        else:
+            fetched = datetime.now(tz.tzutc())
+            classicUsage = getInvoiceDetail(startdate, enddate)
 
-        if args.save:
-            accountUsage.to_pickle("classicUsage.pkl")
+            if args.save:
+                classicUsage.to_pickle("classicUsage.pkl")
 
+    """
+    Detail and reconciliation tabs read line items a month at a time from the spool when streaming,
+    summary tabs are built from the monthly rollups.
+    """
+    if classicUsage is None:
+        usageChunks = spool
+    else:
+        addTotalAmount(classicUsage)
+        usageChunks = [classicUsage]
+        rollup = buildRollup(classicUsage)
+        if args.rollups != None and args.load != True:
+            # an invoice created on the end cutoff belongs to the month after the range, which is incomplete here
+            lastMonth = getCFTSInvoiceDate(enddate)
+            saveRollups(args.rollups, rollup.query('IBM_Invoice_Month < @lastMonth'), fetched)
 
     """"
     Build Exel Report Report with Charges
     """
     if type2Flag:
-        createType2Report(args.output, classicUsage)
+        createType2Report(args.output, usageChunks, rollup)
     else:
-        createType1Report(args.output, classicUsage)
+        createType1Report(args.output, usageChunks, rollup)
+
+    if isinstance(usageChunks, InvoiceMonthSpool):
+        spool.close()
 
     if args.sendGridApi != None:
         sendEmail(startdate, enddate, args.sendGridTo, args.sendGridFrom, args.sendGridSubject, args.sendGridApi, args.output)
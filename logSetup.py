@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Shared logging setup for the report scripts.
+
+Handlers configured in logging.json (console and rotating file) are moved behind QueueHandlers, so threads only merge
+the message with its arguments and enqueue the record.  A single QueueListener thread takes records from one shared
+queue, in the order they were logged, and formats and writes them with the handlers of the logger they came from.
+"""
+
+import atexit, json, logging, logging.config, logging.handlers, os, queue
+
+logQueue = queue.SimpleQueue()
+listener = None
+
+
+class RoutingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which tags each record with the handlers of the logger it replaced.  The base prepare() merges the
+    message and arguments (and any traceback) on the calling thread, so later changes to the arguments are not logged.
+    """
+
+    def __init__(self, logQueue, targets):
+        super().__init__(logQueue)
+        self.targets = targets
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.targets = self.targets
+        return record
+
+
+class RoutingQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener which writes each record with the handlers it was tagged with
+    """
+
+    def handle(self, record):
+        record = self.prepare(record)
+        for handler in record.targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def queueLoggerHandlers(logger):
+    """
+    Replace the handlers of a logger with a QueueHandler feeding the shared listener thread, which owns the original
+    handlers
+    """
+    handlers = list(logger.handlers)
+    if len(handlers) == 0 or any(isinstance(handler, RoutingQueueHandler) for handler in handlers):
+        return
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(RoutingQueueHandler(logQueue, handlers))
+
+
+def stopListeners():
+    """
+    Flush queued records and stop the listener thread
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def setup_logging(default_path='logging.json', default_level=logging.INFO, env_key='LOG_CFG'):
+    # read logging.json for log parameters to be used by script
+    global listener
+    stopListeners()
+    path = default_path
+    value = os.getenv(env_key, None)
+    if value:
+        path = value
+    if os.path.exists(path):
+        with open(path, 'rt') as f:
+            config = json.load(f)
+        logging.config.dictConfig(config)
+    else:
+        logging.basicConfig(level=default_level)
+
+    queueLoggerHandlers(logging.getLogger())
+    for name in logging.Logger.manager.loggerDict:
+        logger = logging.getLogger(name)
+        if isinstance(logger, logging.Logger):
+            queueLoggerHandlers(logger)
+    listener = RoutingQueueListener(logQueue)
+    listener.start()
+
+
+atexit.register(stopListeners)
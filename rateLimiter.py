@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Process wide rate limiter shared by every thread calling the SoftLayer and IBM Cloud APIs.
+
+Each API family (SoftLayer, or an IBM Cloud service such as UsageReportsV4 or ResourceControllerV2) has a token bucket.
+A family's rate can be set with --rate-limits (ie SoftLayer=10,ResourceControllerV2=20 calls per second), and is
+unlimited otherwise.  When a call is throttled (HTTP 429, or a SoftLayer rate limit fault) the family's rate is halved,
+calls are paused for the Retry-After time if one was returned, and the call is retried up to THROTTLE_RETRIES times.
+The rate then recovers a little with each successful call, up to the configured rate.  A family without a configured
+rate keeps the rate it was throttled at as its ceiling, and is only unlimited again after UNLIMITED_AFTER seconds
+without being throttled.  Time spent waiting is recorded per family in the run metrics.
+"""
+
+import logging, threading, time
+from collections import deque
+from runMetrics import metrics
+
+# lowest rate (calls per second) a family is slowed to
+MIN_RATE = 0.5
+
+# times a throttled call is retried before the error is returned
+THROTTLE_RETRIES = 5
+
+# fraction of the family's ceiling regained per successful call
+RECOVERY = 0.05
+
+# seconds paused after a throttled call without Retry-After
+THROTTLE_PAUSE = 1.0
+
+# seconds without a throttled call after which a family with no configured rate is unlimited again
+UNLIMITED_AFTER = 600
+
+
+class TokenBucket(object):
+    """
+    Token bucket of rate calls per second (None for unlimited) with a burst of up to one second of calls
+    """
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.limit = rate
+        self.ceiling = rate
+        self.rate = rate
+        self.tokens = rate if rate != None else 0
+        self.updated = time.monotonic()
+        self.pausedUntil = 0
+        self.lastThrottled = None
+        self.recent = deque(maxlen=1000)
+
+    def acquire(self):
+        """
+        Wait for a token, returning the seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.pausedUntil - now
+                if wait <= 0:
+                    if self.rate is None:
+                        self.recent.append(now)
+                        return waited
+                    self.tokens = min(max(self.rate, 1), self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.recent.append(now)
+                        return waited
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def observedRate(self):
+        """
+        Return the calls per second made over the last second (or since the first call if more recent)
+        """
+        now = time.monotonic()
+        calls = [t for t in self.recent if t > now - 1]
+        if len(calls) == 0:
+            return 0
+        return len(calls) / max(now - calls[0], 0.1)
+
+    def throttled(self, retryAfter=None):
+        """
+        Halve the rate and pause calls after the API throttled one
+        """
+        with self.lock:
+            if self.ceiling is None:
+                # an unlimited family is capped at the rate it was throttled at
+                self.ceiling = max(1, self.observedRate())
+                self.rate = self.ceiling
+            self.rate = max(MIN_RATE, self.rate / 2)
+            # one call is let through when the pause ends, later calls wait for the lower rate
+            self.tokens = 1
+            self.updated = time.monotonic()
+            self.lastThrottled = self.updated
+            self.pausedUntil = max(self.pausedUntil, self.updated + (retryAfter if retryAfter != None else THROTTLE_PAUSE))
+            return self.rate
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate != None and self.rate < self.ceiling:
+                self.rate = min(self.ceiling, self.rate + self.ceiling * RECOVERY)
+            elif self.limit is None and self.rate != None and time.monotonic() - self.lastThrottled >= UNLIMITED_AFTER:
+                # the rate learned from throttling is kept until the API has been quiet for a while, rather than
+                # going back to unlimited calls as soon as it recovers and being throttled again
+                self.rate = None
+                self.ceiling = None
+
+
+class RateLimiter(object):
+    """
+    Token buckets by API family
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rates = {}
+        self.buckets = {}
+
+    def configure(self, rateLimits):
+        """
+        Set the rates of API families from a string of family=calls per second pairs, ie "SoftLayer=10,UsageReportsV4=5"
+        """
+        if rateLimits == None or rateLimits == "":
+            return
+        with self.lock:
+            for pair in rateLimits.split(","):
+                family, rate = pair.split("=")
+                self.rates[family.strip()] = float(rate)
+                self.buckets.pop(family.strip(), None)
+        logging.info("API rate limits {}.".format(", ".join("{}={}/s".format(family, rate) for family, rate in self.rates.items())))
+
+    def bucket(self, family):
+        with self.lock:
+            if family not in self.buckets:
+                self.buckets[family] = TokenBucket(self.rates.get(family))
+            return self.buckets[family]
+
+    def call(self, family, fn, isThrottled, retryAfter=lambda outcome: None):
+        """
+        Call fn() within the family's rate, retrying it when isThrottled(outcome) is true for its result or exception
+        """
+        bucket = self.bucket(family)
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            try:
+                outcome = fn()
+                error = None
+            except Exception as e:
+                outcome = e
+                error = e
+            throttled = isThrottled(outcome)
+            metrics.recordWait(family, waited, throttled)
+            if throttled and attempt < THROTTLE_RETRIES:
+                attempt += 1
+                rate = bucket.throttled(retryAfter(outcome))
+                logging.warning("{} throttled, retry {} of {} at {:.1f} calls/s.".format(family, attempt, THROTTLE_RETRIES, rate))
+                if hasattr(outcome, "close"):
+                    outcome.close()
+                continue
+            if not throttled:
+                bucket.succeeded()
+            if error is not None:
+                raise error
+            return outcome
+
+
+limiter = RateLimiter()
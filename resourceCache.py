@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Persistent cache of resource controller instances, tags and catalog names shared by the usage scripts.
+
+Instances and tags are stored by CRN in a SQLite file with the time each entry was fetched.  Active instances are
+refreshed incrementally with updated_from, and fully reloaded once the resource TTL has passed, when instances no
+longer listed are dropped.  Lookups of deleted
+or inaccessible instances are kept, so they are not requested again on the next run.  Point --resource-cache (or the
+resource_cache environment variable) of each script at the same file to share it.
+"""
+
+import json, logging, sqlite3, threading, time
+
+# seconds before the active instances are fully reloaded rather than refreshed with updated_from
+RESOURCE_TTL = 7 * 86400
+
+# seconds before the tag search is run again
+TAG_TTL = 86400
+
+# seconds an instance lookup which returned 403 or 404 is remembered
+MISSING_TTL = 86400
+
+# seconds a service or plan name from the global catalog is kept
+CATALOG_TTL = 7 * 86400
+
+
+class ResourceCache(object):
+    """
+    SQLite store of resource instances and tags keyed by CRN, and of catalog names keyed by catalog id
+    """
+
+    def __init__(self, path, resourceTTL=RESOURCE_TTL, tagTTL=TAG_TTL, missingTTL=MISSING_TTL, catalogTTL=CATALOG_TTL):
+        self.path = path
+        self.resourceTTL = resourceTTL
+        self.tagTTL = tagTTL
+        self.missingTTL = missingTTL
+        self.catalogTTL = catalogTTL
+        self.loaded = set()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS resources (crn TEXT PRIMARY KEY, record TEXT NOT NULL, updated_at TEXT, fetched REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tags (crn TEXT PRIMARY KEY, tags TEXT NOT NULL, fetched REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS refresh (name TEXT PRIMARY KEY, fetched REAL NOT NULL, watermark TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS catalog (id TEXT PRIMARY KEY, name TEXT NOT NULL, fetched REAL NOT NULL)")
+
+    def getRefresh(self, name):
+        """
+        Return (time of last full refresh, watermark) for a table, or None if never refreshed
+        """
+        with self.lock:
+            return self.db.execute("SELECT fetched, watermark FROM refresh WHERE name = ?", (name,)).fetchone()
+
+    def setRefresh(self, name, fetched, watermark):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO refresh (name, fetched, watermark) VALUES (?, ?, ?)", (name, fetched, watermark))
+
+    def saveResources(self, resources):
+        """
+        Insert or replace resource instances, resources is a dict of CRN to resource record ({} for a 403/404 lookup)
+        """
+        now = time.time()
+        rows = [(crn, json.dumps(record), record.get("updated_at"), now) for crn, record in resources.items()]
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO resources (crn, record, updated_at, fetched) VALUES (?, ?, ?, ?)", rows)
+        self.loaded.update(resources)
+
+    def loadResources(self):
+        """
+        Return a dict of CRN to resource record.  Expired 403/404 lookups are left out so they are looked up again.
+        """
+        expired = time.time() - self.missingTTL
+        resource_cache = {}
+        with self.lock:
+            for crn, record, fetched in self.db.execute("SELECT crn, record, fetched FROM resources"):
+                if record == "{}" and fetched < expired:
+                    continue
+                resource_cache[crn] = json.loads(record)
+        self.loaded = set(resource_cache)
+        return resource_cache
+
+    def refreshResources(self, listResources):
+        """
+        Bring the stored resource instances up to date and return them as a dict of CRN to resource record.
+        listResources(updated_from, state) returns a dict of CRN to resource record from the resource controller.
+        """
+        now = time.time()
+        refresh = self.getRefresh("resources")
+        if refresh is None or now - refresh[0] > self.resourceTTL:
+            logging.info("Resource cache {} full refresh.".format(self.path))
+            changed = listResources()
+            self.pruneResources(changed, now)
+            fetched = now
+            watermark = None
+        else:
+            fetched, watermark = refresh
+            logging.info("Resource cache {} refreshing instances updated since {}.".format(self.path, watermark))
+            changed = listResources(updated_from=watermark)
+            # instances deleted since the last refresh
+            changed.update(listResources(updated_from=watermark, state="removed"))
+        updated = [record["updated_at"] for record in changed.values() if record.get("updated_at")]
+        if len(updated) > 0:
+            watermark = max(updated + ([watermark] if watermark else []))
+        elif watermark is None:
+            watermark = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+        self.saveResources(changed)
+        self.setRefresh("resources", fetched, watermark)
+        logging.info("Resource cache {} refreshed {} instances.".format(self.path, len(changed)))
+        return self.loadResources()
+
+    def pruneResources(self, listed, now):
+        """
+        Delete stored instances missing from a full listing.  Instances stored as active have since been deleted or
+        purged.  Deleted instances (and 403/404 lookups) fetched more than the resource TTL ago are dropped too, so they
+        are looked up again when usage refers to them, and a purged instance is then stored as a 404.
+        """
+        expired = now - self.resourceTTL
+        with self.lock, self.db:
+            stale = [(crn,) for crn, record, fetched in self.db.execute("SELECT crn, record, fetched FROM resources")
+                     if crn not in listed and (fetched < expired or json.loads(record).get("state", "removed") != "removed")]
+            self.db.executemany("DELETE FROM resources WHERE crn = ?", stale)
+        if len(stale) > 0:
+            logging.info("Resource cache {} dropped {} instances no longer listed.".format(self.path, len(stale)))
+
+    def saveLookups(self, resource_cache):
+        """
+        Store instances looked up individually during the run (deleted, reclaimed or inaccessible instances)
+        """
+        lookups = {crn: record for crn, record in resource_cache.items() if crn not in self.loaded}
+        if len(lookups) > 0:
+            self.saveResources(lookups)
+            logging.info("Resource cache {} saved {} instance lookups.".format(self.path, len(lookups)))
+
+    def refreshTags(self, searchTags):
+        """
+        Return a dict of CRN to tags, running searchTags() to replace the stored tags once the tag TTL has passed
+        """
+        now = time.time()
+        refresh = self.getRefresh("tags")
+        if refresh is not None and now - refresh[0] <= self.tagTTL:
+            with self.lock:
+                tag_cache = {crn: json.loads(tags) for crn, tags in self.db.execute("SELECT crn, tags FROM tags")}
+            logging.info("Using {} cached tags from {}.".format(len(tag_cache), self.path))
+            return tag_cache
+        tag_cache = searchTags()
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM tags")
+            self.db.executemany("INSERT INTO tags (crn, tags, fetched) VALUES (?, ?, ?)",
+                                [(crn, json.dumps(tags), now) for crn, tags in tag_cache.items()])
+        self.setRefresh("tags", now, None)
+        return tag_cache
+
+    def loadCatalog(self):
+        """
+        Return a dict of catalog id to service or plan name, leaving out names older than the catalog TTL
+        """
+        expired = time.time() - self.catalogTTL
+        with self.lock:
+            return {catalogId: name for catalogId, name in self.db.execute("SELECT id, name FROM catalog WHERE fetched >= ?", (expired,))}
+
+    def saveCatalog(self, names):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO catalog (id, name, fetched) VALUES (?, ?, ?)",
+                                [(catalogId, name, now) for catalogId, name in names.items()])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
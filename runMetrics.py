@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Run instrumentation shared by the report scripts.
+
+Records wall time and peak memory per phase, call counts, latency histograms and bytes received per API method,
+time spent waiting for rate limits per API family, hedged calls, and rows produced.  Results are written as JSON with --metrics-out, and --profile dumps cProfile stats for the run.
+"""
+
+import atexit, cProfile, functools, json, logging, sys, threading, time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from ibm_cloud_sdk_core import BaseService
+
+try:
+    import resource
+except ImportError:
+    # resource module is not available on Windows, peak memory is not reported there.
+    resource = None
+
+# upper bounds (seconds) of the API latency histogram buckets
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# number of recent latencies kept per API method for percentiles
+LATENCY_SAMPLES = 1000
+
+
+def peakMemoryMB():
+    """
+    Return peak resident memory of this process in MB
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # macOS reports bytes, Linux reports KB
+        return round(peak / 1048576, 1)
+    return round(peak / 1024, 1)
+
+
+def percentile(samples, pct):
+    """
+    Return the pct percentile of a list of samples
+    """
+    if len(samples) == 0:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class RunMetrics(object):
+    """
+    Collect phase, API and row metrics for a single script run
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.perf_counter()
+        self.startTime = datetime.now()
+        self.phases = {}
+        self.api = {}
+        self.rows = {}
+        self.waits = {}
+        self.hedges = {}
+        self.profiler = None
+        self.metricsOut = None
+        self.profileOut = None
+
+    def enable(self, metricsOut=None, profileOut=None):
+        """
+        Start profiling if requested and write the report when the process exits (including quit() on errors)
+        """
+        self.metricsOut = metricsOut
+        self.profileOut = profileOut
+        if profileOut is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if metricsOut is not None or profileOut is not None:
+            atexit.register(self.finish)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the run.  Phases entered more than once accumulate.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak = peakMemoryMB()
+            with self.lock:
+                phase = self.phases.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "peak_rss_mb": None})
+                phase["calls"] += 1
+                phase["wall_seconds"] += elapsed
+                if peak is not None and (phase["peak_rss_mb"] is None or peak > phase["peak_rss_mb"]):
+                    phase["peak_rss_mb"] = peak
+
+    def timed(self, name=None):
+        """
+        Decorator which records each call of a function as a phase (default phase name is the function name)
+        """
+        def decorator(fn):
+            phaseName = name or fn.__name__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.phase(phaseName):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def addRows(self, name, count):
+        """
+        Count rows produced by a stage of the run
+        """
+        with self.lock:
+            self.rows[name] = self.rows.get(name, 0) + int(count)
+
+    def recordCall(self, api, method, seconds, nbytes=0, error=False):
+        """
+        Record latency and bytes received for one API call
+        """
+        key = "{}::{}".format(api, method)
+        with self.lock:
+            stats = self.api.get(key)
+            if stats is None:
+                stats = {"calls": 0, "errors": 0, "seconds": 0.0, "bytes": 0,
+                         "histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+                         "samples": deque(maxlen=LATENCY_SAMPLES)}
+                self.api[key] = stats
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["bytes"] += nbytes
+            if error:
+                stats["errors"] += 1
+            bucket = len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    bucket = i
+                    break
+            stats["histogram"][bucket] += 1
+            stats["samples"].append(seconds)
+
+    def recordWait(self, family, seconds, throttled=False):
+        """
+        Record the time a call waited for the rate limiter of its API family, and whether it was throttled
+        """
+        with self.lock:
+            waits = self.waits.setdefault(family, {"calls": 0, "waited": 0, "seconds": 0.0, "max_seconds": 0.0, "throttled": 0})
+            waits["calls"] += 1
+            if seconds > 0:
+                waits["waited"] += 1
+                waits["seconds"] += seconds
+                waits["max_seconds"] = max(waits["max_seconds"], seconds)
+            if throttled:
+                waits["throttled"] += 1
+
+    def recordHedge(self, method, winner, saved=0.0):
+        """
+        Record a hedged call, the copy which answered first (primary, hedge or failed) and seconds saved by the hedge
+        """
+        with self.lock:
+            hedges = self.hedges.setdefault(method, {"hedged": 0, "primary": 0, "hedge": 0, "failed": 0, "saved_seconds": 0.0})
+            hedges["hedged"] += 1
+            hedges[winner] += 1
+            hedges["saved_seconds"] += saved
+
+    def callCount(self, api, method):
+        """
+        Return the number of calls timed so far for an API method
+        """
+        with self.lock:
+            stats = self.api.get("{}::{}".format(api, method))
+            return 0 if stats is None else stats["calls"]
+
+    def latencyPercentile(self, api, method, pct):
+        """
+        Return the pct percentile latency observed so far for an API method, None if no calls yet
+        """
+        with self.lock:
+            stats = self.api.get("{}::{}".format(api, method))
+            if stats is None:
+                return None
+            samples = list(stats["samples"])
+        return percentile(samples, pct)
+
+    def _countBytes(self, response, *args, **kwargs):
+        """
+        requests response hook, adds the size of the response body to the call in progress on this thread
+        """
+        self.local.bytes = getattr(self.local, "bytes", 0) + len(response.content)
+
+    def _hookSession(self, session):
+        if session is not None and self._countBytes not in session.hooks["response"]:
+            session.hooks["response"].append(self._countBytes)
+
+    def _timedCall(self, api, method, fn, *args, **kwargs):
+        self.local.bytes = 0
+        start = time.perf_counter()
+        error = False
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.recordCall(api, method, time.perf_counter() - start, self.local.bytes, error)
+
+    def instrumentService(self, service, api):
+        """
+        Wrap an IBM Cloud SDK service client so each operation is timed under its method name
+        """
+        self._hookSession(service.get_http_client())
+        return InstrumentedService(service, api, self)
+
+    def instrumentSoftLayer(self, client):
+        """
+        Replace the transport of a SoftLayer client with one that times each Service::method call
+        """
+        if not isinstance(client.transport, InstrumentedTransport):
+            self._hookSession(getattr(client.transport, "client", None))
+            client.transport = InstrumentedTransport(client.transport, self)
+        return client
+
+    def report(self):
+        """
+        Return the collected metrics as a dict
+        """
+        with self.lock:
+            api = {}
+            for key, stats in sorted(self.api.items()):
+                samples = list(stats["samples"])
+                histogram = {}
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    histogram["le_{}".format(bound)] = stats["histogram"][i]
+                histogram["gt_{}".format(LATENCY_BUCKETS[-1])] = stats["histogram"][-1]
+                api[key] = {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "total_seconds": round(stats["seconds"], 4),
+                    "mean_seconds": round(stats["seconds"] / stats["calls"], 4),
+                    "p50_seconds": round(percentile(samples, 50), 4),
+                    "p90_seconds": round(percentile(samples, 90), 4),
+                    "p99_seconds": round(percentile(samples, 99), 4),
+                    "bytes": stats["bytes"],
+                    "histogram": histogram
+                }
+            rateLimits = {}
+            for family, waits in sorted(self.waits.items()):
+                rateLimits[family] = {"calls": waits["calls"], "waited": waits["waited"], "wait_seconds": round(waits["seconds"], 4),
+                                      "max_wait_seconds": round(waits["max_seconds"], 4), "throttled": waits["throttled"]}
+            hedging = {}
+            for method, hedges in sorted(self.hedges.items()):
+                hedging[method] = {"hedged": hedges["hedged"], "primary_won": hedges["primary"], "hedge_won": hedges["hedge"],
+                                   "both_failed": hedges["failed"], "saved_seconds": round(hedges["saved_seconds"], 4)}
+            phases = {}
+            for name, phase in self.phases.items():
+                phases[name] = {"calls": phase["calls"], "wall_seconds": round(phase["wall_seconds"], 4),
+                                "peak_rss_mb": phase["peak_rss_mb"]}
+            return {
+                "script": sys.argv[0],
+                "started": self.startTime.isoformat(timespec="seconds"),
+                "wall_seconds": round(time.perf_counter() - self.started, 4),
+                "peak_rss_mb": peakMemoryMB(),
+                "phases": phases,
+                "api": api,
+                "rate_limits": rateLimits,
+                "hedging": hedging,
+                "rows": dict(self.rows)
+            }
+
+    def finish(self):
+        """
+        Stop the profiler and write metrics and profile output
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profileOut)
+            logging.info("Profile written to {}.".format(self.profileOut))
+            self.profiler = None
+        if self.metricsOut is not None:
+            with open(self.metricsOut, "w") as f:
+                json.dump(self.report(), f, indent=2)
+            logging.info("Run metrics written to {}.".format(self.metricsOut))
+            self.metricsOut = None
+
+
+class InstrumentedService(object):
+    """
+    Proxy for an IBM Cloud SDK service which times every operation call
+    """
+
+    def __init__(self, service, api, metrics):
+        self._service = service
+        self._api = api
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._service, name)
+        # only service operations are timed, BaseService plumbing (set_http_client, send, ...) passes through
+        if name.startswith("_") or not callable(attr) or hasattr(BaseService, name):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._metrics._timedCall(self._api, name, attr, *args, **kwargs)
+        return call
+
+
+class InstrumentedTransport(object):
+    """
+    SoftLayer transport wrapper which times every API call
+    """
+
+    def __init__(self, transport, metrics):
+        self.transport = transport
+        self.metrics = metrics
+
+    def __call__(self, call):
+        return self.metrics._timedCall("SoftLayer", "{}::{}".format(call.service, call.method), self.transport, call)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+class ProgressReporter(object):
+    """
+    Rate limited progress log for long loops.  Logs items/sec, ETA and the item currently being worked on
+    at most once per interval instead of a log line per row.
+    """
+
+    def __init__(self, label, total=0, interval=10):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.count = 0
+        self.current = ""
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.lastReport = self.started
+
+    def addTotal(self, count):
+        """
+        Increase the expected total when it is only known as the work is discovered (ie per month or page)
+        """
+        with self.lock:
+            self.total += count
+
+    def update(self, count=1, current=None):
+        """
+        Record completed items and log progress if the interval has passed
+        """
+        with self.lock:
+            self.count += count
+            if current is not None:
+                self.current = current
+            now = time.monotonic()
+            if now - self.lastReport < self.interval:
+                return
+            self.lastReport = now
+        self.log(now)
+
+    def log(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.started
+        rate = self.count / elapsed if elapsed > 0 else 0
+        if self.total > self.count and rate > 0:
+            eta = "{:.0f}s".format((self.total - self.count) / rate)
+        else:
+            eta = "-"
+        logging.info("%s: %s of %s (%.1f/sec, ETA %s) %s", self.label, self.count, self.total or "?", rate, eta, self.current)
+
+    def finish(self):
+        """
+        Log the final count and rate
+        """
+        elapsed = time.monotonic() - self.started
+        rate = self.count / elapsed if elapsed > 0 else 0
+        logging.info("%s: completed %s in %.1fs (%.1f/sec).", self.label, self.count, elapsed, rate)
+
+
+# process wide metrics shared by all modules of a run
+metrics = RunMetrics()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+SoftLayer client factory shared by the classic infrastructure scripts.
+
+The SoftLayer package's own transport has no timeout, a pool of 10 connections and only retries https.  Clients
+created here use a keep-alive pool of poolSize connections (safe to share between fetch threads), a connect and read
+timeout, and retry connection errors and 5xx responses with backoff.  Calls are made within the SoftLayer rate limit,
+and throttled calls (429 or a rate limit fault) are retried by the rate limiter (rateLimiter.py).  The XML-RPC (default) or REST transport can
+be chosen; REST returns JSON, which is quicker to parse for large pages
+(see benchmarks/softlayerTransportBenchmark.py).
+"""
+
+import logging
+import requests
+import SoftLayer
+from SoftLayer import consts, transports
+from requests.adapters import HTTPAdapter
+from rateLimiter import limiter
+from httpSessions import CountedRetry
+
+TRANSPORTS = ["xmlrpc", "rest"]
+
+# connections kept open to the API, at least the number of threads calling it
+POOL_SIZE = 10
+
+# seconds to connect, and to wait for a response (pages of invoice items with large masks can take minutes)
+CONNECT_TIMEOUT = 10
+TIMEOUT = 300
+
+RETRIES = 3
+
+RETRY_STATUS = [500, 502, 503, 504]
+
+
+def createSession(poolSize=POOL_SIZE, retries=RETRIES, userAgent=consts.USER_AGENT):
+    """
+    Return a requests Session for the SoftLayer API with a pool of poolSize keep-alive connections, retrying
+    connection errors and 5xx responses
+    """
+    # SoftLayer calls are POSTs with XML-RPC, the reports only read, so all methods are retried
+    retry = CountedRetry(total=retries, connect=retries, backoff_factor=1, status_forcelist=RETRY_STATUS, allowed_methods=None,
+                         respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=poolSize, max_retries=retry, pool_block=True)
+    session = requests.Session()
+    session.headers.update({'Content-Type': 'application/json', 'User-Agent': userAgent})
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def isThrottled(outcome):
+    """
+    Return True for a SoftLayer error raised because calls were throttled
+    """
+    if not isinstance(outcome, SoftLayer.SoftLayerAPIError):
+        return False
+    fault = str(outcome.faultString).lower()
+    return outcome.faultCode == 429 or "ratelimit" in fault or "rate limit" in fault or "too many requests" in fault
+
+
+class LimitedTransport(object):
+    """
+    SoftLayer transport wrapper which makes each call within the SoftLayer rate limit
+    """
+
+    def __init__(self, transport, family="SoftLayer"):
+        self.transport = transport
+        self.family = family
+
+    def __call__(self, call):
+        return limiter.call(self.family, lambda: self.transport(call), isThrottled)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+def endpointFor(endpointUrl, transport):
+    """
+    Return the endpoint of the transport for an XML-RPC (or REST) endpoint url
+    """
+    if transport == "rest":
+        return endpointUrl.replace("/xmlrpc", "/rest")
+    return endpointUrl.replace("/rest", "/xmlrpc")
+
+def createTransport(endpointUrl, transport="xmlrpc", poolSize=POOL_SIZE, timeout=TIMEOUT):
+    """
+    Return a SoftLayer XML-RPC or REST transport using a pooled, retrying, rate limited session
+    """
+    if transport not in TRANSPORTS:
+        raise ValueError("transport must be one of {}".format(", ".join(TRANSPORTS)))
+    endpointUrl = endpointFor(endpointUrl, transport)
+    if transport == "rest":
+        slTransport = transports.RestTransport(endpoint_url=endpointUrl)
+    else:
+        slTransport = transports.XmlRpcTransport(endpoint_url=endpointUrl)
+    # the transports pass timeout straight to requests, which accepts (connect, read)
+    slTransport.timeout = (CONNECT_TIMEOUT, timeout)
+    slTransport._client = createSession(poolSize, userAgent=slTransport.user_agent)
+    logging.debug("SoftLayer {} transport {} with pool {} and timeout {}s.".format(transport, endpointUrl, poolSize, timeout))
+    return LimitedTransport(slTransport)
+
+def createClient(apikey, endpointUrl=consts.API_PUBLIC_ENDPOINT, transport="xmlrpc", poolSize=POOL_SIZE, timeout=TIMEOUT):
+    """
+    Return a SoftLayer client for an IBM Cloud API key
+    """
+    return SoftLayer.create_client_from_env(username="apikey", api_key=apikey, endpoint_url=endpointUrl,
+                                            transport=createTransport(endpointUrl, transport, poolSize, timeout))
+
+def createEmployeeClient(end_point_employee, employee_user, passw, token, transport="xmlrpc", poolSize=POOL_SIZE, timeout=TIMEOUT):
+    """Creates a softlayer-python client that can make API requests for a given employee_user"""
+    client_noauth = SoftLayer.Client(endpoint_url=end_point_employee)
+    client_noauth.auth = None
+    employee = client_noauth['SoftLayer_User_Employee']
+    result = employee.performExternalAuthentication(employee_user, passw, token)
+    # Save result['hash'] somewhere to not have to login for every API request
+    client_employee = SoftLayer.employee_client(username=employee_user, access_token=result['hash'], endpoint_url=end_point_employee,
+                                                transport=createTransport(end_point_employee, transport, poolSize, timeout))
+    return client_employee
@@ -0,0 +1,140 @@
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Hedger deadlines and budget, using a stand-in for the SoftLayer transport.
+"""
+
+import threading, time
+import pytest
+from SoftLayer.transports import Request
+import hedging, rateLimiter
+from hedging import Hedger, HedgedTransport
+from runMetrics import metrics
+
+METHOD = "SoftLayer_Account::getHardware"
+
+
+@pytest.fixture(autouse=True)
+def hedgingState(monkeypatch):
+    monkeypatch.setattr(hedging, "MIN_DEADLINE", 0.05)
+    monkeypatch.setattr(hedging, "limiter", rateLimiter.RateLimiter())
+    metrics.api.pop("SoftLayer::" + METHOD, None)
+    metrics.hedges.clear()
+
+
+def timedCalls(count=10, seconds=0.01):
+    for _ in range(count):
+        metrics.recordCall("SoftLayer", METHOD, seconds)
+
+
+class SlowFirstCall(object):
+    """
+    Transport whose first call takes slow seconds, later calls return at once
+    """
+
+    def __init__(self, slow=1.0):
+        self.slow = slow
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        with self.lock:
+            self.calls += 1
+            first = self.calls == 1
+        if first:
+            time.sleep(self.slow)
+            return "primary"
+        return "hedge"
+
+
+def request():
+    call = Request()
+    call.service = "SoftLayer_Account"
+    call.method = "getHardware"
+    call.headers = {}
+    call.transport_headers = {}
+    return call
+
+
+def test_slow_call_hedged():
+    timedCalls()
+    transport = SlowFirstCall(slow=0.5)
+    start = time.perf_counter()
+    assert Hedger(budget=1.0).call(METHOD, transport, request()) == "hedge"
+    assert time.perf_counter() - start < 0.3
+    assert transport.calls == 2
+    # the win is recorded once the original call returns, with the seconds saved
+    time.sleep(0.5)
+    assert metrics.hedges[METHOD]["hedge"] == 1
+    assert metrics.hedges[METHOD]["saved_seconds"] > 0.1
+
+
+def test_quick_call_not_hedged():
+    timedCalls()
+    transport = SlowFirstCall(slow=0)
+    assert Hedger(budget=1.0).call(METHOD, transport, request()) == "primary"
+    assert transport.calls == 1
+
+
+def test_not_hedged_before_samples():
+    timedCalls(hedging.MIN_SAMPLES - 1)
+    transport = SlowFirstCall(slow=0.2)
+    assert Hedger(budget=1.0).call(METHOD, transport, request()) == "primary"
+    assert transport.calls == 1
+
+
+def test_budget():
+    timedCalls()
+    hedger = Hedger(budget=0.5)
+    results = [hedger.call(METHOD, SlowFirstCall(slow=0.2), request()) for _ in range(4)]
+    # a hedge is only sent while hedges stay within half of the calls made
+    assert results == ["primary", "hedge", "primary", "hedge"]
+    assert hedger.hedges == 2
+
+
+def test_not_hedged_while_throttled():
+    timedCalls()
+    hedging.limiter.configure("SoftLayer=10")
+    hedging.limiter.bucket("SoftLayer").throttled(retryAfter=0)
+    transport = SlowFirstCall(slow=0.2)
+    assert Hedger(budget=1.0).call(METHOD, transport, request()) == "primary"
+    assert transport.calls == 1
+
+
+def test_both_failed():
+    timedCalls()
+
+    def failing(call):
+        time.sleep(0.1)
+        raise RuntimeError("failed")
+    with pytest.raises(RuntimeError):
+        Hedger(budget=1.0).call(METHOD, failing, request())
+    assert metrics.hedges[METHOD]["failed"] == 1
+
+
+def test_transport_only_hedges_reads():
+    timedCalls()
+    transport = SlowFirstCall(slow=0.2)
+    hedged = HedgedTransport(transport, Hedger(budget=1.0))
+    call = request()
+    call.method = "editObject"
+    assert hedged(call) == "primary"
+    assert transport.calls == 1
+
+
+def test_duplicate_request():
+    call = request()
+    duplicate = hedging.duplicateRequest(call)
+    duplicate.headers["added"] = 1
+    assert call.headers == {}
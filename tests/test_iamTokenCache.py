@@ -0,0 +1,95 @@
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+CachedIAMTokenManager saving tokens to the cache file and reusing them, with the token requests stubbed.
+"""
+
+import json, os, stat, time
+import jwt
+import pytest
+import iamTokenCache
+from iamTokenCache import CachedIAMTokenManager
+
+
+def token(lifetime=3600):
+    now = int(time.time())
+    return jwt.encode({"iat": now, "exp": now + lifetime, "sub": "test"}, "secret", algorithm="HS256")
+
+
+class StubTokenManager(CachedIAMTokenManager):
+    """
+    Token manager which counts token requests instead of calling IAM
+    """
+
+    lifetime = 3600
+
+    def request_token(self):
+        self.requests = getattr(self, "requests", 0) + 1
+        return {"access_token": token(self.lifetime), "refresh_token": "refresh", "token_type": "Bearer",
+                "expires_in": self.lifetime, "expiration": int(time.time()) + self.lifetime}
+
+
+def test_token_reused(tmp_path):
+    cachePath = str(tmp_path / "token.json")
+    first = StubTokenManager("apikey", cachePath)
+    accessToken = first.get_token()
+    assert first.requests == 1
+    assert stat.S_IMODE(os.stat(cachePath).st_mode) == 0o600
+    second = StubTokenManager("apikey", cachePath)
+    assert second.get_token() == accessToken
+    assert getattr(second, "requests", 0) == 0
+
+
+def test_tokens_by_apikey(tmp_path):
+    cachePath = str(tmp_path / "token.json")
+    StubTokenManager("apikey", cachePath).get_token()
+    other = StubTokenManager("other apikey", cachePath)
+    other.get_token()
+    assert other.requests == 1
+    with open(cachePath) as f:
+        assert len(json.load(f)) == 2
+
+
+def test_refreshed_ahead_of_expiry(tmp_path):
+    cachePath = str(tmp_path / "token.json")
+    manager = StubTokenManager("apikey", cachePath)
+    manager.get_token()
+    assert manager.refresh_time <= manager.expire_time - iamTokenCache.REFRESH_AHEAD
+    # a cached token too close to expiry is not used
+    StubTokenManager.lifetime = iamTokenCache.REFRESH_AHEAD - 60
+    try:
+        short = StubTokenManager("short apikey", cachePath)
+        short.get_token()
+        again = StubTokenManager("short apikey", cachePath)
+        assert again.access_token is None
+        assert not again.loadToken()
+    finally:
+        StubTokenManager.lifetime = 3600
+
+
+@pytest.mark.skipif(os.name != "posix", reason="file modes")
+def test_shared_cache_ignored(tmp_path):
+    cachePath = str(tmp_path / "token.json")
+    StubTokenManager("apikey", cachePath).get_token()
+    os.chmod(cachePath, 0o644)
+    manager = StubTokenManager("apikey", cachePath)
+    manager.get_token()
+    assert manager.requests == 1
+
+
+def test_no_cache_file():
+    manager = StubTokenManager("apikey")
+    manager.get_token()
+    manager.get_token()
+    assert manager.requests == 1
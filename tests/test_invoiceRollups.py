@@ -0,0 +1,115 @@
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Monthly invoice rollups: folding line items, the rollup store, and the month spool.
+"""
+
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from dateutil import tz
+import invoiceAnalysis
+from invoiceAnalysis import buildRollup, saveRollups, loadRollup, InvoiceMonthSpool, rollupKeys, rollupValues
+
+
+@pytest.fixture(autouse=True)
+def flags(monkeypatch):
+    monkeypatch.setattr(invoiceAnalysis, "storageFlag", False, raising=False)
+
+
+def lineItems(months=("2023-01", "2023-02"), items=40):
+    rng = np.random.default_rng(1)
+    rows = []
+    for month in months:
+        for i in range(items):
+            child = i % 3 == 0
+            rows.append({"IBM_Invoice_Month": month, "Type": ["NEW", "RECURRING"][i % 2], "RecordType": "Child" if child else "Parent",
+                         "TaxCategory": "IaaS", "Category_Group": "Compute", "Category": "Server", "Description": "server {}".format(i % 4),
+                         "OS": "", "location": ["Dallas 10", "London 2"][i % 2], "Hourly": i % 4 == 0,
+                         "childParentProduct": "parent" if child else np.nan, "INV_PRODID": "", "billing_notes": "",
+                         "storage_notes": "", "totalRecurringCharge": 0.0 if child else float(rng.integers(1, 100)),
+                         "childTotalRecurringCharge": float(rng.integers(1, 100)) if child else 0.0,
+                         "totalOneTimeAmount": float(rng.integers(0, 3)), "Hours": int(rng.integers(0, 700))})
+    return invoiceAnalysis.addTotalAmount(pd.DataFrame(rows))
+
+
+def test_rollup_totals():
+    items = lineItems()
+    rollup = buildRollup(items)
+    assert rollup["Count"].sum() == len(items)
+    for value in rollupValues:
+        assert rollup[value].sum() == pytest.approx(items[value].sum())
+    # missing keys (childParentProduct of parents) are kept as their own group
+    assert rollup["childParentProduct"].isna().any()
+    monthly = rollup.groupby("IBM_Invoice_Month")["totalAmount"].sum()
+    assert monthly.to_dict() == pytest.approx(items.groupby("IBM_Invoice_Month")["totalAmount"].sum().to_dict())
+
+
+def test_one_row_per_key():
+    items = lineItems()
+    rollup = buildRollup(items)
+    keys = [key for key in rollupKeys if key in items.columns]
+    assert len(rollup) == len(items[keys].drop_duplicates())
+
+
+def test_saved_rollup_reused(tmp_path):
+    rollup = buildRollup(lineItems())
+    monthEnd = datetime(2023, 1, 20, tzinfo=tz.tzutc())
+    saveRollups(str(tmp_path), rollup, datetime(2023, 1, 25, tzinfo=tz.tzutc()))
+    assert sorted(os.listdir(tmp_path)) == ["rollup_2023-01.pkl", "rollup_2023-02.pkl"]
+    january = loadRollup(str(tmp_path), "2023-01", monthEnd)
+    pd.testing.assert_frame_equal(january, rollup[rollup["IBM_Invoice_Month"] == "2023-01"].reset_index(drop=True))
+
+
+def test_open_month_not_reused(tmp_path):
+    rollup = buildRollup(lineItems())
+    saveRollups(str(tmp_path), rollup, datetime(2023, 1, 15, tzinfo=tz.tzutc()))
+    # fetched before the month's cutoff, the month may have changed since
+    assert loadRollup(str(tmp_path), "2023-01", datetime(2023, 1, 20, tzinfo=tz.tzutc())) is None
+    assert loadRollup(str(tmp_path), "2023-03", datetime(2023, 3, 20, tzinfo=tz.tzutc())) is None
+
+
+def test_fetched_time_kept_when_copied(tmp_path):
+    rollup = buildRollup(lineItems())
+    saveRollups(str(tmp_path), rollup, datetime(2023, 1, 15, tzinfo=tz.tzutc()))
+    # a copy of the store has a new modification time, the fetch time in the rollup still says the month was open
+    path = os.path.join(str(tmp_path), "rollup_2023-01.pkl")
+    os.utime(path, (datetime(2023, 6, 1).timestamp(), datetime(2023, 6, 1).timestamp()))
+    assert loadRollup(str(tmp_path), "2023-01", datetime(2023, 1, 20, tzinfo=tz.tzutc())) is None
+
+
+def test_storage_rollup_needed(tmp_path, monkeypatch):
+    rollup = buildRollup(lineItems().drop(columns="storage_notes"))
+    saveRollups(str(tmp_path), rollup, datetime(2023, 3, 1, tzinfo=tz.tzutc()))
+    monthEnd = datetime(2023, 1, 20, tzinfo=tz.tzutc())
+    assert loadRollup(str(tmp_path), "2023-01", monthEnd) is not None
+    monkeypatch.setattr(invoiceAnalysis, "storageFlag", True)
+    assert loadRollup(str(tmp_path), "2023-01", monthEnd) is None
+
+
+def test_spool():
+    items = lineItems()
+    spool = InvoiceMonthSpool()
+    try:
+        for month, monthItems in items.groupby("IBM_Invoice_Month"):
+            spool.add(month, monthItems.copy())
+        chunks = list(spool)
+        assert [len(chunk) for chunk in chunks] == [40, 40]
+        # rows are numbered across months as one DataFrame would be
+        assert pd.concat(chunks).index.tolist() == list(range(len(items)))
+        pd.testing.assert_frame_equal(spool.rollup(), buildRollup(items))
+    finally:
+        spool.close()
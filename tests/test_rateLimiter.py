@@ -0,0 +1,117 @@
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+TokenBucket rates, slowing down when throttled and recovering, and RateLimiter retries.
+"""
+
+import time
+import pytest
+import rateLimiter
+from rateLimiter import RateLimiter, TokenBucket
+
+
+def test_unlimited():
+    bucket = TokenBucket()
+    assert sum(bucket.acquire() for _ in range(1000)) == 0
+
+
+def test_rate():
+    bucket = TokenBucket(20)
+    start = time.monotonic()
+    for _ in range(30):
+        bucket.acquire()
+    # a burst of one second of calls, then 20 a second
+    assert time.monotonic() - start == pytest.approx(0.5, abs=0.15)
+
+
+def test_throttled_and_recovered(monkeypatch):
+    monkeypatch.setattr(rateLimiter, "RECOVERY", 0.25)
+    bucket = TokenBucket(8)
+    assert bucket.throttled(retryAfter=0) == 4
+    assert bucket.throttled(retryAfter=0) == 2
+    bucket.succeeded()
+    assert bucket.rate == 4
+    for _ in range(10):
+        bucket.succeeded()
+    assert bucket.rate == 8
+
+
+def test_throttled_pause():
+    bucket = TokenBucket(100)
+    bucket.throttled(retryAfter=0.3)
+    assert bucket.acquire() == pytest.approx(0.3, abs=0.1)
+
+
+def test_min_rate():
+    bucket = TokenBucket(1)
+    for _ in range(5):
+        bucket.throttled(retryAfter=0)
+    assert bucket.rate == rateLimiter.MIN_RATE
+
+
+def test_unlimited_learns_ceiling(monkeypatch):
+    bucket = TokenBucket()
+    for _ in range(10):
+        bucket.acquire()
+    bucket.throttled(retryAfter=0)
+    ceiling = bucket.ceiling
+    assert ceiling >= 1 and bucket.rate == max(rateLimiter.MIN_RATE, ceiling / 2)
+    for _ in range(100):
+        bucket.succeeded()
+    # recovered to the learned ceiling, which is kept until the API has been quiet for UNLIMITED_AFTER
+    assert bucket.rate == ceiling and bucket.ceiling == ceiling
+    monkeypatch.setattr(rateLimiter, "UNLIMITED_AFTER", 0)
+    bucket.succeeded()
+    assert bucket.rate is None and bucket.ceiling is None
+
+
+def test_configure():
+    limiter = RateLimiter()
+    limiter.configure("SoftLayer=10, UsageReportsV4=2.5")
+    assert limiter.bucket("SoftLayer").rate == 10
+    assert limiter.bucket("UsageReportsV4").rate == 2.5
+    assert limiter.bucket("GlobalSearchV2").rate is None
+
+
+def test_call_retries_throttled(monkeypatch):
+    monkeypatch.setattr(rateLimiter, "THROTTLE_PAUSE", 0)
+    limiter = RateLimiter()
+    outcomes = iter([429, 429, 200])
+    assert limiter.call("Test", lambda: next(outcomes), lambda outcome: outcome == 429) == 200
+    assert limiter.bucket("Test").lastThrottled is not None
+
+
+def test_call_gives_up(monkeypatch):
+    monkeypatch.setattr(rateLimiter, "THROTTLE_PAUSE", 0)
+    limiter = RateLimiter()
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        raise RuntimeError("rate limit")
+    with pytest.raises(RuntimeError):
+        limiter.call("Test", throttled, lambda outcome: isinstance(outcome, RuntimeError))
+    assert len(calls) == rateLimiter.THROTTLE_RETRIES + 1
+
+
+def test_call_error_not_retried():
+    limiter = RateLimiter()
+    calls = []
+
+    def failed():
+        calls.append(1)
+        raise ValueError("bad request")
+    with pytest.raises(ValueError):
+        limiter.call("Test", failed, lambda outcome: False)
+    assert len(calls) == 1
@@ -0,0 +1,122 @@
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+ResourceCache full and incremental refreshes, pruning, lookups and tags.
+"""
+
+import time
+from resourceCache import ResourceCache
+
+
+class Controller(object):
+    """
+    Stand-in for the resource controller listing, recording the arguments of each call
+    """
+
+    def __init__(self, active, removed=None):
+        self.active = active
+        self.removed = removed or {}
+        self.calls = []
+
+    def __call__(self, updated_from=None, state=None):
+        self.calls.append((updated_from, state))
+        listed = self.removed if state == "removed" else self.active
+        return {crn: record for crn, record in listed.items() if updated_from is None or record["updated_at"] > updated_from}
+
+
+def instance(updated, state="active"):
+    return {"state": state, "updated_at": updated, "type": "service_instance"}
+
+
+def age(cache, crn, seconds):
+    with cache.lock, cache.db:
+        cache.db.execute("UPDATE resources SET fetched = fetched - ? WHERE crn = ?", (seconds, crn))
+
+
+def test_full_then_incremental(tmp_path):
+    cache = ResourceCache(str(tmp_path / "cache.db"))
+    controller = Controller({"crn:a": instance("2023-01-01T00:00:00Z"), "crn:b": instance("2023-01-02T00:00:00Z")})
+    assert set(cache.refreshResources(controller)) == {"crn:a", "crn:b"}
+    assert controller.calls == [(None, None)]
+
+    controller.active["crn:c"] = instance("2023-01-03T00:00:00Z")
+    controller.removed["crn:a"] = instance("2023-01-04T00:00:00Z", "removed")
+    resources = cache.refreshResources(controller)
+    # only instances updated since the newest seen are listed, active and removed
+    assert controller.calls[1:] == [("2023-01-02T00:00:00Z", None), ("2023-01-02T00:00:00Z", "removed")]
+    assert set(resources) == {"crn:a", "crn:b", "crn:c"}
+    assert resources["crn:a"]["state"] == "removed"
+    assert cache.getRefresh("resources")[1] == "2023-01-04T00:00:00Z"
+
+
+def test_full_refresh_prunes(tmp_path):
+    cache = ResourceCache(str(tmp_path / "cache.db"), resourceTTL=3600)
+    cache.refreshResources(Controller({"crn:a": instance("2023-01-01T00:00:00Z"), "crn:b": instance("2023-01-01T00:00:00Z")}))
+    # lookups during the run of a deleted instance and an inaccessible one
+    cache.saveLookups({"crn:deleted": instance("2023-01-01T00:00:00Z", "removed"), "crn:forbidden": {}, "crn:old": {}})
+    age(cache, "crn:old", 7200)
+    cache.setRefresh("resources", time.time() - 7200, "2023-01-01T00:00:00Z")
+
+    resources = cache.refreshResources(Controller({"crn:a": instance("2023-01-01T00:00:00Z")}))
+    # crn:b was active and is no longer listed, crn:old was looked up before the TTL
+    assert set(resources) == {"crn:a", "crn:deleted", "crn:forbidden"}
+
+
+def test_missing_lookups_expire(tmp_path):
+    cache = ResourceCache(str(tmp_path / "cache.db"), missingTTL=60)
+    cache.saveLookups({"crn:forbidden": {}, "crn:expired": {}})
+    age(cache, "crn:expired", 120)
+    assert set(cache.loadResources()) == {"crn:forbidden"}
+
+
+def test_lookups_not_saved_twice(tmp_path):
+    cache = ResourceCache(str(tmp_path / "cache.db"))
+    resources = cache.refreshResources(Controller({"crn:a": instance("2023-01-01T00:00:00Z")}))
+    resources["crn:new"] = {}
+    cache.saveLookups(resources)
+    assert cache.loaded == {"crn:a", "crn:new"}
+
+
+def test_shared_between_runs(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = ResourceCache(path)
+    cache.refreshResources(Controller({"crn:a": instance("2023-01-01T00:00:00Z")}))
+    cache.close()
+    controller = Controller({"crn:a": instance("2023-01-01T00:00:00Z")})
+    assert set(ResourceCache(path).refreshResources(controller)) == {"crn:a"}
+    assert controller.calls[0][0] == "2023-01-01T00:00:00Z"
+
+
+def test_tags(tmp_path):
+    cache = ResourceCache(str(tmp_path / "cache.db"), tagTTL=3600)
+    searches = []
+
+    def searchTags():
+        searches.append(1)
+        return {"crn:a": ["env:prod", "team:x"]}
+    assert cache.refreshTags(searchTags) == {"crn:a": ["env:prod", "team:x"]}
+    assert cache.refreshTags(searchTags) == {"crn:a": ["env:prod", "team:x"]}
+    assert len(searches) == 1
+    cache.setRefresh("tags", time.time() - 7200, None)
+    cache.refreshTags(searchTags)
+    assert len(searches) == 2
+
+
+def test_catalog(tmp_path):
+    cache = ResourceCache(str(tmp_path / "cache.db"), catalogTTL=60)
+    cache.saveCatalog({"plan-1": "Lite", "service-1": "Cloudant"})
+    assert cache.loadCatalog() == {"plan-1": "Lite", "service-1": "Cloudant"}
+    with cache.lock, cache.db:
+        cache.db.execute("UPDATE catalog SET fetched = fetched - 120 WHERE id = 'plan-1'")
+    assert cache.loadCatalog() == {"service-1": "Cloudant"}
@@ -0,0 +1,105 @@
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Snapshots written day by day with saveSnapshot read back with iterSnapshots and loadSnapshot.
+"""
+
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+import usageSnapshots
+
+
+def dayUsage(day, rng):
+    """
+    Instance usage of a day: instances come and go, costs change and one key appears twice
+    """
+    instances = ["crn:instance:{}".format(i) for i in range(20) if (i + day.day) % 7 != 0]
+    rows = []
+    for instance in instances:
+        for metric in ["HOURS", "GB"]:
+            rows.append({"month": day.strftime("%Y-%m"), "instance_id": instance, "metric": metric, "unit": "UNIT",
+                         "service_name": "service", "cost": float(rng.integers(0, 5)), "quantity": float(rng.integers(0, 100)),
+                         "price": [{"quantity_from": 0, "price": 0.01}], "numberOfVirtualCPUs": "" if metric == "GB" else 4})
+    rows.append(dict(rows[0], cost=99.0))
+    return pd.DataFrame(rows)
+
+
+def expected(df):
+    """
+    A day's usage as the snapshots return it, lists as JSON text, in key order
+    """
+    return canonical(usageSnapshots.toColumnar(df).drop(columns="_n"))
+
+
+def canonical(df):
+    df = df.astype(str).sort_values(list(df.columns)).reset_index(drop=True)
+    return df[sorted(df.columns)]
+
+
+def writeDays(snapshotDir, first, count):
+    rng = np.random.default_rng(1)
+    days = {}
+    for i in range(count):
+        day = first + timedelta(days=i)
+        df = dayUsage(day, rng)
+        usageSnapshots.saveSnapshot(str(snapshotDir), df, day.strftime("%Y%m%d"))
+        days[day.strftime("%Y%m%d")] = expected(df)
+    return days
+
+
+def test_full_and_delta_snapshots(tmp_path):
+    writeDays(tmp_path, date(2023, 3, 25), 20)
+    snapshots = usageSnapshots.listSnapshots(str(tmp_path))
+    bases = [day for day, delta in snapshots if not delta]
+    # the first day, the start of April and every BASE_INTERVAL days are full snapshots
+    assert bases == ["20230325", "20230401", "20230408"]
+    assert len(snapshots) == 20
+
+
+def test_iterate_every_day(tmp_path):
+    days = writeDays(tmp_path, date(2023, 3, 25), 20)
+    read = list(usageSnapshots.iterSnapshots(str(tmp_path)))
+    assert [day for day, df in read] == sorted(days)
+    for day, df in read:
+        pd.testing.assert_frame_equal(canonical(df), days[day])
+
+
+def test_iterate_from_start(tmp_path):
+    days = writeDays(tmp_path, date(2023, 3, 25), 20)
+    read = list(usageSnapshots.iterSnapshots(str(tmp_path), start="20230403", end="20230410"))
+    assert [day for day, df in read] == [day for day in sorted(days) if "20230403" <= day <= "20230410"]
+    for day, df in read:
+        pd.testing.assert_frame_equal(canonical(df), days[day])
+
+
+def test_load_snapshot(tmp_path):
+    days = writeDays(tmp_path, date(2023, 3, 25), 20)
+    for day in ["20230325", "20230331", "20230406", "20230413"]:
+        pd.testing.assert_frame_equal(canonical(usageSnapshots.loadSnapshot(str(tmp_path), day)), days[day])
+    assert usageSnapshots.loadSnapshot(str(tmp_path), "20230501") is None
+
+
+def test_columns(tmp_path):
+    writeDays(tmp_path, date(2023, 3, 25), 10)
+    for day, df in usageSnapshots.iterSnapshots(str(tmp_path), columns=["cost"]):
+        assert sorted(df.columns) == sorted(usageSnapshots.KEY + ["cost"])
+
+
+def test_rewrite_day(tmp_path):
+    days = writeDays(tmp_path, date(2023, 3, 25), 3)
+    changed = dayUsage(date(2023, 3, 27), np.random.default_rng(2))
+    usageSnapshots.saveSnapshot(str(tmp_path), changed, "20230327")
+    pd.testing.assert_frame_equal(canonical(usageSnapshots.loadSnapshot(str(tmp_path), "20230327")), expected(changed))
+    pd.testing.assert_frame_equal(canonical(usageSnapshots.loadSnapshot(str(tmp_path), "20230326")), days["20230326"])
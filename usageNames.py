@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Local name resolution for usage retrieved with names=False.
+
+The usage reports API only adds service, plan, resource group and instance names to each record when names=True is
+requested, which inflates every page.  Usage can instead be retrieved by id, and the name columns filled afterwards:
+service and plan names from the global catalog and resource group names from the resource manager (instance names
+come from the resource cache as each row is enriched).  Catalog ids not yet known are looked up concurrently in one
+pass over the distinct ids, and kept in the resource cache file if one is used.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from ibm_cloud_sdk_core import ApiException
+
+
+class UsageNames(object):
+    """
+    Fills usage name columns from their id columns
+    """
+
+    def __init__(self, global_catalog_service, resource_manager_service=None, accountId=None, cache=None, workers=8):
+        self.global_catalog_service = global_catalog_service
+        self.resource_manager_service = resource_manager_service
+        self.accountId = accountId
+        self.cache = cache
+        self.workers = workers
+        self.catalog = cache.loadCatalog() if cache != None else {}
+        self.groups = None
+
+    def getCatalogName(self, catalogId):
+        """
+        Return the display name of a service or plan from the global catalog, or None if it can't be retrieved
+        """
+        try:
+            entry = self.global_catalog_service.get_catalog_entry(id=catalogId).get_result()
+        except ApiException as e:
+            logging.warning("Error: Catalog entry {} {}: {}".format(catalogId, str(e.code), e.message))
+            return None
+        display_name = entry.get("overview_ui", {}).get("en", {}).get("display_name")
+        return display_name if display_name else entry.get("name")
+
+    def resolveCatalog(self, catalogIds):
+        """
+        Look up the catalog ids not already known concurrently
+        """
+        missing = [catalogId for catalogId in set(catalogIds) if isinstance(catalogId, str) and catalogId != "" and catalogId not in self.catalog]
+        if len(missing) == 0:
+            return
+        logging.info("Resolving {} service and plan names from the global catalog.".format(len(missing)))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            resolved = {catalogId: name for catalogId, name in zip(missing, executor.map(self.getCatalogName, missing)) if name != None}
+        self.catalog.update(resolved)
+        if self.cache != None and len(resolved) > 0:
+            self.cache.saveCatalog(resolved)
+
+    def catalogName(self, catalogId):
+        """
+        Return the catalog name of an id, or the id itself if it is unknown
+        """
+        return self.catalog.get(catalogId, catalogId)
+
+    def resourceGroups(self):
+        """
+        Return a dict of resource group id to name for the account, including deleted groups, retrieved once
+        """
+        if self.groups is None:
+            self.groups = {}
+            try:
+                result = self.resource_manager_service.list_resource_groups(account_id=self.accountId, include_deleted=True).get_result()
+                for group in result["resources"]:
+                    self.groups[group["id"]] = group["name"]
+            except ApiException as e:
+                logging.warning("Error: Resource groups {}: {}".format(str(e.code), e.message))
+        return self.groups
+
+    def fillCatalogNames(self, df, columns):
+        """
+        Fill name columns of df from catalog ids, columns is a dict of name column to id column
+        """
+        if len(df) == 0:
+            return df
+        self.resolveCatalog(pd.unique(pd.concat([df[idColumn].astype(object) for idColumn in columns.values()])))
+        for nameColumn, idColumn in columns.items():
+            df[nameColumn] = df[idColumn].map(self.catalogName)
+        return df
+
+    def fillResourceGroupNames(self, df, nameColumn="resource_group_name", idColumn="resource_group_id"):
+        groups = self.resourceGroups()
+        df[nameColumn] = df[idColumn].map(lambda groupId: groups.get(groupId, groupId))
+        return df
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Author: Jon Hall
+# Copyright (c) 2023
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Daily instance usage snapshots stored as Arrow (feather) files.
+
+A day's month to date instance usage is written as a full snapshot (instanceUsage-YYYYMMDD.feather) when there is no
+earlier snapshot, at the start of a month, or every BASE_INTERVAL days.  Other days only store the rows added or changed
+since the previous snapshot, and the keys of rows removed (instanceUsage-YYYYMMDD.delta.feather).  Rows are keyed by
+month, instance_id, metric and unit.  loadSnapshot() rebuilds any day from the last full snapshot and the deltas after it.
+
+    python usageSnapshots.py --snapshot-dir snapshots --day 20231015 --output instanceUsage-20231015.pkl
+"""
+
+import os, re, json, logging, argparse
+from datetime import datetime
+import pandas as pd
+import pyarrow, pyarrow.feather as feather
+from logSetup import setup_logging
+
+# days between full snapshots, bounding the number of deltas applied to rebuild a day
+BASE_INTERVAL = 7
+
+KEY = ["month", "instance_id", "metric", "unit"]
+
+snapshotFile = re.compile(r"^instanceUsage-(\d{8})(\.delta)?\.feather$")
+
+
+def snapshotPath(snapshotDir, day, delta=False):
+    return os.path.join(snapshotDir, "instanceUsage-{}{}.feather".format(day, ".delta" if delta else ""))
+
+def listSnapshots(snapshotDir):
+    """
+    Return a sorted list of (day, delta) for the snapshots in a directory, day is YYYYMMDD
+    """
+    snapshots = []
+    if os.path.isdir(snapshotDir):
+        for name in os.listdir(snapshotDir):
+            match = snapshotFile.match(name)
+            if match:
+                snapshots.append((match.group(1), match.group(2) != None))
+    return sorted(snapshots)
+
+def toText(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return None
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+def toColumnar(df):
+    """
+    Return a copy of df Arrow can store: categories as plain values, and columns of mixed types (ie "" and numbers,
+    or the price and discount lists) as text.  A per key occurrence number _n keeps duplicate keys distinct.
+    """
+    df = df.reset_index(drop=True).copy()
+    for column in df.columns:
+        if df[column].dtype.name == "category":
+            df[column] = df[column].astype(object)
+        if df[column].dtype == object:
+            kind = pd.api.types.infer_dtype(df[column], skipna=True)
+            if kind not in ("string", "empty", "integer", "floating", "mixed-integer-float", "boolean"):
+                df[column] = df[column].map(toText)
+    df["_n"] = df.groupby(KEY, dropna=False, sort=False).cumcount()
+    return df
+
+def readFeather(path, columns=None):
+    """
+    Read a snapshot file memory mapped, only the columns (of those present) if given
+    """
+    if columns != None:
+        with pyarrow.memory_map(path) as source:
+            present = set(pyarrow.ipc.open_file(source).schema.names)
+        columns = [column for column in columns if column in present]
+    return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+def rowKeys(df, columns=KEY):
+    """
+    Return a uint64 hash of the key columns of each row
+    """
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy()
+
+def diffSnapshot(previous, current):
+    """
+    Return the rows of current which are new or changed since previous, and the keys of rows no longer in current
+    flagged with _deleted
+    """
+    keys = KEY + ["_n"]
+    values = [column for column in current.columns if column not in keys]
+    merged = current.merge(previous, on=keys, how="outer", suffixes=("", "_previous"), indicator=True)
+    both = (merged["_merge"] == "both").to_numpy()
+    changed = (merged["_merge"] == "left_only").to_numpy()
+    for column in values:
+        if column + "_previous" not in merged.columns:
+            changed |= both
+            continue
+        a = merged[column]
+        b = merged[column + "_previous"]
+        changed |= both & ~((a == b) | (a.isna() & b.isna())).to_numpy()
+    delta = merged.loc[changed, keys + values].assign(_deleted=False)
+    removed = merged.loc[(merged["_merge"] == "right_only").to_numpy(), keys].assign(_deleted=True)
+    return pd.concat([delta, removed], ignore_index=True)
+
+def applyDelta(state, delta):
+    """
+    Apply the changed and removed rows of a delta to a rebuilt snapshot
+    """
+    keys = KEY + ["_n"]
+    # rows are matched on a 64 bit hash of their key, much quicker than a MultiIndex
+    state = state[~pd.Index(rowKeys(state, keys)).isin(rowKeys(delta, keys))]
+    deleted = delta["_deleted"].astype(bool).to_numpy()
+    return pd.concat([state, delta.loc[~deleted].drop(columns="_deleted")], ignore_index=True)
+
+def iterSnapshots(snapshotDir, start=None, end=None, columns=None, keepKey=False):
+    """
+    Yield (day, instance usage) for each snapshot day from start to end (YYYYMMDD, default all), rebuilding each day
+    from the day before rather than from its full snapshot.  columns limits the columns read.
+    """
+    snapshots = [(day, delta) for day, delta in listSnapshots(snapshotDir) if end == None or day <= end]
+    bases = [i for i, (day, delta) in enumerate(snapshots) if not delta]
+    if len(bases) == 0:
+        return
+    if start == None:
+        first = bases[0]
+    else:
+        # start from the last full snapshot on or before start
+        first = max([i for i in bases if snapshots[i][0] <= start], default=bases[0])
+    if columns != None:
+        columns = list(dict.fromkeys(KEY + ["_n"] + list(columns)))
+    state = None
+    for day, delta in snapshots[first:]:
+        if delta:
+            state = applyDelta(state, readFeather(snapshotPath(snapshotDir, day, True), None if columns is None else columns + ["_deleted"]))
+        else:
+            state = readFeather(snapshotPath(snapshotDir, day), columns)
+        if start == None or day >= start:
+            yield day, state if keepKey else state.drop(columns="_n")
+
+def loadSnapshot(snapshotDir, day=None, keepKey=False, columns=None):
+    """
+    Rebuild the instance usage of a day (YYYYMMDD, default the latest) from the last full snapshot before it and
+    the deltas after that.  Returns None if there is no snapshot for the day.
+    """
+    snapshots = listSnapshots(snapshotDir)
+    if day == None and len(snapshots) > 0:
+        day = snapshots[-1][0]
+    for snapshotDay, state in iterSnapshots(snapshotDir, day, day, columns, keepKey):
+        return state
+    return None
+
+def saveSnapshot(snapshotDir, instancesUsage, day=None):
+    """
+    Store a day's instance usage (the wide frame), as a delta of the previous snapshot where there is one.
+    Returns the path written.
+    """
+    day = day if day != None else datetime.now().strftime("%Y%m%d")
+    os.makedirs(snapshotDir, exist_ok=True)
+    current = toColumnar(instancesUsage)
+    earlier = [(snapshotDay, delta) for snapshotDay, delta in listSnapshots(snapshotDir) if snapshotDay < day]
+    bases = [snapshotDay for snapshotDay, delta in earlier if not delta]
+    if len(bases) == 0 or earlier[-1][0][:6] != day[:6] or \
+            (datetime.strptime(day, "%Y%m%d") - datetime.strptime(bases[-1], "%Y%m%d")).days >= BASE_INTERVAL:
+        path = snapshotPath(snapshotDir, day)
+        feather.write_feather(current, path)
+        logging.info("Wrote full instance usage snapshot {} ({} rows).".format(path, len(current)))
+    else:
+        delta = diffSnapshot(loadSnapshot(snapshotDir, earlier[-1][0], keepKey=True), current)
+        path = snapshotPath(snapshotDir, day, True)
+        feather.write_feather(delta, path)
+        logging.info("Wrote instance usage snapshot delta {} ({} of {} rows changed or removed).".format(path, len(delta), len(current)))
+    # a snapshot replacing one for the same day must not leave the other form behind
+    other = snapshotPath(snapshotDir, day, not path.endswith(".delta.feather"))
+    if os.path.exists(other):
+        os.remove(other)
+    return path
+
+
+if __name__ == "__main__":
+    setup_logging()
+    parser = argparse.ArgumentParser(description="Rebuild a day's instance usage from ibmCloudUsage.py snapshots.")
+    parser.add_argument("--snapshot-dir", default=os.environ.get('snapshot_dir', 'snapshots'), help="Directory of instance usage snapshots.")
+    parser.add_argument("--day", default=None, help="Day to rebuild YYYYMMDD, default the latest snapshot.")
+    parser.add_argument("--output", default=None, help="Pickle file to write, default instanceUsage-YYYYMMDD.pkl.")
+    args = parser.parse_args()
+
+    day = args.day if args.day != None else listSnapshots(args.snapshot_dir)[-1][0]
+    instancesUsage = loadSnapshot(args.snapshot_dir, day)
+    if instancesUsage is None:
+        logging.error("No snapshot for {} in {}.".format(day, args.snapshot_dir))
+        quit()
+    output = args.output if args.output != None else "instanceUsage-{}.pkl".format(day)
+    instancesUsage.to_pickle(output)
+    logging.info("Rebuilt {} rows of instance usage for {} in {}.".format(len(instancesUsage), day, output))